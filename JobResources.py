@@ -0,0 +1,255 @@
+'''
+JobResources.py - size pipeline jobs from the history of earlier jobs
+=====================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+The pipeline records the peak memory, CPU time and run time of each job
+it runs, with the task and the size of its input, in a tab-separated
+history file (see :data:`HISTORY_COLUMNS`). Later jobs of the same task
+are given memory and threads predicted from that history, rather than
+fixed amounts, so small samples don't hold memory they don't need and
+deep samples get enough.
+
+Peak memory and CPU time are each fitted as a straight line of the input
+size over the successful jobs of a task. The memory prediction is moved
+up by the largest amount any earlier job used over the line, multiplied
+by a safety margin and rounded up to the next of a list of memory tiers.
+A job that runs out of memory is run again on the next tier up. A job
+has run out of memory only if it was killed by SIGKILL, as the kernel's
+out of memory killer does, or said so in its stderr; any other failure
+is not retried.
+
+Jobs are measured by measure_job.py, which :func:`measured_statement`
+starts in the background of a job's statement. It adds up the memory of
+every process of the job, and writes the measurements to a JSON file
+once the statement has finished.
+
+'''
+
+import os
+import json
+import math
+import errno
+import fcntl
+import numpy as np
+
+HISTORY_COLUMNS = ["task", "input_bytes", "threads", "memory_bytes",
+                   "max_rss_bytes", "cpu_seconds", "seconds", "status"]
+
+# messages in a job's stderr that mean it ran out of memory
+OOM_MESSAGES = ["java.lang.OutOfMemoryError", "MemoryError",
+                "std::bad_alloc", "Cannot allocate memory"]
+
+# exit status of a job killed with SIGKILL, as done by the kernel's out of
+# memory killer and by most cluster schedulers
+KILLED_STATUS = 128 + 9
+
+# the statement of a measured job, run in a subshell with measure_job.py
+# watching it from the background. The exit status is kept with && ||, so
+# that a failing statement doesn't stop the job before it is written.
+MEASURED_STATEMENT = '''python %%(projectsrc)s/measure_job.py
+        --pid=$$
+        --measure-path=%%(measure_path)s
+        --status-path=%%(measure_path)s.status
+        --stderr-path=%%(measure_path)s.err
+        -L %%(measure_path)s.log &
+    monitor=$! ;
+    ( %s ) 2> %%(measure_path)s.err && status=0 || status=$? ;
+    echo $status > %%(measure_path)s.status ;
+    wait $monitor ;
+    cat %%(measure_path)s.err >&2 ;
+    exit $status'''
+
+UNITS = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+
+
+def memory_bytes(value):
+    '''return a job_memory string such as "6G" as a number of bytes'''
+
+    value = str(value).strip().upper()
+    if value and value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+def memory_string(nbytes):
+    '''return `nbytes` as a job_memory string, in whole gigabytes if it is
+    one, otherwise in megabytes'''
+
+    if nbytes % UNITS["G"] == 0:
+        return "%iG" % (nbytes // UNITS["G"])
+    return "%iM" % int(math.ceil(float(nbytes) / UNITS["M"]))
+
+
+def make_directory(path):
+    '''create the directory `path` if it doesn't exist yet'''
+
+    try:
+        os.makedirs(path)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+
+
+def input_bytes(infiles):
+    '''return the total size of `infiles`, a path or a list of paths'''
+
+    if isinstance(infiles, basestring):
+        infiles = [infiles]
+    return sum(os.path.getsize(infile) for infile in infiles)
+
+
+def measured_statement(statement):
+    '''return `statement`, a pipeline task's statement before it is
+    interpolated, wrapped so that measure_job.py measures it. The wrapped
+    statement also needs values for projectsrc and measure_path, the file
+    the measurements are written to.'''
+
+    return MEASURED_STATEMENT % statement
+
+
+def read_history(path, task):
+    '''return the successful jobs of `task` in the history file at `path`,
+    as a list of dictionaries'''
+
+    if not os.path.exists(path):
+        return []
+
+    jobs = []
+    with open(path) as inf:
+        header = inf.readline().rstrip("\n").split("\t")
+        for line in inf:
+            job = dict(zip(header, line.rstrip("\n").split("\t")))
+            if job["task"] != task or int(job["status"]) != 0:
+                continue
+            for column in HISTORY_COLUMNS[1:]:
+                job[column] = float(job[column])
+            jobs.append(job)
+
+    return jobs
+
+
+def record(path, **job):
+    '''append `job`, with values for each of :data:`HISTORY_COLUMNS`, to
+    the history file at `path`. Jobs finishing at the same time each
+    append a whole line.'''
+
+    make_directory(os.path.dirname(path) or ".")
+
+    with open(path, "a") as outf:
+        fcntl.flock(outf, fcntl.LOCK_EX)
+        if outf.tell() == 0:
+            outf.write("\t".join(HISTORY_COLUMNS) + "\n")
+        outf.write("\t".join(str(job[column])
+                             for column in HISTORY_COLUMNS) + "\n")
+        fcntl.flock(outf, fcntl.LOCK_UN)
+
+
+def fit(sizes, values):
+    '''fit `values` as a straight line of `sizes`. Returns the predicted
+    value for a size as a function, and the largest amount any of
+    `values` is over the line.'''
+
+    sizes = np.asarray(sizes, dtype=float)
+    values = np.asarray(values, dtype=float)
+
+    if len(set(sizes)) > 1:
+        slope, intercept = np.polyfit(sizes, values, 1)
+    else:
+        slope, intercept = 0.0, values.mean()
+    if slope < 0:
+        slope, intercept = 0.0, values.mean()
+
+    over = max(0.0, (values - (intercept + slope * sizes)).max())
+
+    return lambda size: max(0.0, intercept + slope * size), over
+
+
+def choose_tier(nbytes, tiers):
+    '''return the smallest of `tiers`, in bytes, that is at least
+    `nbytes`, or the largest tier if none is'''
+
+    for tier in sorted(tiers):
+        if tier >= nbytes:
+            return tier
+    return max(tiers)
+
+
+def next_tier(nbytes, tiers):
+    '''return the smallest of `tiers` larger than `nbytes`, or None if
+    there isn't one'''
+
+    larger = [tier for tier in tiers if tier > nbytes]
+    return min(larger) if larger else None
+
+
+def job_memory(jobs, size, default, margin, tiers, threads=None,
+               min_history=3):
+    '''return the memory, in bytes, to give a job with `size` bytes of
+    input, from the earlier `jobs` of its task. Jobs run with the same
+    number of `threads` are used if there are enough of them. With fewer
+    than `min_history` jobs the `default` is used.'''
+
+    same_threads = [job for job in jobs if job["threads"] == threads]
+    if len(same_threads) >= min_history:
+        jobs = same_threads
+    if len(jobs) < min_history:
+        return memory_bytes(default)
+
+    predict, over = fit([job["input_bytes"] for job in jobs],
+                        [job["max_rss_bytes"] for job in jobs])
+
+    return choose_tier((predict(size) + over) * margin, tiers)
+
+
+def job_threads(jobs, size, default, maximum, target_seconds,
+                min_history=3):
+    '''return the number of threads, up to `maximum`, that should let a
+    job with `size` bytes of input finish in about `target_seconds`,
+    going by the CPU time of the earlier `jobs` of its task. With fewer
+    than `min_history` jobs the `default` is used.'''
+
+    if len(jobs) < min_history:
+        return default
+
+    predict, over = fit([job["input_bytes"] for job in jobs],
+                        [job["cpu_seconds"] for job in jobs])
+
+    return int(min(maximum, max(1, math.ceil(predict(size) /
+                                             target_seconds))))
+
+
+def java_heap(nbytes):
+    '''return the -Xmx setting that leaves room in `nbytes` of job memory
+    for the JVM's own use'''
+
+    return "%im" % (nbytes * 0.8 // UNITS["M"])
+
+
+def read_measurements(path):
+    '''read the measurements of a job written by measure_job.py to
+    `path`. Returns a dictionary of max_rss_bytes, cpu_seconds, seconds,
+    status and memory_error, or None if the job was killed before they
+    were written.'''
+
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+
+    with open(path) as inf:
+        return json.load(inf)
+
+
+def out_of_memory(measured):
+    '''return True if a failed job, with the `measured` values read by
+    :func:`read_measurements`, ran out of memory: it was killed by
+    SIGKILL or said it had run out in its stderr. A job without
+    measurements failed for some other reason.'''
+
+    if measured is None:
+        return False
+    return measured["status"] == KILLED_STATUS or \
+        bool(measured["memory_error"])
@@ -0,0 +1,71 @@
+'''
+MismatchCounts.py - columnar storage of per-gene mismatch counts
+=================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Per-gene counts from count_mismatches.py can be saved as a numpy ``.npz``
+archive instead of a tab-separated table. Each output column is stored
+as a typed array (strings for ``gene_id`` and ``strand``, 64 bit integers
+for the counts), so neither writing nor loading them involves formatting
+or parsing numbers.
+
+The archive also holds the column order (``columns``) and metadata about
+the run as 0-dimensional arrays, the most useful being ``sample``, the
+name of the BAM file the counts came from without its directory or
+``.bam`` suffix.
+
+'''
+
+import os
+import numpy as np
+
+# columns stored as strings, all the others are integer counts
+STRING_COLUMNS = ["gene_id", "strand"]
+
+
+def sample_name(bampath):
+    '''return the sample name for counts made from `bampath`'''
+
+    name = os.path.basename(bampath)
+    if name.endswith(".bam"):
+        name = name[:-len(".bam")]
+
+    return name
+
+
+def save_counts(path, header, rows, **metadata):
+    '''save `rows`, a list of output rows with columns named in `header`,
+    to the archive `path`. Keyword arguments are saved as metadata.'''
+
+    arrays = {}
+    for column, values in zip(header, zip(*rows) or [[]] * len(header)):
+        if column in STRING_COLUMNS:
+            arrays[column] = np.array(values, dtype=str)
+        else:
+            arrays[column] = np.array(values, dtype=np.int64)
+
+    arrays["columns"] = np.array(header)
+    for key, value in metadata.iteritems():
+        arrays[key] = np.array(value)
+
+    with open(path, "wb") as outf:
+        np.savez(outf, **arrays)
+
+
+def load_counts(path):
+    '''load an archive written by :func:`save_counts`. Returns a list of
+    (column, array) tuples in output order, and a dictionary of the
+    metadata.'''
+
+    archive = np.load(path)
+    names = list(archive["columns"])
+    columns = [(name, archive[name]) for name in names]
+    metadata = dict((key, archive[key].item()) for key in archive.files
+                    if key != "columns" and key not in names)
+    archive.close()
+
+    return columns, metadata
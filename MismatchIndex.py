@@ -0,0 +1,517 @@
+'''
+MismatchIndex.py - compact on-disk indexes used when counting mismatches
+=========================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+An index is a set of numpy arrays that are sorted by contig and saved
+as ``<prefix>.<name>.npy``, together with a table ``<prefix>.contigs.tsv``
+giving the first and last row of each contig. The table is written last,
+so it can be used as the target of a pipeline task.
+
+Arrays are opened memory-mapped, so loading an index is nearly free and
+concurrent jobs on a node share a single copy of it in the page cache.
+
+'''
+
+import os
+import re
+from collections import defaultdict
+import numpy as np
+import pysam
+
+CONTIGS_SUFFIX = ".contigs.tsv"
+
+# bases packed into 4 bits: a=0, c=1, g=2, t=3, anything else 4, which
+# unpacks to 0 so that it never matches a base
+PACK_CODE = dict((base, code) for code, base in enumerate("acgt"))
+UNPACK_BASE = np.array([ord(base) for base in "acgt"] + [0] * 12,
+                       dtype=np.uint8)
+
+
+def contig_aliases(contig):
+    '''other names that `contig` could go by, switching between UCSC
+    (chr1, chrM) and Ensembl (1, MT) styles'''
+
+    if contig.startswith("chr"):
+        alias = contig[3:]
+        if alias == "M":
+            alias = "MT"
+    elif contig == "MT":
+        alias = "chrM"
+    else:
+        alias = "chr" + contig
+
+    return [alias]
+
+
+def fetch_regions(handle, contigs, regions):
+    '''iterate over the records of the tabix indexed `handle` (a pysam
+    VariantFile or TabixFile with `contigs`) in each of `regions`, a list
+    of (contig, start, end) tuples. Contigs are looked up under their other
+    names if the file doesn't have them.'''
+
+    contigs = set(contigs)
+    for contig, start, end in regions:
+        for name in [contig] + contig_aliases(contig):
+            if name in contigs:
+                for record in handle.fetch(name, start, end):
+                    yield record
+                break
+
+
+def index_prefix(path):
+    '''return the prefix of an index given either the prefix or the path
+    of its contigs table'''
+
+    if path.endswith(CONTIGS_SUFFIX):
+        return path[:-len(CONTIGS_SUFFIX)]
+    return path
+
+
+def write_index(prefix, contigs, **arrays):
+    '''save `arrays` as an index at `prefix`.
+
+    `contigs` is a list of (contig, first, last) tuples giving the rows of
+    the arrays that belong to each contig.
+    '''
+
+    for name, values in arrays.iteritems():
+        np.save("%s.%s.npy" % (prefix, name), values)
+
+    tmpfile = prefix + CONTIGS_SUFFIX + ".tmp"
+    with open(tmpfile, "w") as outf:
+        outf.write("contig\tfirst\tlast\n")
+        for contig, first, last in contigs:
+            outf.write("%s\t%i\t%i\n" % (contig, first, last))
+    os.rename(tmpfile, prefix + CONTIGS_SUFFIX)
+
+
+def concatenate_contigs(contig_arrays, names):
+    '''join per-contig arrays into single arrays.
+
+    `contig_arrays` is a list of (contig, arrays) tuples, where arrays is
+    a dictionary keyed by `names`. Returns the contigs list needed by
+    :func:`write_index` and a dictionary of joined arrays.
+    '''
+
+    contigs = []
+    first = 0
+    for contig, arrays in contig_arrays:
+        last = first + len(arrays[names[0]])
+        contigs.append((contig, first, last))
+        first = last
+
+    joined = {}
+    for name in names:
+        joined[name] = np.concatenate(
+            [arrays[name] for contig, arrays in contig_arrays] or
+            [np.zeros(0)])
+
+    return contigs, joined
+
+
+class ArrayIndex(object):
+    '''a set of arrays with rows grouped by contig.
+
+    Use :meth:`load` to open an index written by :func:`write_index`, or
+    pass the contigs list and arrays to build one in memory.
+    '''
+
+    def __init__(self, contigs, arrays):
+
+        self.contig_rows = list(contigs)
+        self.contigs = dict((contig, (first, last))
+                            for contig, first, last in contigs)
+        self.arrays = arrays
+        self._resolved = {}
+
+    @classmethod
+    def load(cls, path):
+        prefix = index_prefix(path)
+        contigs = []
+        with open(prefix + CONTIGS_SUFFIX) as inf:
+            inf.readline()
+            for line in inf:
+                contig, first, last = line.rstrip("\n").split("\t")
+                contigs.append((contig, int(first), int(last)))
+
+        arrays = {}
+        dirname, basename = os.path.split(prefix)
+        pattern = re.compile(r"^%s\.([^.]+)\.npy$" % re.escape(basename))
+        for filename in os.listdir(dirname or "."):
+            match = pattern.match(filename)
+            if match:
+                arrays[match.group(1)] = np.load(
+                    os.path.join(dirname, filename), mmap_mode="r")
+
+        return cls(contigs, arrays)
+
+    def save(self, prefix):
+        '''write the index to disk at `prefix`'''
+        write_index(prefix, self.contig_rows, **self.arrays)
+
+    def rows(self, contig, suffix=""):
+        '''return the first and last rows for `contig`, trying other names
+        for it if needed. Contigs that aren't in the index have no rows.
+
+        Indexes that split contigs further (eg by strand) name their rows
+        `contig` + `suffix`.'''
+
+        key = contig + suffix
+        if key not in self._resolved:
+            self._resolved[key] = (0, 0)
+            for name in [contig] + contig_aliases(contig):
+                if name + suffix in self.contigs:
+                    self._resolved[key] = self.contigs[name + suffix]
+                    break
+
+        return self._resolved[key]
+
+
+class VariantIndex(ArrayIndex):
+    '''the non-reference sites of one donor.
+
+    :attr:`arrays` holds ``positions`` (0-based, sorted within each contig)
+    and ``alts``, the ascii code of the lower case alt base, or 0 where the
+    alt allele isn't a single base.
+    '''
+
+    names = ["positions", "alts"]
+
+    def fetch(self, contig, start, end):
+        '''return the positions and alt bases of the sites in
+        `contig`:`start`-`end`'''
+
+        first, last = self.rows(contig)
+        positions = self.arrays["positions"][first:last]
+        lo, hi = np.searchsorted(positions, [start, end])
+
+        return (positions[lo:hi],
+                self.arrays["alts"][first:last][lo:hi])
+
+
+class RediIndex(ArrayIndex):
+    '''RNA editing sites from the REDIportal table.
+
+    Rows are grouped by contig and strand (named eg ``chr1+``) and hold
+    ``positions`` (0-based, sorted) and ``bases``, the ref and alt bases
+    packed into the high and low 4 bits of a byte.
+    '''
+
+    names = ["positions", "bases"]
+
+    def fetch(self, contig, strand, start, end):
+        '''return the positions and the ascii codes of the lower case ref
+        and alt bases of the editing sites on `strand` in
+        `contig`:`start`-`end`'''
+
+        first, last = self.rows(contig, strand)
+        positions = self.arrays["positions"][first:last]
+        lo, hi = np.searchsorted(positions, [start, end])
+        bases = self.arrays["bases"][first:last][lo:hi]
+
+        return (positions[lo:hi],
+                UNPACK_BASE[bases >> 4],
+                UNPACK_BASE[bases & 15])
+
+
+class GenomeIndex(ArrayIndex):
+    '''the reference genome as a single array, ``bases``, of the ascii
+    codes of the lower case bases of each contig.
+
+    Sequences returned by :meth:`fetch` are views on the memory-mapped
+    array, so no copy of the genome is made per gene and all the processes
+    counting against the same genome share it in the page cache.
+    '''
+
+    names = ["bases"]
+
+    def fetch(self, contig, start, end):
+        '''return the bases of `contig`:`start`-`end` as a uint8 array'''
+
+        first, last = self.rows(contig)
+        return self.arrays["bases"][first:last][start:end]
+
+
+class GeneIndex(ArrayIndex):
+    '''gene models compiled from a GTF file.
+
+    Rows are genes, grouped by contig, and hold ``gene_ids``, ``strands``
+    (ascii codes), the span of the gene from its first to its last exon
+    (``starts`` and ``ends``, 0-based half open), ``ranks``, the order of
+    the genes in the GTF file, and ``exon_firsts`` and ``exon_lasts``, the
+    rows of the gene's exons in ``exon_starts`` and ``exon_ends``. The
+    exons of each gene are merged where they overlap and sorted by start.
+    ``id_order`` lists the rows sorted by gene id, for :meth:`find`.
+    '''
+
+    names = ["gene_ids", "strands", "starts", "ends", "ranks",
+             "exon_firsts", "exon_lasts"]
+
+    def genes(self):
+        '''iterate over the genes in the order of the GTF file, as tuples
+        of (gene_id, contig, strand, start, end)'''
+
+        contig_names = [contig for contig, first, last in self.contig_rows]
+        contig_of = np.repeat(np.arange(len(self.contig_rows)),
+                              [last - first for contig, first, last
+                               in self.contig_rows]).tolist()
+        gene_ids = self.arrays["gene_ids"].tolist()
+        strands = self.arrays["strands"].tolist()
+        starts = self.arrays["starts"].tolist()
+        ends = self.arrays["ends"].tolist()
+
+        for row in np.argsort(self.arrays["ranks"], kind="mergesort"):
+            yield (gene_ids[row], contig_names[contig_of[row]],
+                   chr(strands[row]), starts[row], ends[row])
+
+    def find(self, gene_id):
+        '''return the row of `gene_id`, or None if it isn't in the
+        index'''
+
+        order = self.arrays["id_order"]
+        gene_ids = self.arrays["gene_ids"]
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if gene_ids[order[mid]] < gene_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(order) and gene_ids[order[lo]] == gene_id:
+            return int(order[lo])
+        return None
+
+    def exons(self, row):
+        '''return the starts and ends of the exons of the gene in `row`'''
+
+        first = self.arrays["exon_firsts"][row]
+        last = self.arrays["exon_lasts"][row]
+        return (self.arrays["exon_starts"][first:last],
+                self.arrays["exon_ends"][first:last])
+
+
+def merge_intervals(intervals):
+    '''merge overlapping or touching (start, end) `intervals`. Returns a
+    sorted list of (start, end) tuples.'''
+
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return [tuple(interval) for interval in merged]
+
+
+def build_gene_index(genes):
+    '''build a :class:`GeneIndex` from `genes`, an iterable of (gene_id,
+    contig, strand, start, end, exons) tuples in the order of the GTF
+    file, where exons is a list of (start, end) tuples.'''
+
+    keys = []
+    contig_genes = defaultdict(list)
+    for rank, (gene_id, contig, strand, start, end, exons) in \
+            enumerate(genes):
+        if contig not in contig_genes:
+            keys.append(contig)
+        contig_genes[contig].append((rank, gene_id, strand, start, end,
+                                     merge_intervals(exons)))
+
+    contig_arrays = []
+    exon_starts, exon_ends = [], []
+    for contig in keys:
+        arrays = dict((name, []) for name in GeneIndex.names)
+        for rank, gene_id, strand, start, end, exons in \
+                contig_genes.pop(contig):
+            arrays["gene_ids"].append(gene_id)
+            arrays["strands"].append(ord(strand))
+            arrays["starts"].append(start)
+            arrays["ends"].append(end)
+            arrays["ranks"].append(rank)
+            arrays["exon_firsts"].append(len(exon_starts))
+            exon_starts.extend(start for start, end in exons)
+            exon_ends.extend(end for start, end in exons)
+            arrays["exon_lasts"].append(len(exon_starts))
+        contig_arrays.append((contig, arrays))
+
+    contigs, arrays = concatenate_contigs(contig_arrays, GeneIndex.names)
+    arrays["gene_ids"] = np.array(arrays["gene_ids"], dtype=str)
+    arrays["strands"] = arrays["strands"].astype(np.uint8)
+    for name in ["starts", "ends", "ranks", "exon_firsts", "exon_lasts"]:
+        arrays[name] = arrays[name].astype(np.int64)
+    arrays["exon_starts"] = np.array(exon_starts, dtype=np.int64)
+    arrays["exon_ends"] = np.array(exon_ends, dtype=np.int64)
+    arrays["id_order"] = np.argsort(arrays["gene_ids"], kind="mergesort")
+
+    return GeneIndex(contigs, arrays)
+
+
+def build_genome_index(fasta, prefix, chunk_size=10000000):
+    '''write the sequences in `fasta`, a CGAT IndexedFasta, as a
+    :class:`GenomeIndex` at `prefix`. Contigs are copied into the
+    memory-mapped array `chunk_size` bases at a time, so the whole genome
+    is never held in memory.
+
+    Returns the contigs list of the index.
+    '''
+
+    sizes = fasta.getContigSizes(with_synonyms=False)
+    contigs = []
+    first = 0
+    for contig in sorted(sizes):
+        contigs.append((contig, first, first + sizes[contig]))
+        first += sizes[contig]
+
+    bases = np.lib.format.open_memmap("%s.bases.npy" % prefix, mode="w+",
+                                      dtype=np.uint8, shape=(first,))
+    for contig, first, last in contigs:
+        for start in range(0, last - first, chunk_size):
+            end = min(start + chunk_size, last - first)
+            seq = fasta.getSequence(contig, "+", start, end).lower()
+            bases[first + start:first + end] = np.frombuffer(seq,
+                                                             dtype=np.uint8)
+    bases.flush()
+    del bases
+
+    write_index(prefix, contigs)
+
+    return contigs
+
+
+def pack_bases(ref, alt):
+    '''pack a pair of single base strings into a byte'''
+    return (PACK_CODE.get(ref.lower(), 4) << 4) | PACK_CODE.get(alt.lower(), 4)
+
+
+def build_redi_index(infile):
+    '''read a BED format REDIportal table, with the ref base, alt base and
+    strand after the coordinates, from `infile`. Where a site is listed
+    more than once on the same strand the last one is used.
+
+    Returns a :class:`RediIndex`.
+    '''
+
+    keys = []
+    positions = defaultdict(list)
+    bases = defaultdict(list)
+
+    for line in infile:
+        if line.startswith("#") or line.startswith("track"):
+            continue
+        fields = line.rstrip("\n").split("\t")
+        key = fields[0] + fields[5]
+        if key not in positions:
+            keys.append(key)
+        positions[key].append(int(fields[1]))
+        bases[key].append(pack_bases(fields[3], fields[4]))
+
+    contig_arrays = []
+    for key in sorted(keys):
+        pos = np.array(positions.pop(key), dtype=np.int64)
+        packed = np.array(bases.pop(key), dtype=np.uint8)
+        order = np.argsort(pos, kind="mergesort")
+        pos, packed = pos[order], packed[order]
+        last = np.append(pos[1:] != pos[:-1], True)
+        contig_arrays.append((key, {"positions": pos[last],
+                                    "bases": packed[last]}))
+
+    contigs, arrays = concatenate_contigs(contig_arrays, RediIndex.names)
+    arrays["positions"] = arrays["positions"].astype(np.int64)
+    arrays["bases"] = arrays["bases"].astype(np.uint8)
+
+    return RediIndex(contigs, arrays)
+
+
+def find_donor(samples, bampath, samplepattern):
+    '''find the sample in `samples` that matches the donor name extracted
+    from `bampath` using `samplepattern`'''
+
+    donorfrombam = re.search(r"%s" % (samplepattern), bampath).group(1)
+
+    donorid = None
+    for samp in samples:
+        if donorfrombam in samp:
+            donorid = samp
+
+    if donorid is None:
+        raise ValueError("Donor %s not found in VCF" % donorfrombam)
+
+    return donorid
+
+
+def genotype_string(sample):
+    '''return the GT field of a pysam VariantRecordSample as it is written
+    in the VCF, eg 0/1, 1|1 or ./.'''
+
+    alleles = ["." if allele is None else str(allele)
+               for allele in sample["GT"]]
+
+    return ("|" if sample.phased else "/").join(alleles)
+
+
+def build_variant_index(vcfpath, donorid, regions=None):
+    '''read the sites where `donorid` isn't called 0/0 from the VCF file
+    at `vcfpath`. Only the donor's genotypes are decoded. If `regions`, a
+    list of (contig, start, end) tuples grouped by contig, is given only
+    the sites in them are read, using the VCF's index.
+
+    As when the genotypes were read with PyVCF, anything other than an
+    unphased 0/0 call (including missing calls) is kept. Where a position
+    has more than one record the last one is used.
+
+    Returns a :class:`VariantIndex`.
+    '''
+
+    vcffile = pysam.VariantFile(vcfpath)
+    vcffile.subset_samples([donorid])
+
+    contig_arrays = []
+    positions, alts = [], []
+    current = None
+
+    def _add_contig():
+        pos = np.array(positions, dtype=np.int64)
+        alt = np.array(alts, dtype=np.uint8)
+        order = np.argsort(pos, kind="mergesort")
+        pos, alt = pos[order], alt[order]
+        if len(pos):
+            last = np.append(pos[1:] != pos[:-1], True)
+            pos, alt = pos[last], alt[last]
+        contig_arrays.append((current, {"positions": pos, "alts": alt}))
+
+    if regions is None:
+        records = vcffile
+    else:
+        records = fetch_regions(vcffile, vcffile.header.contigs, regions)
+
+    for record in records:
+        if record.contig != current:
+            if current is not None:
+                _add_contig()
+            current = record.contig
+            positions, alts = [], []
+
+        if genotype_string(record.samples[donorid]) == "0/0":
+            continue
+
+        positions.append(record.pos - 1)
+        if record.alts and len(record.alts[0]) == 1:
+            alts.append(ord(record.alts[0].lower()))
+        else:
+            alts.append(0)
+
+    if current is not None:
+        _add_contig()
+
+    contigs, arrays = concatenate_contigs(contig_arrays,
+                                          VariantIndex.names)
+    arrays["positions"] = arrays["positions"].astype(np.int64)
+    arrays["alts"] = arrays["alts"].astype(np.uint8)
+
+    return VariantIndex(contigs, arrays)
@@ -0,0 +1,171 @@
+'''
+MismatchTallies.py - sparse per-position mismatch tallies
+==========================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+A tally file lists, for every genomic position and strand where at least
+one mismatch was seen, the reference base, the mismatched read base, the
+number of high and low quality mismatches, the depth (bases counted at
+the position) and the number of samples contributing.
+
+Files start with an 8 byte magic string, the length of a JSON header as a
+little endian 32 bit integer, and the header itself, which holds the
+contig names and any metadata. Fixed size records follow (see
+:data:`TALLY_DTYPE`), sorted by contig, position, strand and read base.
+Contigs are stored as their index in the header, which is the order of
+the references in the BAM file the tallies came from.
+
+Because the records are sorted, any number of tally files can be merged
+with a streaming k-way merge (:func:`merge_tallies`) that reads each file
+a chunk at a time.
+
+'''
+
+import json
+import struct
+import numpy as np
+
+MAGIC = "MMTALLY\x01"
+
+# bases and strands are held as ascii codes
+TALLY_DTYPE = np.dtype([("contig", "<u4"),
+                        ("position", "<u4"),
+                        ("strand", "u1"),
+                        ("ref", "u1"),
+                        ("alt", "u1"),
+                        ("high_quality", "<u4"),
+                        ("low_quality", "<u4"),
+                        ("depth", "<u4"),
+                        ("samples", "<u4")])
+
+COUNT_FIELDS = ["high_quality", "low_quality", "depth", "samples"]
+
+
+def tally_keys(records):
+    '''return an int64 sort key for each of `records` that orders them by
+    contig, position, strand and read base'''
+
+    return (((records["contig"].astype(np.int64) << 32 |
+              records["position"].astype(np.int64)) << 1 |
+             (records["strand"] == ord("-"))) << 8 |
+            records["alt"].astype(np.int64))
+
+
+def sort_tallies(records, combine="sum"):
+    '''sort `records` and collapse those with the same key. With `combine`
+    "sum" the counts of duplicates are added up; with "first" the first
+    record for each key is kept.'''
+
+    keys = tally_keys(records)
+    order = np.argsort(keys, kind="mergesort")
+    keys, records = keys[order], records[order]
+    if len(records) == 0:
+        return records
+
+    starts = np.flatnonzero(np.append(True, keys[1:] != keys[:-1]))
+    merged = records[starts]
+    if combine == "sum":
+        for field in COUNT_FIELDS:
+            merged[field] = np.add.reduceat(
+                records[field].astype(np.int64), starts)
+
+    return merged
+
+
+def write_header(outf, contigs, **metadata):
+    '''write the header of a tally file listing `contigs` to `outf`'''
+
+    header = dict(metadata)
+    header["contigs"] = list(contigs)
+    header = json.dumps(header)
+    outf.write(MAGIC)
+    outf.write(struct.pack("<I", len(header)))
+    outf.write(header)
+
+
+def write_tallies(path, contigs, records, **metadata):
+    '''write sorted `records` to a tally file at `path`'''
+
+    with open(path, "wb") as outf:
+        write_header(outf, contigs, **metadata)
+        records.tofile(outf)
+
+
+class TallyReader(object):
+    '''read a tally file a chunk of records at a time.
+
+    The header is read on opening, and is available as :attr:`header`,
+    with the contig names in :attr:`contigs`.
+    '''
+
+    def __init__(self, path):
+
+        self.path = path
+        self.infile = open(path, "rb")
+        if self.infile.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a mismatch tally file" % path)
+        length = struct.unpack("<I", self.infile.read(4))[0]
+        self.header = json.loads(self.infile.read(length))
+        self.contigs = self.header["contigs"]
+        self.records_read = 0
+
+    def read(self, nrecords=-1):
+        '''return the next `nrecords` records, or all the rest if
+        `nrecords` is -1. Returns an empty array at the end of the
+        file.'''
+
+        records = np.fromfile(self.infile, dtype=TALLY_DTYPE, count=nrecords)
+        self.records_read += len(records)
+        return records
+
+    def close(self):
+        self.infile.close()
+
+
+def merge_tallies(readers, outf, chunk_size=1000000):
+    '''merge the sorted records of `readers` into the open file `outf`,
+    adding up records with the same key. Each reader is read
+    `chunk_size` records at a time.
+
+    Records are only written once every file has been read past them, so
+    at most about `chunk_size` records per file are held in memory.
+
+    Returns the number of records written.
+    '''
+
+    buffers = [reader.read(chunk_size) for reader in readers]
+    done = [len(buf) < chunk_size for buf in buffers]
+    nwritten = 0
+
+    while any(len(buf) for buf in buffers):
+
+        # every record with a key up to the smallest last key among the
+        # files that still have records to read is complete
+        limits = [tally_keys(buf[-1:])[0]
+                  for buf, finished in zip(buffers, done)
+                  if not finished and len(buf)]
+        ready = []
+        for i, buf in enumerate(buffers):
+            if limits:
+                cut = np.searchsorted(tally_keys(buf), min(limits),
+                                      side="right")
+            else:
+                cut = len(buf)
+            ready.append(buf[:cut])
+            buffers[i] = buf[cut:]
+
+        merged = sort_tallies(np.concatenate(ready))
+        merged.tofile(outf)
+        nwritten += len(merged)
+
+        for i, reader in enumerate(readers):
+            if not done[i] and len(buffers[i]) < chunk_size:
+                more = reader.read(chunk_size)
+                done[i] = len(more) < chunk_size
+                buffers[i] = np.concatenate([buffers[i], more])
+
+    return nwritten
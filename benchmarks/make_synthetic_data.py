@@ -0,0 +1,413 @@
+'''
+make_synthetic_data.py - make reproducible inputs for benchmarking
+===================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Write a small synthetic data set with everything count_mismatches.py and
+the filter scripts need, so that they can be benchmarked without real
+data:
+
+* ``genome.fa`` (with a samtools index) and the CGAT indexed fasta
+  ``genome.fasta``/``genome.idx``. Each contig has a run of Ns and a soft
+  masked stretch.
+* ``genes.gtf``: multi-exon genes along each contig, some with a second
+  gene overlapping their first exon on either strand.
+* ``variants.vcf.gz`` (tabix indexed) and the uncompressed
+  ``variants.vcf``: SNPs with genotypes for three donors, including
+  missing and phased calls. Contigs are named Ensembl style (1, MT) to
+  exercise the contig aliasing.
+* ``redi.bed.gz``: A>G editing sites on the + strand and T>C on the -.
+* ``<donor>.bam``: sorted and indexed reads with MD, NH and NM (or nM)
+  tags. Reads have soft clips, insertions, deletions, splices, sequencing
+  errors, Ns, alt alleles at SNPs and edited bases at editing sites, and a
+  share are duplicates, multi-mappers or have an unmapped mate. A fraction
+  of the reads (``--deep-fraction``) all come from the first gene, to make
+  one very deep gene.
+
+The same ``--seed`` always gives the same files.
+
+Usage
+-----
+
+Example::
+
+   python make_synthetic_data.py --reads=100000 --output-dir=bench.dir/100000
+
+Type::
+
+   python make_synthetic_data.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import sys
+import gzip
+import random
+import pysam
+from CGAT import Experiment as E
+from CGAT import FastaIterator
+from CGAT import IndexedFasta
+
+CONTIGS = [("chr1", 120000), ("chr2", 60000), ("chrM", 16000)]
+DONORS = ["GTEX-AAA1-0001", "GTEX-BBB2-0001", "GTEX-CCC3-0001"]
+COMPLEMENT = {"A": "T", "C": "G", "G": "C", "T": "A", "N": "N"}
+
+
+def ensembl_name(contig):
+    '''return the Ensembl style name of a UCSC style contig name'''
+    return contig.replace("chrM", "MT").replace("chr", "")
+
+
+def make_genome(rnd, contigs):
+    '''return a dictionary of random sequences for `contigs`, a list of
+    (name, length) tuples'''
+
+    genome = {}
+    for contig, length in contigs:
+        seq = [rnd.choice("ACGT") for i in range(length)]
+        for i in range(5000, 5050):
+            seq[i] = "N"
+        for i in range(9000, 9400):
+            seq[i] = seq[i].lower()
+        genome[contig] = "".join(seq)
+
+    return genome
+
+
+def make_genes(rnd, contigs):
+    '''return a list of (gene_id, contig, strand, exons) tuples'''
+
+    genes = []
+    for contig, length in contigs:
+        pos = 1000
+        while pos < length - 8000:
+            exons = []
+            start = pos
+            for exon in range(rnd.randint(1, 4)):
+                end = start + rnd.randint(100, 800)
+                exons.append((start, end))
+                start = end + rnd.randint(200, 1500)
+            genes.append(["ENSG%05i" % (len(genes) + 1), contig,
+                          rnd.choice("+-"), exons])
+
+            # overlapping genes, on the same or the opposite strand
+            if rnd.random() < 0.3:
+                first = exons[0][0] + rnd.randint(0, 300)
+                genes.append(["ENSG%05i" % (len(genes) + 1), contig,
+                              rnd.choice("+-"),
+                              [(first, first + rnd.randint(200, 900))]])
+            pos = start + rnd.randint(-500, 3000)
+
+    return genes
+
+
+def make_sites(rnd, genome, contigs):
+    '''return dictionaries of SNP alt bases and of editing site (ref, alt,
+    strand) tuples keyed by (contig, position)'''
+
+    snps = {}
+    edits = {}
+    for contig, length in contigs:
+        seq = genome[contig]
+        for i in sorted(rnd.sample(range(100, length - 100), length // 400)):
+            if seq[i].upper() != "N":
+                snps[(contig, i)] = rnd.choice(
+                    [b for b in "ACGT" if b != seq[i].upper()])
+        for i in sorted(rnd.sample(range(100, length - 100), length // 300)):
+            if seq[i].upper() == "A":
+                edits[(contig, i)] = ("A", "G", "+")
+            elif seq[i].upper() == "T":
+                edits[(contig, i)] = ("T", "C", "-")
+
+    return snps, edits
+
+
+def make_read(rnd, genome, gene, snps, edits, read_length=76):
+    '''simulate a read from `gene`. Returns the start, cigar, sequence, MD
+    tag and edit distance of the read, or None if it had to be
+    abandoned.'''
+
+    contig, exons = gene[1], gene[3]
+    seq = genome[contig]
+    exon = rnd.randrange(len(exons))
+    start = max(rnd.randint(exons[exon][0] - 50, exons[exon][1] - 1), 0)
+
+    cigar, bases, md_ops = [], [], []
+    qpos, rpos, matched = 0, start, 0
+
+    if rnd.random() < 0.1:
+        clip = rnd.randint(1, 5)
+        cigar.append((4, clip))
+        bases.extend(rnd.choice("ACGT") for i in range(clip))
+        qpos += clip
+
+    while qpos < read_length:
+        if matched and rnd.random() < 0.02:
+            length = min(rnd.randint(1, 3), read_length - qpos)
+            cigar.extend([(0, matched), (1, length)])
+            matched = 0
+            bases.extend(rnd.choice("ACGT") for i in range(length))
+            qpos += length
+            continue
+
+        if matched and rnd.random() < 0.02:
+            length = rnd.randint(1, 3)
+            cigar.extend([(0, matched), (2, length)])
+            matched = 0
+            md_ops.append(("D", seq[rpos:rpos + length].upper()))
+            rpos += length
+            continue
+
+        if (exon + 1 < len(exons) and rpos == exons[exon][1] and
+                rnd.random() < 0.8):
+            if matched:
+                cigar.append((0, matched))
+                matched = 0
+            cigar.append((3, exons[exon + 1][0] - rpos))
+            rpos = exons[exon + 1][0]
+            exon += 1
+            continue
+
+        if rpos >= len(seq):
+            break
+
+        ref = seq[rpos].upper()
+        base = ref
+        chance = rnd.random()
+        if (contig, rpos) in snps and rnd.random() < 0.5:
+            base = snps[(contig, rpos)]
+        elif (contig, rpos) in edits and rnd.random() < 0.5:
+            base = edits[(contig, rpos)][1]
+        elif chance < 0.01:
+            base = rnd.choice([b for b in "ACGT" if b != ref])
+        elif chance < 0.012:
+            base = "N"
+        elif ref == "N":
+            base = rnd.choice("ACGT")
+
+        bases.append(base)
+        md_ops.append(("M", (base, ref)))
+        matched += 1
+        qpos += 1
+        rpos += 1
+
+    if not matched:
+        return None
+    cigar.append((0, matched))
+
+    md = ""
+    run = 0
+    for op, value in md_ops:
+        if op == "M" and value[0] == value[1]:
+            run += 1
+        elif op == "M":
+            md += "%i%s" % (run, value[1])
+            run = 0
+        else:
+            md += "%i^%s" % (run, value)
+            run = 0
+    md += str(run)
+
+    distance = sum(1 for op, value in md_ops
+                   if op == "M" and value[0] != value[1]) + \
+        sum(length for op, length in cigar if op in (1, 2))
+
+    return start, cigar, "".join(bases), md, distance
+
+
+def write_fasta(outdir, genome, contigs):
+    '''write the genome as a plain fasta file with a samtools index and as
+    a CGAT indexed fasta file'''
+
+    fasta = os.path.join(outdir, "genome.fa")
+    with open(fasta, "w") as outf:
+        for contig, length in contigs:
+            outf.write(">%s\n" % contig)
+            for i in range(0, length, 60):
+                outf.write(genome[contig][i:i + 60] + "\n")
+    pysam.faidx(fasta)
+
+    IndexedFasta.createDatabase(os.path.join(outdir, "genome"),
+                                FastaIterator.iterate(open(fasta)))
+
+
+def write_gtf(outdir, genes):
+    with open(os.path.join(outdir, "genes.gtf"), "w") as outf:
+        for gene_id, contig, strand, exons in genes:
+            for start, end in exons:
+                outf.write("\t".join(
+                    [contig, "protein_coding", "exon", str(start + 1),
+                     str(end), ".", strand, ".",
+                     'gene_id "%s"; transcript_id "%s.1";' % (gene_id,
+                                                              gene_id)]) +
+                    "\n")
+
+
+def write_vcf(outdir, rnd, genome, contigs, snps):
+    '''write the SNPs with random genotypes for each donor, both plain and
+    bgzipped with a tabix index'''
+
+    order = dict((contig, n) for n, (contig, length) in enumerate(contigs))
+    vcf = os.path.join(outdir, "variants.vcf")
+    with open(vcf, "w") as outf:
+        outf.write("##fileformat=VCFv4.1\n")
+        for contig, length in contigs:
+            outf.write("##contig=<ID=%s,length=%i>\n" %
+                       (ensembl_name(contig), length))
+        outf.write('##FORMAT=<ID=GT,Number=1,Type=String,'
+                   'Description="Genotype">\n')
+        outf.write("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL",
+                              "FILTER", "INFO", "FORMAT"] + DONORS) + "\n")
+        for (contig, pos), alt in sorted(
+                snps.items(), key=lambda x: (order[x[0][0]], x[0][1])):
+            genotypes = [rnd.choice(["0/0", "0/1", "1/1", "./.", "0|1"])
+                         for donor in DONORS]
+            outf.write("\t".join(
+                [ensembl_name(contig), str(pos + 1), ".",
+                 genome[contig][pos].upper(), alt, "50", "PASS", ".", "GT"] +
+                genotypes) + "\n")
+
+    pysam.tabix_compress(vcf, vcf + ".gz", force=True)
+    pysam.tabix_index(vcf + ".gz", preset="vcf", force=True)
+
+
+def write_redi(outdir, edits):
+    with gzip.open(os.path.join(outdir, "redi.bed.gz"), "w") as outf:
+        for (contig, pos), (ref, alt, strand) in sorted(edits.items()):
+            outf.write("\t".join([contig, str(pos), str(pos + 1), ref, alt,
+                                  strand]) + "\n")
+
+
+def write_bam(outdir, rnd, genome, contigs, genes, snps, edits, nreads,
+              deep_fraction):
+    '''simulate `nreads` reads and write them to a sorted, indexed BAM file
+    named after the first donor. Returns the path of the BAM file.'''
+
+    header = {"HD": {"VN": "1.0", "SO": "unsorted"},
+              "SQ": [{"SN": contig, "LN": length}
+                     for contig, length in contigs]}
+    tids = dict((contig, n) for n, (contig, length) in enumerate(contigs))
+
+    unsorted = os.path.join(outdir, "unsorted.bam")
+    outf = pysam.AlignmentFile(unsorted, "wb", header=header)
+    for n in range(nreads):
+        if rnd.random() < deep_fraction:
+            gene = genes[0]
+        else:
+            gene = rnd.choice(genes)
+
+        read = make_read(rnd, genome, gene, snps, edits)
+        if read is None:
+            continue
+        start, cigar, bases, md, distance = read
+
+        segment = pysam.AlignedSegment()
+        segment.query_name = "read%i" % n
+        segment.query_sequence = bases
+        segment.reference_id = tids[gene[1]]
+        segment.reference_start = start
+        segment.cigartuples = cigar
+        segment.mapping_quality = 60
+        segment.query_qualities = pysam.qualitystring_to_array(
+            "".join(chr(33 + rnd.randint(2, 40)) for base in bases))
+
+        flag = 0
+        if rnd.random() < 0.5:
+            flag |= 16
+        if rnd.random() < 0.3:
+            flag |= 1 | 64
+            if rnd.random() < 0.1:
+                flag |= 8
+        if rnd.random() < 0.05:
+            flag |= 1024
+        segment.flag = flag
+
+        tags = [("MD", md), ("NH", 2 if rnd.random() < 0.05 else 1)]
+        if rnd.random() < 0.9:
+            tags.append(("NM", distance))
+        else:
+            tags.append(("nM", distance))
+        segment.tags = tags
+        outf.write(segment)
+    outf.close()
+
+    bam = os.path.join(outdir, "%s.bam" % DONORS[0])
+    pysam.sort("-o", bam, unsorted)
+    os.unlink(unsorted)
+    pysam.index(bam)
+
+    return bam
+
+
+def make_data(outdir, nreads, seed=1, genome_scale=1, deep_fraction=0.3):
+    '''write a complete synthetic data set to `outdir`'''
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    rnd = random.Random(seed)
+    contigs = [(contig, length * genome_scale) for contig, length in CONTIGS]
+    genome = make_genome(rnd, contigs)
+    genes = make_genes(rnd, contigs)
+    snps, edits = make_sites(rnd, genome, contigs)
+
+    write_fasta(outdir, genome, contigs)
+    write_gtf(outdir, genes)
+    write_vcf(outdir, rnd, genome, contigs, snps)
+    write_redi(outdir, edits)
+    write_bam(outdir, rnd, genome, contigs, genes, snps, edits, nreads,
+              deep_fraction)
+
+    return len(genes)
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--output-dir", dest="output_dir", type="string",
+                      help="directory to write the data set to")
+    parser.add_option("--reads", dest="reads", type="int", default=20000,
+                      help="number of reads to simulate")
+    parser.add_option("--seed", dest="seed", type="int", default=1,
+                      help="random seed")
+    parser.add_option("--genome-scale", dest="genome_scale", type="int",
+                      default=1,
+                      help="multiply the length of every contig (and so "
+                      "the number of genes) by this")
+    parser.add_option("--deep-fraction", dest="deep_fraction",
+                      type="float", default=0.3,
+                      help="fraction of the reads that come from the first "
+                      "gene")
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    ngenes = make_data(options.output_dir, options.reads, options.seed,
+                       options.genome_scale, options.deep_fraction)
+    E.info("wrote %i genes and %i reads to %s" %
+           (ngenes, options.reads, options.output_dir))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,295 @@
+'''
+run_benchmarks.py - time the mismatch counting scripts on synthetic data
+=========================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Make synthetic data sets of several sizes with make_synthetic_data.py
+(they are kept in ``--work-dir`` and reused), then run count_mismatches.py
+with each number of workers and each counting mode, and the index and
+filter scripts, on each of them. Every run is a separate process, timed
+from start to exit, and its peak resident memory (of the largest process,
+so of the busiest worker when there are several) is taken from the
+kernel.
+
+Results are appended to ``--results`` as a table with one row per run:
+
+label
+   name for this set of runs, by default the current git revision
+benchmark
+   script (and for count_mismatches.py the mode: gene or sweep)
+reads
+   size of the data set
+workers
+   number of worker processes
+seconds
+   wall time
+reads_per_second
+   reads decoded per second, from the count_mismatches.py stats, or
+   simulated reads per second for the other scripts
+peak_rss_mb
+   peak resident memory
+
+Runs from different revisions can then be compared row by row. Given
+``--baseline``, the label of earlier runs in the results file, the change
+in time, reads per second and memory against that baseline is written to
+stdout.
+
+mtfilter_vcf.py is not benchmarked, as it does not run.
+
+Usage
+-----
+
+Example::
+
+   python run_benchmarks.py --sizes=20000,200000 --workers=1,4
+      --results=benchmarks.tsv --baseline=a1b2c3d
+
+Type::
+
+   python run_benchmarks.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import sys
+import json
+import time
+import subprocess
+from CGAT import Experiment as E
+import make_synthetic_data
+
+SRCDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COLUMNS = ["label", "benchmark", "reads", "workers", "seconds",
+           "reads_per_second", "peak_rss_mb"]
+
+
+def git_label():
+    '''return the current git revision of the source tree'''
+
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=SRCDIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def timed_run(statement, logfile):
+    '''run `statement` in a new process, with its stderr sent to
+    `logfile`. Returns the wall time in seconds and the peak resident
+    memory in MB.'''
+
+    with open(logfile, "w") as log:
+        start = time.time()
+        process = subprocess.Popen(statement, stderr=log,
+                                   cwd=os.path.dirname(logfile))
+        pid, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - start
+
+    if status != 0:
+        raise OSError("%s failed, see %s" % (statement[1], logfile))
+
+    # ru_maxrss is in kB on linux
+    return seconds, usage.ru_maxrss / 1024.0
+
+
+def script(name):
+    return [sys.executable, os.path.join(SRCDIR, name)]
+
+
+def count_statement(datadir, outdir, workers, mode):
+    '''the count_mismatches.py command line for a benchmark run'''
+
+    statement = script("count_mismatches.py") + [
+        "-I", os.path.join(datadir, "genes.gtf"),
+        "--bamfile=%s" % os.path.join(
+            datadir, "%s.bam" % make_synthetic_data.DONORS[0]),
+        "--fasta-path=%s" % os.path.join(datadir, "genome"),
+        "--vcf-path=%s" % os.path.join(datadir, "variants.vcf.gz"),
+        "--REDI-path=%s" % os.path.join(datadir, "redi.bed.gz"),
+        "--sample=([^/]+)-0001.bam",
+        "--workers=%i" % workers,
+        "--stats-path=%s" % os.path.join(outdir, "count.stats.json"),
+        "-S", os.path.join(outdir, "count.tsv")]
+
+    if mode == "sweep":
+        statement.append("--sweep")
+
+    return statement
+
+
+def filter_statements(datadir, outdir):
+    '''the command lines of the index and filter scripts, as a list of
+    (benchmark, statement) tuples'''
+
+    return [
+        ("index_variants.py", script("index_variants.py") + [
+            "--vcf-path=%s" % os.path.join(datadir, "variants.vcf.gz"),
+            "--bamfile=%s" % os.path.join(
+                datadir, "%s.bam" % make_synthetic_data.DONORS[0]),
+            "--sample=([^/]+)-0001.bam",
+            "--index-prefix=%s" % os.path.join(outdir, "variants"),
+            "-S", os.path.join(outdir, "variants.tsv")]),
+        ("index_redi.py", script("index_redi.py") + [
+            "-I", os.path.join(datadir, "redi.bed.gz"),
+            "--index-prefix=%s" % os.path.join(outdir, "redi"),
+            "-S", os.path.join(outdir, "redi.tsv")]),
+        ("index_genome.py", script("index_genome.py") + [
+            "--fasta-path=%s" % os.path.join(datadir, "genome"),
+            "--index-prefix=%s" % os.path.join(outdir, "genome"),
+            "-S", os.path.join(outdir, "genome.tsv")]),
+        ("VCF_RNA_edit_filter.py", script("VCF_RNA_edit_filter.py") + [
+            "--vcf-path=%s" % os.path.join(datadir, "variants.vcf"),
+            "-S", os.path.join(outdir, "filtered.tsv")])]
+
+
+def read_results(path):
+    '''read the rows of a results file as dictionaries'''
+
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as inf:
+        header = inf.readline().rstrip("\n").split("\t")
+        return [dict(zip(header, line.rstrip("\n").split("\t")))
+                for line in inf]
+
+
+def compare(results, baseline, outfile):
+    '''write the change in each measure of `results` against the rows of
+    `baseline` for the same benchmark, size and workers'''
+
+    key = lambda row: (row["benchmark"], str(row["reads"]),
+                       str(row["workers"]))
+    before = dict((key(row), row) for row in baseline)
+
+    outfile.write("benchmark\treads\tworkers\tseconds_ratio\t"
+                  "reads_per_second_ratio\tpeak_rss_ratio\n")
+    for row in results:
+        if key(row) not in before:
+            continue
+        ratios = [float(row[column]) / float(before[key(row)][column])
+                  if float(before[key(row)][column]) else float("nan")
+                  for column in ["seconds", "reads_per_second",
+                                 "peak_rss_mb"]]
+        outfile.write("%s\t%s\t%s\t%s\n" % (
+            row["benchmark"], row["reads"], row["workers"],
+            "\t".join("%.3f" % ratio for ratio in ratios)))
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--work-dir", dest="work_dir", type="string",
+                      default="benchmarks.dir",
+                      help="directory for the data sets and outputs")
+    parser.add_option("--sizes", dest="sizes", type="string",
+                      default="20000,100000",
+                      help="comma separated numbers of reads to simulate")
+    parser.add_option("--workers", dest="workers", type="string",
+                      default="1,4",
+                      help="comma separated numbers of worker processes")
+    parser.add_option("--modes", dest="modes", type="string",
+                      default="gene,sweep",
+                      help="comma separated counting modes: gene to fetch "
+                      "reads gene by gene, sweep for --sweep")
+    parser.add_option("--seed", dest="seed", type="int", default=1,
+                      help="random seed for the data sets")
+    parser.add_option("--no-filters", dest="filters", action="store_false",
+                      default=True,
+                      help="only benchmark count_mismatches.py")
+    parser.add_option("--label", dest="label", type="string",
+                      help="label for this set of runs [git revision]")
+    parser.add_option("--results", dest="results", type="string",
+                      default="benchmarks.tsv",
+                      help="table to append the results to")
+    parser.add_option("--baseline", dest="baseline", type="string",
+                      help="label of earlier runs in the results table to "
+                      "compare with")
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    label = options.label or git_label()
+    results = []
+
+    for size in map(int, options.sizes.split(",")):
+        datadir = os.path.abspath(
+            os.path.join(options.work_dir, "data_%i_%i" % (size,
+                                                           options.seed)))
+        if not os.path.exists(os.path.join(datadir, "genes.gtf")):
+            E.info("making data set with %i reads in %s" % (size, datadir))
+            make_synthetic_data.make_data(datadir, size, options.seed)
+
+        outdir = os.path.join(datadir, "runs")
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+
+        for mode in options.modes.split(","):
+            for workers in map(int, options.workers.split(",")):
+                benchmark = "count_mismatches.py:%s" % mode
+                seconds, rss = timed_run(
+                    count_statement(datadir, outdir, workers, mode),
+                    os.path.join(outdir, "count.log"))
+                with open(os.path.join(outdir, "count.stats.json")) as inf:
+                    reads = json.load(inf)["reads"]
+                results.append({"label": label, "benchmark": benchmark,
+                                "reads": size, "workers": workers,
+                                "seconds": seconds,
+                                "reads_per_second": reads / seconds,
+                                "peak_rss_mb": rss})
+                E.info("%s with %i reads and %i workers: %.2fs" %
+                       (benchmark, size, workers, seconds))
+
+        if options.filters:
+            for benchmark, statement in filter_statements(datadir, outdir):
+                seconds, rss = timed_run(
+                    statement,
+                    os.path.join(outdir, benchmark + ".log"))
+                results.append({"label": label, "benchmark": benchmark,
+                                "reads": size, "workers": 1,
+                                "seconds": seconds,
+                                "reads_per_second": size / seconds,
+                                "peak_rss_mb": rss})
+                E.info("%s with %i reads: %.2fs" %
+                       (benchmark, size, seconds))
+
+    baseline = [row for row in read_results(options.results)
+                if row["label"] == options.baseline]
+
+    new_file = not os.path.exists(options.results)
+    with open(options.results, "a") as outf:
+        if new_file:
+            outf.write("\t".join(COLUMNS) + "\n")
+        for row in results:
+            outf.write("%s\t%s\t%i\t%i\t%.3f\t%.1f\t%.1f\n" % tuple(
+                row[column] for column in COLUMNS))
+
+    if options.baseline:
+        compare(results, baseline, options.stdout)
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
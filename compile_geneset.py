@@ -0,0 +1,100 @@
+'''
+compile_geneset.py - compile a GTF geneset into a gene model index
+===================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Parse a GTF geneset once and save the gene models as a memory-mapped
+index (see MismatchIndex.GeneIndex): the id, contig, strand and span of
+each gene (over all of its records) and its merged exon intervals (from
+its ``exon`` records only), as flat arrays, indexed by
+contig and by gene id. count_mismatches.py loads the index
+(``--gene-index``) in a fraction of the time it takes to parse the GTF
+file, and every sample counted against the geneset shares it.
+
+The genes keep the order of the GTF file, so counts made from the index
+are in the same order as counts made from the GTF file.
+
+A summary of the number of genes and exons on each contig goes to
+stdout.
+
+Usage
+-----
+
+Example::
+
+   python compile_geneset.py -I geneset_all.gtf.gz
+      --index-prefix=geneset_all.genes
+
+Type::
+
+   python compile_geneset.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+from CGAT import Experiment as E
+from CGAT import GTF
+import MismatchIndex
+
+
+def iterate_gene_models(infile):
+    '''iterate over the genes in a GTF file, yielding a tuple of
+    (gene_id, contig, strand, start, end, exons) for each. The span is
+    that of all of the gene's records, as in count_mismatches.py, and
+    exons is a list of the (start, end) tuples of its exon records
+    only.'''
+
+    for gene in GTF.flat_gene_iterator(GTF.iterator(infile)):
+        yield (gene[0].gene_id,
+               gene[0].contig,
+               gene[0].strand,
+               min(e.start for e in gene),
+               max(e.end for e in gene),
+               [(e.start, e.end) for e in gene if e.feature == "exon"])
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-x", "--index-prefix", dest="prefix", type="string",
+                      help="prefix for the index files")
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    genes = MismatchIndex.build_gene_index(
+        iterate_gene_models(options.stdin))
+    genes.save(options.prefix)
+
+    exon_firsts = genes.arrays["exon_firsts"]
+    exon_lasts = genes.arrays["exon_lasts"]
+    options.stdout.write("contig\tgenes\texons\n")
+    for contig, first, last in genes.contig_rows:
+        options.stdout.write("%s\t%i\t%i\n" % (
+            contig, last - first,
+            (exon_lasts[first:last] - exon_firsts[first:last]).sum()))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
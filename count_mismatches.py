@@ -30,24 +30,1791 @@ for command line help.
 Command line options
 --------------------
 
+Genes are read from a GTF file on stdin, or from gene models compiled
+from it by compile_geneset.py (``--gene-index``), which load in a
+fraction of the time.
+
+Bases are counted across the whole span of each gene, from its first to
+its last exon. With ``--exons-only`` only bases in the gene's exons (taken
+from ``--gene-index``) are counted. Reads with no aligned block in an
+exon are dropped as soon as their CIGAR is read, before any of their
+bases are decoded, so intronic and pre-mRNA reads of long genes cost
+little.
+
+The donor's variants are read from an index made by index_variants.py
+(``--variant-index``). If there isn't one, they are extracted from the
+VCF given with ``--vcf-path`` at startup, using ``--sample`` to find the
+donor. Likewise RNA editing sites come from an index made by
+index_redi.py (``--REDI-index``) or are read from ``--REDI-path``, and
+gene sequences are sliced from a memory-mapped genome made by
+index_genome.py (``--genome-index``) or read from ``--fasta-path``.
+
+``--workers`` splits the gene stream into shards of consecutive genes on
+the same contig (at most ``--shard-size`` genes each) and counts them in a
+pool of worker processes. Every worker opens its own BAM and fasta
+handles. Rows are written in the same order as a serial run.
+
+``--prefetch`` fetches the inputs for the next genes (their reads,
+reference sequence, variants and RNA editing sites) and decodes their
+reads in a background thread while the current gene is counted. With
+``--sweep`` the background thread streams the reads. pysam releases the
+GIL while it reads and decompresses the BAM file, so reading overlaps
+with counting, which helps most on slow shared filesystems. The
+thread is never more than ``--prefetch`` genes (or chunks of reads)
+ahead, which bounds the memory used.
+
+``--genes`` and ``--regions`` restrict counting to the listed genes and
+to genes overlapping the listed regions. The selected genes are merged
+into the spans of clusters of overlapping genes, and only these spans
+are read: the reads with as few fetches as possible (the selected genes
+are always counted with ``--sweep``), and the donor's variants and, if
+the REDIportal table is tabix indexed, the RNA editing sites through the
+files' indexes.
+
+``--manifest`` counts many samples in one run. It is a tab-separated
+table with a header line naming its columns: ``bamfile`` and ``output``
+(a table, compressed if it ends in .gz) or ``npz_path`` are needed for
+each sample, and ``tally_path``, ``stats_path``, ``checkpoint`` and
+``variant_index`` may be given as well. Columns that are missing or
+empty take the value given on the command line. The genes, RNA editing
+sites and reference are loaded once and shared with a pool of
+``--workers`` processes, each counting whole samples, so that the
+startup cost is only paid once. The variants of each donor without a
+variant index are extracted from the VCF once, into a temporary index
+that all of the donor's samples share, and the samples are then counted
+one at a time. A summary of the genes and reads counted in each sample
+goes to stdout.
+
+``--serve`` runs a daemon that loads the genes and RNA editing sites once
+and counts jobs sent to a unix socket by count_mismatches_client.py. A
+job gives a BAM file and any of the quality threshold, indel window,
+variant index (or sample pattern for the VCF), sweep mode, tally and
+stats paths, and can be restricted to a list of genes. The table is
+streamed back to the client. Each job is run in a forked child of the
+daemon. Jobs are quickest with a variant index and a genome index, which
+are memory-mapped rather than read. The daemon runs until it is sent
+SIGTERM or SIGINT.
+
+``--sweep`` reads the genes up front and walks each contig once in
+coordinate order. Each read is decoded once and credited to every gene it
+overlaps, rather than being fetched again for each overlapping gene.
+Shards are then made of whole clusters of overlapping genes.
+
+High quality mismatches within ``--indel-window`` aligned bases of an
+insertion or deletion in the read's CIGAR are not counted, as they are
+most often the result of an indel placed differently by the aligner. Use
+``--indel-window=0`` to count them all.
+
+``--npz-path`` saves the counts as a columnar numpy archive (see
+MismatchCounts.py) with the sample name and counting settings, rather
+than writing a table to stdout. load_mismatch_counts.py loads these into
+the database.
+
+``--tally-path`` also writes a sorted binary table of every position with
+at least one mismatch: strand, reference and read base, high and low
+quality mismatch counts and depth. Tables from many samples can be
+combined with merge_mismatch_tallies.py, so position level questions can
+be answered without going back to the BAM files.
+
+``--checkpoint`` appends the results of each shard of genes, with their
+share of the summary counters, to a journal file as they are finished.
+If the job dies, running it again with ``--resume`` reads the journal
+back and only counts the genes that are missing from it. The journal is
+ignored if it was made from a different BAM file or with different
+settings, and is deleted when the run completes.
+
+Progress is logged every ``--progress-interval`` seconds. ``--stats-path``
+writes a JSON summary of the run: the time spent in each stage (fetching
+and decoding reads, reference sequence, variant and REDI lookups and
+counting; summed over workers), reads and aligned bases per second, the
+slowest genes, the number of reads dropped by each filter and the
+summary counters.
+
 '''
 
 import sys
+import os
+import time
+import json
+import copy
+import heapq
+import shutil
+import tempfile
+import array
+import struct
+import cPickle
+import signal
+import Queue
+import threading
+import SocketServer
+import multiprocessing
+import itertools
+import bisect
 from collections import defaultdict
 from CGAT import Experiment as E
 from CGAT import GTF
 from CGAT import IOTools
 from CGAT.IndexedFasta import IndexedFasta
-import CGAT.Bed as Bed
-import textwrap
+import numpy as np
 import pysam
-import vcf
 import re
+import MismatchIndex
+import MismatchCounts
+import MismatchTallies
+
+HEADER = ["gene_id",
+          "strand",
+          "mismatches",
+          "bases",
+          "low_qual",
+          "a", "t", "c", "g",
+          "a_to_t", "a_to_g", "a_to_c",
+          "t_to_a", "t_to_g", "t_to_c",
+          "g_to_a", "g_to_t", "g_to_c",
+          "c_to_a", "c_to_t", "c_to_g",
+          "indel_count", "RNA_editing_events"]
+
+# global summary counters, reported at the end of the run. Each call
+# to count_gene adds to a dictionary of these so that counts from
+# worker processes can be summed by the parent.
+COUNTERS = ["got_snp_pos", "wrong_base",
+            "got_edit_pos", "wrong_edit_base",
+            "not_reverse_g_to_t", "reverse_g_to_t"]
+
+# stages of counting that are timed, and the filters reads are dropped
+# by. Times and dropped read counts are kept in the counters as
+# time_<stage> and dropped_<filter>.
+STAGES = ["reads", "reference", "variants", "redi", "count"]
+FILTERS = ["unmapped", "duplicate", "mate_unmapped", "multimapped",
+           "intronic"]
+
+TRANSITIONS = HEADER[9:21]
+
+# clusters of genes closer than this are read from the BAM file with a
+# single fetch when sweeping, as streaming the reads in between is
+# cheaper than seeking
+FETCH_GAP = 100000
+
+# reads are handed over from the --prefetch thread in chunks of this many
+# when sweeping
+PREFETCH_CHUNK = 1000
+
+# lookup tables for working on bases held as ascii codes. Bases are
+# coded a=0, c=1, g=2, t=3 and anything else 4.
+BASE_CODE = np.zeros(256, dtype=np.int64) + 4
+for code, base in enumerate("acgt"):
+    BASE_CODE[ord(base)] = BASE_CODE[ord(base.upper())] = code
+
+COMPLEMENT_CODE = np.array([3, 2, 1, 0, 4])
+
+# column of TRANSITIONS for each genome code * 5 + read code, or -1
+TRANSITION_INDEX = np.zeros(25, dtype=np.int64) - 1
+for column, name in enumerate(TRANSITIONS):
+    TRANSITION_INDEX[BASE_CODE[ord(name[0])] * 5 +
+                     BASE_CODE[ord(name[-1])]] = column
+
+MD_TOKEN = re.compile(r"(\d+)|\^([A-Za-z]+)|([A-Za-z])")
+
+# columns of a --manifest and the options they set for their sample
+MANIFEST_COLUMNS = {"bamfile": "bam",
+                    "output": "output",
+                    "npz_path": "npz_path",
+                    "tally_path": "tally_path",
+                    "stats_path": "stats_path",
+                    "checkpoint": "checkpoint",
+                    "variant_index": "variant_index"}
+
+# fields of a job sent to a --serve daemon and the options they set
+JOB_OPTIONS = {"bamfile": "bam",
+               "quality_threshold": "threshold",
+               "indel_window": "indel_window",
+               "variant_index": "variant_index",
+               "sample": "samppattern",
+               "sweep": "sweep",
+               "tally_path": "tally_path",
+               "stats_path": "stats_path"}
+
+# per-process state for worker processes, filled in by _init_worker or
+# _init_manifest_worker
+_worker = {}
+
+
+def iterate_genes(infile):
+    '''iterate over the genes in a GTF file, yielding a tuple of
+    (gene_id, contig, strand, start, end) for each.'''
+
+    for gene in GTF.flat_gene_iterator(GTF.iterator(infile)):
+        yield (gene[0].gene_id,
+               gene[0].contig,
+               gene[0].strand,
+               min(e.start for e in gene),
+               max(e.end for e in gene))
+
+
+def read_gene_ids(value):
+    '''return the set of gene ids in `value`, either a comma separated list
+    or a file with one gene id per line'''
+
+    if os.path.exists(value):
+        return set(line.split()[0] for line in IOTools.openFile(value)
+                   if line.strip() and not line.startswith("#"))
+
+    return set(value.split(","))
+
+
+def parse_regions(value):
+    '''return the regions in `value` as a list of (contig, start, end)
+    tuples. `value` is either a comma separated list of regions written as
+    contig:start-end (1-based, inclusive) or contig, or a BED file. As
+    commas separate the regions, the coordinates can't have thousands
+    separators.'''
+
+    regions = []
+    if os.path.exists(value):
+        for line in IOTools.openFile(value):
+            if line.startswith("#") or line.startswith("track"):
+                continue
+            fields = line.split()
+            if fields:
+                regions.append((fields[0], int(fields[1]), int(fields[2])))
+        return regions
+
+    for region in value.split(","):
+        if ":" in region:
+            contig, span = region.rsplit(":", 1)
+            if not re.match(r"^\d+-\d+$", span):
+                raise ValueError(
+                    "region %s is not contig:start-end, the coordinates "
+                    "can't contain commas" % region)
+            start, end = span.split("-")
+            regions.append((contig, int(start) - 1, int(end)))
+        else:
+            regions.append((region, 0, sys.maxint))
+
+    return regions
+
+
+def select_genes(genes, gene_ids=None, regions=None):
+    '''filter a stream of genes down to those with an id in `gene_ids` or
+    overlapping one of `regions`, from :func:`parse_regions`'''
+
+    by_contig = defaultdict(list)
+    for contig, start, end in regions or []:
+        by_contig[contig].append((start, end))
+
+    for gene in genes:
+        if gene_ids and gene[0] in gene_ids:
+            yield gene
+        elif any(start < gene[4] and end > gene[3]
+                 for start, end in by_contig[gene[1]]):
+            yield gene
+
+
+def merge_regions(genes):
+    '''return the spans of the clusters of overlapping `genes` as a list of
+    (contig, start, end) tuples, grouped by contig and sorted by start, so
+    the genes can be read with as few fetches as possible'''
+
+    contigs = []
+    contig_genes = defaultdict(list)
+    for gene in genes:
+        if gene[1] not in contig_genes:
+            contigs.append(gene[1])
+        contig_genes[gene[1]].append((None, gene))
+
+    regions = []
+    for contig in contigs:
+        contig_genes[contig].sort(key=lambda x: x[1][3])
+        regions.extend((contig, start, end) for start, end, cluster in
+                       cluster_genes(contig_genes[contig]))
+
+    return regions
+
+
+def shard_genes(genes, shard_size):
+    '''split a stream of (index, gene) tuples into lists of consecutive
+    genes on the same contig, each at most `shard_size` long.
+    Concatenating the shards gives back the original order.'''
+
+    shard = []
+    for gene in genes:
+        if shard and (gene[1][1] != shard[-1][1][1] or
+                      len(shard) >= shard_size):
+            yield shard
+            shard = []
+        shard.append(gene)
+
+    if shard:
+        yield shard
+
+
+def open_reference(options):
+    '''open the reference genome, as a dictionary holding either the
+    genome index or the fasta file'''
+
+    if options.genome_index:
+        return {"genome": MismatchIndex.GenomeIndex.load(
+            options.genome_index)}
+
+    return {"fasta": IndexedFasta(options.fastapath)}
+
+
+def open_handles(options, reference=None):
+    '''open the file based inputs for counting. pysam and fasta handles
+    cannot be shared between processes, so each worker calls this
+    itself. An already open `reference`, from :func:`open_reference`, can
+    be given to only open the BAM file.'''
+
+    handles = dict(reference or open_reference(options))
+    handles["bam"] = pysam.AlignmentFile(options.bam)
+    if options.exons_only:
+        handles["genes"] = MismatchIndex.GeneIndex.load(options.gene_index)
+
+    return handles
+
+
+def reference_sequence(handles, contig, start, end):
+    '''return the lower case reference sequence of `contig`:`start`-`end`
+    as a uint8 array of ascii codes. With a genome index this is a view on
+    the memory-mapped genome rather than a copy.'''
+
+    if "genome" in handles:
+        return handles["genome"].fetch(contig, start, end)
+
+    seq = handles["fasta"].getSequence(contig, "+", start, end).lower()
+    return np.frombuffer(seq, dtype=np.uint8)
+
+
+def load_variants(options, regions=None):
+    '''load the donor's variants, either from a prebuilt index or by
+    extracting them from the VCF file. If `regions` are given (see
+    :func:`merge_regions`) only the variants in them are extracted.'''
+
+    if options.variant_index:
+        return MismatchIndex.VariantIndex.load(options.variant_index)
+
+    samples = list(pysam.VariantFile(options.vcfpath).header.samples)
+    donorid = MismatchIndex.find_donor(samples, options.bam,
+                                       options.samppattern)
+
+    return MismatchIndex.build_variant_index(options.vcfpath, donorid,
+                                             regions)
+
+
+def load_redi(options, regions=None):
+    '''load the RNA editing sites, either from a prebuilt index or from
+    the REDIportal table. If `regions` are given and the table is tabix
+    indexed, only the sites in them are read.'''
+
+    if options.redi_index:
+        return MismatchIndex.RediIndex.load(options.redi_index)
+
+    if regions is not None and os.path.exists(options.redipath + ".tbi"):
+        tabix = pysam.TabixFile(options.redipath)
+        return MismatchIndex.build_redi_index(
+            MismatchIndex.fetch_regions(tabix, tabix.contigs, regions))
+
+    return MismatchIndex.build_redi_index(IOTools.openFile(options.redipath))
+
+
+def read_filter(read):
+    '''return the name of the filter in FILTERS that drops `read`, or None
+    if it is kept'''
+
+    if read.is_unmapped:
+        return "unmapped"
+    if read.is_duplicate:
+        return "duplicate"
+    if read.mate_is_unmapped:
+        return "mate_unmapped"
+    if read.get_tag("NH") > 1:
+        return "multimapped"
+    return None
+
+
+def touches_exons(read, starts, ends):
+    '''return whether any aligned block of `read` overlaps one of the
+    sorted, non-overlapping exons with lists of `starts` and `ends`'''
+
+    r = read.reference_start
+    for op, length in read.cigartuples:
+        if op == 0 or op == 7 or op == 8:
+            i = bisect.bisect_right(ends, r)
+            if i < len(starts) and starts[i] < r + length:
+                return True
+            r += length
+        elif op == 2 or op == 3:
+            r += length
+
+    return False
+
+
+def add_read_stats(counters, reads, exons=None):
+    '''add the number of `reads`, which have been through
+    :func:`read_filter`, and of their aligned bases to `counters`, as
+    :meth:`ReadBatch.add_stats` does for the reads of a batch. With
+    `exons`, as given to :class:`ReadBatch`, reads with no aligned block
+    in an exon are counted as dropped instead.'''
+
+    if exons is not None:
+        exon_starts, exon_ends = list(exons[0]), list(exons[1])
+
+    for read in reads:
+        if exons is not None and not touches_exons(read, exon_starts,
+                                                   exon_ends):
+            counters["dropped_intronic"] += 1
+            continue
+        counters["reads"] += 1
+        counters["aligned_bases"] += sum(
+            length for op, length in read.cigartuples
+            if op == 0 or op == 7 or op == 8)
+
+
+def gene_exons(handles, genes):
+    '''return the starts and ends of the exons of `genes`, merged where
+    they overlap, from the gene index in `handles`, or None when whole
+    genes are counted'''
+
+    if "genes" not in handles:
+        return None
+
+    index = handles["genes"]
+    intervals = []
+    for gene in genes:
+        row = index.find(gene[0])
+        if row is None:
+            raise KeyError("gene %s is not in the gene index" % gene[0])
+        starts, ends = index.exons(row)
+        intervals.extend(zip(starts.tolist(), ends.tolist()))
+
+    intervals = MismatchIndex.merge_intervals(intervals)
+    return (np.array([start for start, end in intervals], dtype=np.int64),
+            np.array([end for start, end in intervals], dtype=np.int64))
+
+
+def exon_mask(exons, start, length):
+    '''return a boolean array marking which of the `length` bases from
+    `start` are in `exons`'''
+
+    change = np.zeros(length + 1, dtype=np.int64)
+    np.add.at(change, np.clip(exons[0] - start, 0, length), 1)
+    np.add.at(change, np.clip(exons[1] - start, 0, length), -1)
+
+    return np.cumsum(change[:-1]) > 0
+
+
+def add_time(counters, stage, since):
+    '''add the time since `since` to the timer for `stage` in `counters`.
+    Returns the current time.'''
+
+    now = time.time()
+    counters["time_" + stage] += now - since
+    return now
+
+
+class ReadBatch(object):
+    '''the aligned bases of a set of reads, held as flat arrays.
+
+    Reads that are unmapped, duplicates, have an unmapped mate or map to
+    more than one place are dropped. If `exons`, the sorted starts and
+    ends of non-overlapping exons, are given, reads with no aligned block
+    in an exon are dropped as well, before their bases are decoded.
+
+    Reads with an edit distance of 0 (:attr:`perfect`) match the reference
+    everywhere they align, so only their aligned blocks are kept
+    (:attr:`perfect_start` and :attr:`perfect_end`, found between
+    :attr:`poffsets` of two reads); their sequence, qualities and MD tag
+    are never decoded.
+
+    For every aligned (M/=/X) base of the other reads the batch holds its
+    position in the concatenated read sequences (:attr:`qpos`), its
+    position in the genome (:attr:`rpos`), the read it came from
+    (:attr:`read_of`), the reference base reconstructed from the read and
+    its MD tag (:attr:`genome`) and whether the MD tag marks it as a
+    mismatch (:attr:`is_mm`).
+
+    Read sequences are lower case and bases are held as their ascii
+    codes. `reads` should be in the order they come out of the BAM file,
+    so that the bases of reads overlapping any one region can be found
+    between :attr:`aoffsets` of two reads. The number of reads dropped by
+    each filter is in :attr:`dropped`.
+    '''
+
+    def __init__(self, reads, exons=None):
+
+        self.reads = []
+        self.dropped = defaultdict(int)
+        seqs = []
+        quals = array.array("B")
+        read_start, read_end, indels, perfect, reverse = [], [], [], [], []
+        qoffsets, aoffsets, poffsets = [], [], []
+        blk_q, blk_r, blk_len, blk_read = [], [], [], []
+        perfect_start, perfect_end = [], []
+        md_index, md_bases = [], []
+        events, event_reads = [], []
+
+        query_offset = 0
+        aligned_offset = 0
+        if exons is not None:
+            exon_starts, exon_ends = list(exons[0]), list(exons[1])
+
+        for read in reads:
+            dropped = read_filter(read)
+            if dropped:
+                self.dropped[dropped] += 1
+                continue
+            if exons is not None and not touches_exons(read, exon_starts,
+                                                       exon_ends):
+                self.dropped["intronic"] += 1
+                continue
+
+            nread = len(self.reads)
+            self.reads.append(read)
+            qoffsets.append(query_offset)
+            aoffsets.append(aligned_offset)
+            poffsets.append(len(perfect_start))
+            read_start.append(read.reference_start)
+            read_end.append(read.reference_end)
+            reverse.append(read.is_reverse)
+
+            try:
+                is_perfect = read.get_tag("NM") == 0
+            except KeyError:
+                is_perfect = read.get_tag("nM") == 0
+            perfect.append(is_perfect)
+
+            if is_perfect:
+                # only the reference blocks are needed
+                r = read.reference_start
+                nindels = 0
+                for op, length in read.cigartuples:
+                    if op == 0 or op == 7 or op == 8:
+                        perfect_start.append(r)
+                        perfect_end.append(r + length)
+                        r += length
+                    elif op == 2 or op == 3:
+                        r += length
+                    if op == 1 or op == 2:
+                        nindels += 1
+                indels.append(nindels)
+                continue
+
+            readseq = read.query_sequence
+            seqs.append(readseq)
+            quals.extend(read.query_qualities)
+
+            q = query_offset
+            r = read.reference_start
+            naligned = 0
+            nindels = 0
+            for op, length in read.cigartuples:
+                if op == 0 or op == 7 or op == 8:
+                    blk_q.append(q)
+                    blk_r.append(r)
+                    blk_len.append(length)
+                    blk_read.append(nread)
+                    q += length
+                    r += length
+                    naligned += length
+                elif op == 1 or op == 4:
+                    q += length
+                    if op == 1:
+                        nindels += 1
+                        events.append(aligned_offset + naligned)
+                        event_reads.append(nread)
+                elif op == 2 or op == 3:
+                    r += length
+                    if op == 2:
+                        nindels += 1
+                        events.append(aligned_offset + naligned)
+                        event_reads.append(nread)
+            indels.append(nindels)
+
+            # MD counts along the aligned bases, with deletions marked
+            # by ^ and not counted, so each mismatch can be placed
+            # directly in the aligned arrays.
+            md = read.get_tag("MD")
+            if not md.isdigit():
+                md_offset = aligned_offset
+                for matches, deletion, mismatch in MD_TOKEN.findall(md):
+                    if matches:
+                        md_offset += int(matches)
+                    elif mismatch:
+                        md_index.append(md_offset)
+                        md_bases.append(mismatch)
+                        md_offset += 1
+
+            query_offset += len(readseq)
+            aligned_offset += naligned
+
+        self.seqstr = "".join(seqs).lower()
+        self.seq = np.frombuffer(self.seqstr, dtype=np.uint8)
+        self.qual = np.frombuffer(quals, dtype=np.uint8)
+        self.qoffsets = np.array(qoffsets + [query_offset], dtype=np.int64)
+        self.read_start = np.array(read_start, dtype=np.int64)
+        self.read_end = np.array(read_end, dtype=np.int64)
+        self.aoffsets = np.array(aoffsets + [aligned_offset], dtype=np.int64)
+        self.poffsets = np.array(poffsets + [len(perfect_start)],
+                                 dtype=np.int64)
+        self.perfect_start = np.array(perfect_start, dtype=np.int64)
+        self.perfect_end = np.array(perfect_end, dtype=np.int64)
+        if len(self.reads):
+            self.max_span = int((self.read_end - self.read_start).max())
+        else:
+            self.max_span = 0
+        self.indels = np.array(indels, dtype=np.int64)
+        self.perfect = np.array(perfect, dtype=bool)
+        self.reverse = np.array(reverse, dtype=bool)
+
+        # expand the aligned blocks into one entry per base
+        blk_len = np.array(blk_len, dtype=np.int64)
+        blk_first = np.cumsum(blk_len) - blk_len
+        blk = np.repeat(np.arange(len(blk_len)), blk_len)
+        within = np.arange(aligned_offset, dtype=np.int64) - blk_first[blk]
+        self.qpos = np.array(blk_q, dtype=np.int64)[blk] + within
+        self.rpos = np.array(blk_r, dtype=np.int64)[blk] + within
+        self.read_of = np.array(blk_read, dtype=np.int64)[blk]
+
+        # insertions and deletions sit between two aligned bases, and are
+        # recorded by the index of the aligned base that follows them.
+        # Adding the read number keeps the last event of one read apart
+        # from the first of the next.
+        self.event_reads = np.array(event_reads, dtype=np.int64)
+        self.event_keys = np.array(events, dtype=np.int64) + self.event_reads
+
+        md_index = np.array(md_index, dtype=np.int64)
+        self.is_mm = np.zeros(aligned_offset, dtype=bool)
+        self.is_mm[md_index] = True
+        self.genome = self.seq[self.qpos]
+        self.genome[md_index] = encode_bases(md_bases)
+
+    def __len__(self):
+        return len(self.reads)
+
+    def add_stats(self, counters):
+        '''add the number of reads and aligned bases in the batch, and of
+        reads dropped, to `counters`'''
+
+        counters["reads"] += len(self.reads)
+        counters["aligned_bases"] += len(self.rpos) + \
+            int((self.perfect_end - self.perfect_start).sum())
+        for name, count in self.dropped.iteritems():
+            counters["dropped_" + name] += count
+
+    def indel_distance(self, bases):
+        '''return the distance, in aligned bases along the read, from each
+        of `bases` to the nearest insertion or deletion in the same read.
+        Bases next to an indel are at distance 1. Bases in reads without
+        indels get a distance larger than any read.'''
+
+        reads = self.read_of[bases]
+        keys = bases + reads
+        nevents = len(self.event_keys)
+        far = len(self.rpos) + 1
+
+        if nevents == 0:
+            return np.zeros(len(bases), dtype=np.int64) + far
+
+        after = np.searchsorted(self.event_keys, keys, side="right")
+        before = np.maximum(after - 1, 0)
+        after = np.minimum(after, nevents - 1)
+
+        left = np.where((self.event_reads[before] == reads) &
+                        (self.event_keys[before] <= keys),
+                        keys - self.event_keys[before] + 1, far)
+        right = np.where((self.event_reads[after] == reads) &
+                         (self.event_keys[after] > keys),
+                         self.event_keys[after] - keys, far)
+
+        return np.minimum(left, right)
+
+
+def encode_bases(bases):
+    '''encode a list of single base strings as an array of lower case
+    ascii codes. Anything that isn't a single base is encoded as 0 so that
+    it never compares equal to a read base.'''
+
+    return np.array([ord(b.lower()) if len(b) == 1 else 0 for b in bases],
+                    dtype=np.uint8)
+
+
+def lookup_positions(query, positions, *values):
+    '''find each of `query` in the sorted array `positions`.
+
+    Returns a boolean array saying which were found followed by, for each
+    array in `values`, the value for each query (0 if it wasn't found).'''
+
+    if len(positions) == 0:
+        return (np.zeros(len(query), dtype=bool),) + \
+            tuple(np.zeros(len(query), dtype=v.dtype) for v in values)
+
+    index = np.minimum(np.searchsorted(positions, query), len(positions) - 1)
+    found = positions[index] == query
+    return (found,) + tuple(np.where(found, v[index], 0) for v in values)
+
+
+def tally_positions(batch, strand, bases, blocks, mm, high, low):
+    '''tally the mismatches of a gene by position and read base.
+
+    `bases` are the batch's aligned bases in the gene, `blocks` the start
+    and end arrays of the aligned blocks of perfect reads in the gene, `mm`
+    the mismatched bases among `bases`, and `high` and `low` boolean arrays
+    marking which of `mm` are high and low quality mismatches. Returns a
+    sorted array of :data:`MismatchTallies.TALLY_DTYPE` records, with bases
+    on the + strand and the depth at each position from all of `bases`
+    and `blocks`.
+    '''
+
+    keep = high | low
+    mm = mm[keep]
+    positions = batch.rpos[mm]
+    alts = batch.seq[batch.qpos[mm]]
+    keys, first, inverse = np.unique(positions * 256 + alts,
+                                     return_index=True,
+                                     return_inverse=True)
+
+    records = np.zeros(len(keys), dtype=MismatchTallies.TALLY_DTYPE)
+    if len(keys) == 0:
+        return records
+
+    records["contig"] = batch.reads[batch.read_of[mm[0]]].reference_id
+    records["position"] = keys // 256
+    records["strand"] = ord(strand)
+    records["ref"] = batch.genome[mm[first]]
+    records["alt"] = keys % 256
+    records["high_quality"] = np.bincount(inverse, weights=high[keep],
+                                          minlength=len(keys))
+    records["low_quality"] = np.bincount(inverse, weights=low[keep],
+                                         minlength=len(keys))
+    covered = np.sort(batch.rpos[bases])
+    opened = np.sort(blocks[0])
+    closed = np.sort(blocks[1])
+    records["depth"] = (np.searchsorted(covered, keys // 256, side="right") -
+                        np.searchsorted(covered, keys // 256) +
+                        np.searchsorted(opened, keys // 256, side="right") -
+                        np.searchsorted(closed, keys // 256, side="right"))
+    records["samples"] = 1
+
+    return records
+
+
+def count_batch(batch, gene, seq, snps, edits, options, counters,
+                tallies=None, exons=None):
+    '''count the mismatches in the reads of `batch` that fall in `gene`.
+
+    `seq` is the genomic sequence of the gene, as returned by
+    :func:`reference_sequence`. `snps` is a tuple of sorted
+    positions and alt bases (as from :func:`encode_bases`) of the donor's
+    variants, and `edits` is the same for the ref and alt bases of the RNA
+    editing sites on the strand of the gene. Perfect reads are counted
+    from the reference over their aligned blocks, using prefix sums of
+    each base along `seq` kept at the ends of the blocks. High quality
+    mismatches within ``options.indel_window`` aligned bases of an
+    insertion or deletion are not counted, as they are likely to come from
+    a misplaced indel.
+    Summary statistics are added to `counters`. If `tallies` is a list,
+    the per-position tallies of the gene (see :func:`tally_positions`) are
+    appended to it. If the gene's `exons` are given (see
+    :func:`gene_exons`), only bases in them are counted. Returns the
+    output row for the gene as a list.
+    '''
+
+    gene_id, contig, strand, start, end = gene
+
+    # reads are sorted by start, so only those starting between here
+    # and the end of the gene can overlap it
+    first = np.searchsorted(batch.read_start, start - batch.max_span)
+    last = np.searchsorted(batch.read_start, end)
+    in_gene = first + np.flatnonzero((batch.read_start[first:last] < end) &
+                                     (batch.read_end[first:last] > start))
+    if exons is None:
+        indel_count = int(batch.indels[in_gene].sum())
+    else:
+        # a batch from a sweep can hold reads that are only in the exons
+        # of other genes
+        exon_starts, exon_ends = exons[0].tolist(), exons[1].tolist()
+        indel_count = sum(int(batch.indels[read]) for read in in_gene
+                          if batch.indels[read] and
+                          touches_exons(batch.reads[read], exon_starts,
+                                        exon_ends))
+
+    rpos = batch.rpos
+    lo, hi = batch.aoffsets[first], batch.aoffsets[last]
+    bases = lo + np.flatnonzero((rpos[lo:hi] >= start) &
+                                (rpos[lo:hi] < end) &
+                                (batch.genome[lo:hi] != ord("n")))
+
+    # reference bases that are counted: not n, and in an exon if only
+    # exons are counted
+    counted = seq != ord("n")
+    if exons is not None:
+        counted &= exon_mask(exons, start, len(seq))
+        bases = bases[counted[rpos[bases] - start]]
+    genome = batch.genome[bases]
+    reference = seq[rpos[bases] - start]
+
+    if (reference != genome).any():
+        wrong = bases[np.flatnonzero(reference != genome)[0]]
+        read = batch.reads[batch.read_of[wrong]]
+        E.debug("read: %s, cigar: %s, MD: %s" %
+                (read.query_name, read.cigarstring, read.get_tag("MD")))
+        E.debug("positions of start and end of the gene based on the gtf: %s,%s" % (start, end))
+        E.debug("position of base in genome: %s" % rpos[wrong])
+        E.debug("identity of base from the fasta: %s" % chr(seq[rpos[wrong] - start]))
+        E.debug("identity of base from the read and MD tag: %s" % chr(batch.genome[wrong]))
+        raise ValueError("reference mismatch for read %s in gene %s" %
+                         (read.query_name, gene_id))
+
+    composition = np.bincount(genome, minlength=256)
+    nbases = len(bases)
+
+    # perfect reads match the reference wherever they align, so their
+    # bases are the reference bases of their blocks clipped to the gene
+    plo, phi = batch.poffsets[first], batch.poffsets[last]
+    block_start = np.maximum(batch.perfect_start[plo:phi], start)
+    block_end = np.minimum(batch.perfect_end[plo:phi],
+                           min(end, start + len(seq)))
+    overlaps = block_end > block_start
+    block_start, block_end = block_start[overlaps], block_end[overlaps]
+
+    if len(block_start):
+        # prefix sums of each base are only kept at the ends of the
+        # blocks, so they take memory for the blocks rather than for the
+        # whole of a long gene
+        bounds = np.union1d(block_start, block_end) - start
+        span = slice(bounds[0], bounds[-1])
+        prefix = np.zeros((5, len(bounds)), dtype=np.int64)
+        for i, base in enumerate("acgt"):
+            np.cumsum(np.add.reduceat((seq[span] == ord(base)) &
+                                      counted[span],
+                                      bounds[:-1] - bounds[0],
+                                      dtype=np.int64),
+                      out=prefix[i, 1:])
+        np.cumsum(np.add.reduceat(counted[span], bounds[:-1] - bounds[0],
+                                  dtype=np.int64),
+                  out=prefix[4, 1:])
+        counts = (prefix[:, np.searchsorted(bounds, block_end - start)] -
+                  prefix[:, np.searchsorted(bounds, block_start - start)]
+                  ).sum(axis=1)
+        for i, base in enumerate("acgt"):
+            composition[ord(base)] += counts[i]
+        nbases += int(counts[4])
+
+    # only mismatched bases need classifying
+    mm = bases[batch.is_mm[bases]]
+    genome = batch.genome[mm]
+    qpos = batch.qpos[mm]
+    readbase = batch.seq[qpos]
+    read_n = readbase == ord("n")
+    hq = batch.qual[qpos] >= options.threshold
+
+    at_snp, snp_alt = lookup_positions(rpos[mm], *snps)
+    alt_base = at_snp & (snp_alt == readbase)
+    not_snp = ~alt_base
+
+    at_edit, edit_ref, edit_alt = lookup_positions(rpos[mm], *edits)
+    at_edit &= ~read_n
+    edit = at_edit & (edit_ref == genome) & (edit_alt == readbase)
+    RNA_edits = int(edit.sum())
+    counters["got_edit_pos"] += int(at_edit.sum())
+    counters["wrong_edit_base"] += int((at_edit & ~edit).sum())
+
+    candidates = hq & not_snp
+    counters["got_snp_pos"] += int((hq & at_snp).sum())
+    counters["wrong_base"] += int((hq & at_snp & ~alt_base).sum())
+
+    if options.indel_window > 0:
+        candidates &= batch.indel_distance(mm) > options.indel_window
+
+    counters["got_edit_pos"] += int((candidates & at_edit).sum())
+    counters["wrong_edit_base"] += int((candidates & at_edit & ~edit).sum())
+    mismatches = candidates & ~edit & ~read_n
+
+    total_mm = int((not_snp & ~read_n).sum())
+    counters["got_snp_pos"] += int(at_snp.sum())
+    counters["wrong_base"] += int((at_snp & ~alt_base).sum())
+
+    hq_mm = int(mismatches.sum())
+
+    if tallies is not None:
+        tallies.append(tally_positions(batch, strand, bases,
+                                       (block_start, block_end), mm,
+                                       mismatches,
+                                       not_snp & ~read_n & ~mismatches))
+
+    genomecode = BASE_CODE[genome[mismatches]]
+    readcode = BASE_CODE[readbase[mismatches]]
+    if strand == "-":
+        genomecode = COMPLEMENT_CODE[genomecode]
+        readcode = COMPLEMENT_CODE[readcode]
+        g_to_a = (genomecode == 2) & (readcode == 0)
+        reverse = batch.reverse[batch.read_of[mm[mismatches]]]
+        counters["reverse_g_to_t"] += int((g_to_a & reverse).sum())
+        counters["not_reverse_g_to_t"] += int((g_to_a & ~reverse).sum())
+
+    columns = TRANSITION_INDEX[genomecode * 5 + readcode]
+    if (columns < 0).any():
+        bad = np.flatnonzero(columns < 0)[0]
+        raise KeyError("%s_to_%s" % ("acgtn"[genomecode[bad]],
+                                     "acgtn"[readcode[bad]]))
+    transition = np.bincount(columns, minlength=len(TRANSITIONS))
+
+    return ([gene_id,
+             strand,
+             hq_mm,
+             nbases,
+             total_mm - hq_mm] +
+            [int(composition[ord(b)]) for b in "atcg"] +
+            [int(t) for t in transition] +
+            [indel_count,
+             RNA_edits])
+
+
+def gene_variants(gene, variants, redi, counters):
+    '''find the donor's variants and the RNA editing sites in `gene`.
+
+    Returns two tuples of arrays as used by :func:`count_batch`: the
+    positions and alt bases of the variants, and the positions, ref and alt
+    bases of the editing sites on the same strand as the gene. The time
+    taken is added to `counters`.
+    '''
+
+    gene_id, genecontig, strand, start, end = gene
+
+    since = time.time()
+    snps = variants.fetch(genecontig, start, end)
+    since = add_time(counters, "variants", since)
+    edits = redi.fetch(genecontig, strand, start, end)
+    add_time(counters, "redi", since)
+
+    return snps, edits
+
+
+def fetch_gene(gene, handles, redi, variants, counters):
+    '''fetch the inputs for counting `gene`: its reference sequence,
+    variants, RNA editing sites, exons if only exons are counted and
+    decoded reads. Returns the arguments for :func:`count_batch` as a
+    tuple of (batch, seq, snps, edits, exons).'''
+
+    gene_id, contig, strand, start, end = gene
+
+    since = time.time()
+    seq = reference_sequence(handles, contig, start, end)
+    add_time(counters, "reference", since)
+    snps, edits = gene_variants(gene, variants, redi, counters)
+
+    exons = gene_exons(handles, [gene])
+
+    since = time.time()
+    batch = ReadBatch(handles["bam"].fetch(contig, start, end), exons)
+    add_time(counters, "reads", since)
+    batch.add_stats(counters)
+
+    return batch, seq, snps, edits, exons
+
+
+def count_gene(gene, handles, redi, variants, options, counters,
+               tallies=None):
+    '''count mismatches in a single gene.
+
+    `gene` is a tuple as returned by :func:`iterate_genes`. Summary
+    statistics are added to the dictionary `counters`, and tallies to
+    `tallies` as for :func:`count_batch`. Returns the output row for the
+    gene as a list.
+    '''
+
+    batch, seq, snps, edits, exons = fetch_gene(gene, handles, redi,
+                                                variants, counters)
+
+    since = time.time()
+    row = count_batch(batch, gene, seq, snps, edits, options, counters,
+                      tallies, exons)
+    add_time(counters, "count", since)
+
+    return row
+
+
+def prefetch(iterator, depth, chunk_size=1):
+    '''iterate over `iterator` in a background thread, keeping up to
+    `depth` chunks of `chunk_size` items ready. The thread is stopped when
+    the returned generator is closed, so `iterator` can be left part way
+    through. Any exception it raises is raised again here.'''
+
+    queue = Queue.Queue(depth)
+    stop = threading.Event()
+    finished = object()
+
+    def _fill():
+        try:
+            chunk = []
+            for item in iterator:
+                chunk.append(item)
+                if len(chunk) == chunk_size:
+                    queue.put(chunk)
+                    chunk = []
+                    if stop.is_set():
+                        return
+            queue.put(chunk)
+            queue.put(finished)
+        except Exception:
+            queue.put(sys.exc_info())
+
+    thread = threading.Thread(target=_fill)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            chunk = queue.get()
+            if chunk is finished:
+                break
+            if isinstance(chunk, tuple):
+                raise chunk[0], chunk[1], chunk[2]
+            for item in chunk:
+                yield item
+    finally:
+        # let the thread finish before its handles are used again
+        stop.set()
+        while thread.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+
+def prefetch_genes(genes, handles, redi, variants, counters):
+    '''fetch the inputs for each of `genes`, a list of (index, gene)
+    tuples, as for :func:`fetch_gene`. Yields the index, gene, the inputs
+    and the time taken to fetch them.'''
+
+    for index, gene in genes:
+        since = time.time()
+        inputs = fetch_gene(gene, handles, redi, variants, counters)
+        yield (index, gene) + inputs + (time.time() - since,)
+
+
+def cluster_genes(genes):
+    '''group `genes`, a list of (index, gene) tuples from one contig sorted
+    by start, into clusters of overlapping genes. Returns a list of (start,
+    end, genes) for each cluster.'''
+
+    clusters = []
+    for index, gene in genes:
+        if clusters and gene[3] < clusters[-1][1]:
+            clusters[-1][1] = max(clusters[-1][1], gene[4])
+            clusters[-1][2].append((index, gene))
+        else:
+            clusters.append([gene[3], gene[4], [(index, gene)]])
+
+    return clusters
+
+
+def sweep_shards(genes, shard_size):
+    '''group a stream of (index, gene) tuples by contig and sort them by
+    start, then split each contig into shards of whole clusters of
+    overlapping genes with at least `shard_size` genes in each (apart from
+    the last on each contig).'''
+
+    contigs = []
+    contig_genes = defaultdict(list)
+    for index, gene in genes:
+        if gene[1] not in contig_genes:
+            contigs.append(gene[1])
+        contig_genes[gene[1]].append((index, gene))
+
+    for contig in contigs:
+        contig_genes[contig].sort(key=lambda x: x[1][3])
+        shard = []
+        for start, end, cluster in cluster_genes(contig_genes[contig]):
+            shard.extend(cluster)
+            if len(shard) >= shard_size:
+                yield shard
+                shard = []
+        if shard:
+            yield shard
+
+
+def fetch_clusters(bam, contig, clusters):
+    '''iterate over the reads of `bam` overlapping `clusters`, from
+    :func:`cluster_genes`, in coordinate order. Clusters less than
+    :data:`FETCH_GAP` apart are fetched together, and reads overlapping
+    more than one fetch are only returned by the first.'''
+
+    spans = []
+    for start, end, cluster in clusters:
+        if spans and start - spans[-1][1] < FETCH_GAP:
+            spans[-1][1] = max(spans[-1][1], end)
+        else:
+            spans.append([start, end])
+
+    fetched_to = None
+    for start, end in spans:
+        for read in bam.fetch(contig, start, end):
+            if fetched_to is not None and read.reference_start < fetched_to:
+                continue
+            yield read
+        fetched_to = end
+
+
+def sweep_genes(genes, handles, redi, variants, options, counters,
+                tallies=None, gene_times=None):
+    '''count mismatches in `genes`, a list of (index, gene) tuples from one
+    contig sorted by start, in a single pass over the reads.
+
+    Reads are streamed in coordinate order and held while they overlap the
+    current cluster of overlapping genes. When the cluster is passed its
+    reads are decoded once and credited to every gene in it. Reads that
+    reach into the next cluster are carried over to it, and decoded again
+    there, but are only added to the read and aligned base counts by the
+    first cluster they are in.
+
+    If `gene_times` is a list, the time spent on each gene is appended to
+    it as (seconds, gene_id), with the time decoding the reads of a
+    cluster split evenly between its genes.
+
+    Returns a list of (index, row) tuples.
+    '''
+
+    clusters = cluster_genes(genes)
+    contig = genes[0][1][1]
+    rows = []
+    started = time.time()
+    in_clusters = [0.0]
+
+    def _count_cluster(cluster, reads, ncarried):
+        cluster_start = since = time.time()
+        cluster_exons = gene_exons(handles, [gene for index, gene
+                                             in cluster[2]])
+        batch = ReadBatch(reads, cluster_exons)
+        decoding = add_time(counters, "reads", since) - since
+        # the reads carried over from the last cluster come first
+        add_read_stats(counters, reads[ncarried:], cluster_exons)
+        for index, gene in cluster[2]:
+            gene_start = since = time.time()
+            seq = reference_sequence(handles, contig, gene[3], gene[4])
+            add_time(counters, "reference", since)
+            snps, edits = gene_variants(gene, variants, redi, counters)
+            exons = gene_exons(handles, [gene])
+            since = time.time()
+            rows.append((index, count_batch(batch, gene, seq, snps, edits,
+                                            options, counters, tallies,
+                                            exons)))
+            add_time(counters, "count", since)
+            if gene_times is not None:
+                gene_times.append((time.time() - gene_start +
+                                   decoding / len(cluster[2]), gene[0]))
+        in_clusters[0] += time.time() - cluster_start
+
+    reads = fetch_clusters(handles["bam"], contig, clusters)
+    if options.prefetch:
+        reads = prefetch(reads, options.prefetch, PREFETCH_CHUNK)
+
+    current = 0
+    pending = []
+    ncarried = 0
+    for read in reads:
+        dropped = read_filter(read)
+        if dropped:
+            counters["dropped_" + dropped] += 1
+            continue
+
+        while (current < len(clusters) and
+               read.reference_start >= clusters[current][1]):
+            _count_cluster(clusters[current], pending, ncarried)
+            current += 1
+            if current < len(clusters):
+                pending = [r for r in pending
+                           if r.reference_end > clusters[current][0]]
+                ncarried = len(pending)
+
+        if current == len(clusters):
+            reads.close()
+            break
+
+        if read.reference_end > clusters[current][0]:
+            pending.append(read)
+
+    for cluster in clusters[current:]:
+        _count_cluster(cluster, pending, ncarried)
+        pending = [r for r in pending if r.reference_end > cluster[1]]
+        ncarried = len(pending)
+
+    # the rest of the time went on streaming the reads from the BAM file
+    counters["time_reads"] += time.time() - started - in_clusters[0]
+
+    return rows
+
+
+def count_shard(shard, handles, redi, variants, options):
+    '''count a shard of (index, gene) tuples. Returns a list of (index,
+    row) tuples, the summary counters for the shard, a list of (index,
+    tallies) tuples if ``options.tally_path`` is set (otherwise None) and
+    a list of (seconds, gene_id) tuples with the time taken by each
+    gene.'''
+
+    counters = defaultdict(int)
+    tallies = [] if options.tally_path else None
+    gene_times = []
+    if options.sweep:
+        rows = sweep_genes(shard, handles, redi, variants, options,
+                           counters, tallies, gene_times)
+    elif options.prefetch:
+        # the background thread keeps its own counters, as both threads
+        # adding to the same ones could lose counts
+        fetched = defaultdict(int)
+        rows = []
+        for index, gene, batch, seq, snps, edits, exons, seconds in \
+                prefetch(prefetch_genes(shard, handles, redi, variants,
+                                        fetched),
+                         options.prefetch):
+            since = time.time()
+            rows.append((index, count_batch(batch, gene, seq, snps, edits,
+                                            options, counters, tallies,
+                                            exons)))
+            add_time(counters, "count", since)
+            gene_times.append((time.time() - since + seconds, gene[0]))
+        for key, value in fetched.iteritems():
+            counters[key] += value
+    else:
+        rows = []
+        for index, gene in shard:
+            since = time.time()
+            rows.append((index, count_gene(gene, handles, redi, variants,
+                                           options, counters, tallies)))
+            gene_times.append((time.time() - since, gene[0]))
+
+    # each gene appends one array of tallies as its row is made
+    if tallies is not None:
+        tallies = zip([index for index, row in rows], tallies)
+
+    return rows, dict(counters), tallies, gene_times
+
+
+def file_identity(path):
+    '''the absolute path, size and modification time of `path`, or of the
+    file it is the prefix of (the contigs table of an index or a fasta
+    file), or None if `path` isn't given'''
+
+    if not path:
+        return None
+
+    for candidate in [path, path + MismatchIndex.CONTIGS_SUFFIX,
+                      path + ".fasta"]:
+        if os.path.exists(candidate):
+            stat = os.stat(candidate)
+            return [os.path.abspath(candidate), stat.st_size,
+                    int(stat.st_mtime)]
+
+    return [os.path.abspath(path)]
+
+
+def run_identity(options):
+    '''the inputs and settings of a run, used to check that a checkpoint
+    journal belongs to the run resuming from it'''
+
+    # --genes and --regions are either files or lists on the command line
+    selection = {}
+    for name in ["genes", "regions"]:
+        value = getattr(options, name)
+        if value and os.path.exists(value):
+            value = file_identity(value)
+        selection[name] = value
+
+    return {"bam": file_identity(options.bam),
+            "genes": file_identity(options.gene_index) or
+            getattr(options.stdin, "name", None),
+            "genome": file_identity(options.genome_index or
+                                    options.fastapath),
+            "variants": file_identity(options.variant_index or
+                                      options.vcfpath),
+            "sample_pattern": options.samppattern,
+            "redi": file_identity(options.redi_index or options.redipath),
+            "selection": selection,
+            "sweep": options.sweep,
+            "threshold": options.threshold,
+            "indel_window": options.indel_window,
+            "exons_only": options.exons_only,
+            "tallies": bool(options.tally_path)}
+
+
+def write_journal(journal, result):
+    '''append `result` to the open checkpoint `journal` and make sure it
+    is on disk'''
+
+    data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+    journal.write(struct.pack("<Q", len(data)))
+    journal.write(data)
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def read_journal(path):
+    '''read the records in the checkpoint journal at `path`. A record that
+    was only partly written when the job stopped is ignored. Returns the
+    records and the length of the file up to the end of the last complete
+    one.'''
+
+    records = []
+    length = 0
+    if not os.path.exists(path):
+        return records, length
+
+    with open(path, "rb") as inf:
+        while True:
+            size = inf.read(8)
+            if len(size) < 8:
+                break
+            size = struct.unpack("<Q", size)[0]
+            data = inf.read(size)
+            if len(data) < size:
+                break
+            records.append(cPickle.loads(data))
+            length = inf.tell()
+
+    return records, length
+
+
+def open_journal(options):
+    '''open the checkpoint journal for appending. With ``--resume`` the
+    shard results already in it are returned, provided it was written by
+    the same run, otherwise it is started again.'''
+
+    identity = run_identity(options)
+    results, length = [], 0
+    if options.resume:
+        records, length = read_journal(options.checkpoint)
+        if records and records[0] == identity:
+            results = records[1:]
+        elif records:
+            E.warn("checkpoint %s is from a different run, starting again" %
+                   options.checkpoint)
+            length = 0
+
+    journal = open(options.checkpoint, "ab")
+    journal.truncate(length)
+    if length == 0:
+        write_journal(journal, identity)
+
+    return journal, results
+
+
+def skip_genes(genes, done):
+    '''filter out of a stream of (index, gene) tuples those whose index is
+    in `done`, a dictionary of the gene ids already counted. Raises
+    ValueError if these don't match the genes in the stream.'''
+
+    for index, gene in genes:
+        if index in done:
+            if done[index] != gene[0]:
+                raise ValueError(
+                    "gene %i is %s in the checkpoint but %s in the input" %
+                    (index, done[index], gene[0]))
+            continue
+        yield index, gene
+
+
+def journal_results(results, journal):
+    '''record each shard result in `journal` as it goes past'''
+
+    for result in results:
+        write_journal(journal, result)
+        yield result
+
+
+def run_stats(counters, slowest, elapsed, ngenes):
+    '''gather the instrumentation of a run into a dictionary for the
+    stats sidecar. `slowest` is a list of (seconds, gene_id) tuples.'''
+
+    stage_time = sum(counters["time_" + stage] for stage in STAGES)
+    return {"genes": ngenes,
+            "elapsed_seconds": elapsed,
+            "reads": counters["reads"],
+            "aligned_bases": counters["aligned_bases"],
+            "reads_per_second": counters["reads"] / elapsed,
+            "bases_per_second": counters["aligned_bases"] / elapsed,
+            "stage_seconds": dict((stage, counters["time_" + stage])
+                                  for stage in STAGES),
+            "reads_per_stage_second": counters["reads"] / stage_time
+            if stage_time else 0,
+            "dropped_reads": dict((name, counters["dropped_" + name])
+                                  for name in FILTERS),
+            "slowest_genes": [{"gene_id": gene_id, "seconds": seconds}
+                              for seconds, gene_id in slowest],
+            "counters": dict((key, counters[key]) for key in COUNTERS)}
+
+
+def _init_worker(options, redi, variants):
+    '''set up a worker process with its own file handles. The REDI and
+    variant indexes are inherited from the parent.'''
+
+    _worker["handles"] = open_handles(options)
+    _worker["redi"] = redi
+    _worker["variants"] = variants
+    _worker["options"] = options
+
+
+def _count_shard(shard):
+    '''count all the genes in a shard in a worker process'''
+
+    return count_shard(shard,
+                       _worker["handles"],
+                       _worker["redi"],
+                       _worker["variants"],
+                       _worker["options"])
+
+
+def count_sample(options, genes, handles, redi, variants, workers=1):
+    '''count the mismatches of the sample in ``options.bam`` in `genes`, an
+    iterable of genes as from :func:`iterate_genes`, writing the counts
+    and any tallies, checkpoint and stats as set in `options`. The genes
+    are counted in a pool of `workers` processes if more than 1. Returns
+    the number of genes counted and the summary counters.'''
+
+    if options.npz_path:
+        output = []
+    else:
+        options.stdout.write("\t".join(HEADER) + "\n")
+
+    counters = defaultdict(int)
+    genes = enumerate(genes)
+
+    if options.checkpoint:
+        journal, restored = open_journal(options)
+        done = dict((index, row[0])
+                    for rows, shard_counters, tallies, gene_times in restored
+                    for index, row in rows)
+        if done:
+            E.info("resuming from checkpoint with %i genes already counted" %
+                   len(done))
+        genes = skip_genes(genes, done)
+    else:
+        journal, restored = None, []
+
+    if options.sweep:
+        shards = sweep_shards(genes, options.shard_size)
+    else:
+        shards = shard_genes(genes, options.shard_size)
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers,
+                                    initializer=_init_worker,
+                                    initargs=(options, redi, variants))
+
+        # imap returns the shards in the order they were submitted
+        results = pool.imap(_count_shard, shards)
+    else:
+        pool = None
+        results = (count_shard(shard, handles, redi, variants, options)
+                   for shard in shards)
+
+    if journal is not None:
+        results = itertools.chain(restored, journal_results(results, journal))
+
+    # rows are written in the order of the genes in the input, holding
+    # back any that arrive early
+    waiting = {}
+    next_row = 0
+    gene_tallies = []
+    slowest = []
+    started = last_progress = time.time()
+    for rows, shard_counters, tallies, gene_times in results:
+        if tallies is not None:
+            gene_tallies.extend(tallies)
+        slowest = heapq.nlargest(options.slowest, slowest + gene_times)
+        for index, row in rows:
+            waiting[index] = row
+        while next_row in waiting:
+            if options.npz_path:
+                output.append(waiting.pop(next_row))
+            else:
+                options.stdout.write(
+                    "\t".join(map(str, waiting.pop(next_row))) + "\n")
+            next_row += 1
+        for key, value in shard_counters.iteritems():
+            counters[key] += value
+
+        if time.time() - last_progress >= options.progress_interval:
+            last_progress = time.time()
+            E.info("counted %i genes, %i reads at %.0f reads/s" %
+                   (next_row, counters["reads"],
+                    counters["reads"] / (last_progress - started)))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if options.npz_path:
+        MismatchCounts.save_counts(
+            options.npz_path, HEADER, output,
+            sample=MismatchCounts.sample_name(options.bam),
+            bamfile=options.bam,
+            quality_threshold=options.threshold,
+            indel_window=options.indel_window,
+            exons_only=options.exons_only)
+
+    if options.tally_path:
+        # where genes on the same strand overlap, the tallies of the
+        # first in the input are used
+        gene_tallies.sort(key=lambda x: x[0])
+        records = MismatchTallies.sort_tallies(
+            np.concatenate([t for index, t in gene_tallies] or
+                           [np.zeros(0, dtype=MismatchTallies.TALLY_DTYPE)]),
+            combine="first")
+        MismatchTallies.write_tallies(
+            options.tally_path, handles["bam"].references, records,
+            sample=MismatchCounts.sample_name(options.bam),
+            quality_threshold=options.threshold,
+            indel_window=options.indel_window)
+
+    if journal is not None:
+        journal.close()
+        os.unlink(options.checkpoint)
+
+    if options.stats_path:
+        with open(options.stats_path, "w") as outf:
+            json.dump(run_stats(counters, slowest, time.time() - started,
+                                next_row),
+                      outf, indent=2, sort_keys=True)
+
+    # write footer and output benchmark information.
+    E.info("Out of %i mismatches at snp positions %i were the wrong base" %(counters["got_snp_pos"], counters["wrong_base"]))
+    E.info("Out of %i mismatches at RNA edit positions %i were the wrong base" %(counters["got_edit_pos"], counters["wrong_edit_base"]))
+    E.info("Out of %i g_to_c transitions on - strand genes, the read was on the + strand %i times" %
+           (counters["not_reverse_g_to_t"], counters["reverse_g_to_t"]))
+
+    return next_row, counters
+
+
+def read_manifest(infile, options):
+    '''read a manifest of samples from `infile`. The first line names the
+    columns, from :data:`MANIFEST_COLUMNS`, and each further line is a
+    sample. Returns a copy of `options` for each sample, with the
+    per-sample options set from its columns, or from `options` where a
+    column is missing or empty. Raises ValueError if samples would write
+    to the same file.'''
+
+    samples = []
+    columns = None
+    for line in infile:
+        if line.startswith("#") or not line.strip():
+            continue
+        fields = line.rstrip("\n").split("\t")
+        if columns is None:
+            columns = fields
+            unknown = set(columns) - set(MANIFEST_COLUMNS)
+            if unknown:
+                raise ValueError("unknown manifest columns: %s" %
+                                 ", ".join(sorted(unknown)))
+            if "bamfile" not in columns:
+                raise ValueError("manifest has no bamfile column")
+            continue
+
+        row = dict(zip(columns, fields))
+        sample = copy.copy(options)
+        for column, dest in MANIFEST_COLUMNS.iteritems():
+            setattr(sample, dest,
+                    row.get(column) or getattr(options, dest, None))
+        if not (sample.output or sample.npz_path):
+            raise ValueError("no output or npz_path for %s in manifest" %
+                             sample.bam)
+        samples.append(sample)
+
+    for dest in ["output", "npz_path", "tally_path", "stats_path",
+                 "checkpoint"]:
+        paths = [getattr(sample, dest) for sample in samples
+                 if getattr(sample, dest)]
+        if len(paths) != len(set(paths)):
+            raise ValueError("samples in the manifest share a %s" % dest)
+
+    return samples
+
+
+def sample_donor(sample):
+    '''return the donor whose variants are extracted from the VCF for
+    `sample`, from :func:`read_manifest`, or None if the sample has a
+    variant index'''
+
+    if sample.variant_index or not sample.samppattern:
+        return None
+    return re.search(sample.samppattern, sample.bam).group(1)
+
+
+def _init_manifest_worker(options, samples, genes, redi, regions):
+    '''set up a worker process for counting whole samples. The samples
+    from :func:`read_manifest`, the genes, the REDI index and the regions
+    to read variants from are inherited from the parent, so jobs only
+    need to name a sample by its row of the manifest.'''
+
+    _worker["reference"] = open_reference(options)
+    _worker["samples"] = samples
+    _worker["genes"] = genes
+    _worker["redi"] = redi
+    _worker["regions"] = regions
+
+
+def _index_donor(args):
+    '''extract the variants of a donor from the VCF in a worker process,
+    for the sample in row `index` of the manifest, and save them as an
+    index at `prefix`, for all the donor's samples to share'''
+
+    index, prefix = args
+    load_variants(_worker["samples"][index], _worker["regions"]).save(prefix)
+
+
+def _count_manifest_sample(args):
+    '''count the sample in row `index` of the manifest in a worker
+    process, with the variants in the index at `prefix` if there is one.
+    Returns the sample name, number of genes and summary counters.'''
+
+    index, prefix = args
+    sample = copy.copy(_worker["samples"][index])
+    if prefix:
+        variants = MismatchIndex.VariantIndex.load(prefix)
+    else:
+        variants = load_variants(sample, _worker["regions"])
+
+    if sample.output:
+        sample.stdout = IOTools.openFile(sample.output, "w")
+    ngenes, counters = count_sample(
+        sample, _worker["genes"],
+        open_handles(sample, _worker["reference"]),
+        _worker["redi"], variants)
+    if sample.output:
+        sample.stdout.close()
+
+    return MismatchCounts.sample_name(sample.bam), ngenes, dict(counters)
+
+
+def count_manifest(options, genes, redi, regions=None):
+    '''count `genes` in every sample in ``options.manifest``. The samples
+    are counted one at a time in a pool of ``options.workers`` processes
+    that share the genes, REDI index and reference. The variants of each
+    donor are extracted once, into a temporary index shared by the
+    donor's samples. If `regions` are given, only the variants in them
+    are read.'''
+
+    samples = read_manifest(IOTools.openFile(options.manifest), options)
+    genes = list(genes)
+
+    tmpdir = tempfile.mkdtemp(prefix="count_mismatches.")
+    donors = {}
+    for index, sample in enumerate(samples):
+        donor = sample_donor(sample)
+        if donor is not None and donor not in donors:
+            donors[donor] = (index,
+                             os.path.join(tmpdir, "donor%i" % len(donors)))
+    E.info("counting %i genes in %i samples from %i donors" %
+           (len(genes), len(samples), len(donors)))
+
+    if options.workers > 1:
+        pool = multiprocessing.Pool(min(options.workers, len(samples)),
+                                    initializer=_init_manifest_worker,
+                                    initargs=(options, samples, genes,
+                                              redi, regions))
+        mapper, unordered = pool.map, pool.imap_unordered
+    else:
+        pool = None
+        _init_manifest_worker(options, samples, genes, redi, regions)
+        mapper = unordered = itertools.imap
+
+    try:
+        list(mapper(_index_donor, donors.values()))
+        jobs = [(index, sample_donor(sample) and
+                 donors[sample_donor(sample)][1])
+                for index, sample in enumerate(samples)]
+
+        options.stdout.write("sample\tgenes\treads\n")
+        for sample, ngenes, counters in unordered(_count_manifest_sample,
+                                                  jobs):
+            options.stdout.write("%s\t%i\t%i\n" %
+                                 (sample, ngenes, counters["reads"]))
+            E.info("counted %i genes in %s" % (ngenes, sample))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        shutil.rmtree(tmpdir)
+
+
+class JobHandler(SocketServer.StreamRequestHandler):
+    '''count the mismatches for a job sent to the daemon. The job is a
+    single line of JSON, encoded as UTF-8, with the fields in
+    :data:`JOB_OPTIONS` and an optional list of gene ids to count. The
+    table is streamed back a row at a time, followed by a line of
+    ``#done`` and a JSON summary, or ``#error`` and the error message as
+    a JSON string if the job failed, separated by a tab. Both are JSON so
+    that they are a single ASCII line whatever the message.'''
+
+    def handle(self):
+
+        server = self.server
+        try:
+            job = json.loads(self.rfile.readline().decode("utf-8"))
+            options = copy.copy(server.options)
+            for field, dest in JOB_OPTIONS.iteritems():
+                if field in job:
+                    setattr(options, dest, job[field])
+            options.npz_path = options.checkpoint = None
+            options.stdout = self.wfile
+
+            genes = server.genes
+            regions = server.regions
+            if job.get("genes"):
+                wanted = set(job["genes"])
+                genes = list(select_genes(genes, wanted))
+                missing = wanted - set(gene[0] for gene in genes)
+                if missing:
+                    raise ValueError("unknown genes: %s" %
+                                     ", ".join(sorted(missing)))
+                regions = merge_regions(genes)
+                options.sweep = True
+
+            E.info("counting %i genes in %s" % (len(genes), options.bam))
+            ngenes, counters = count_sample(options, genes,
+                                            open_handles(options),
+                                            server.redi,
+                                            load_variants(options, regions))
+            self.wfile.write("#done\t%s\n" % json.dumps(
+                {"genes": ngenes, "reads": counters["reads"]}))
+        except Exception as error:
+            E.warn("job failed: %s" % error)
+            self.wfile.write("#error\t%s\n" % json.dumps(unicode(error)))
+
+
+class CountServer(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+    '''a daemon holding the genes and the REDI index in memory. Each job
+    is counted in a forked child, which shares them with the daemon, so
+    a failed job cannot take the daemon down.'''
+
+    def __init__(self, path, options, genes, redi, regions):
+        SocketServer.UnixStreamServer.__init__(self, path, JobHandler)
+        self.options = options
+        self.genes = genes
+        self.redi = redi
+        self.regions = regions
+
+
+def serve(options, genes, redi, regions=None):
+    '''serve jobs counting `genes` on the unix socket at ``options.serve``
+    until the daemon is stopped'''
+
+    genes = list(genes)
+    if os.path.exists(options.serve):
+        os.unlink(options.serve)
+    server = CountServer(options.serve, options, genes, redi, regions)
+
+    # leave through the finally clause on SIGTERM, so the socket is
+    # removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    E.info("serving %i genes on %s" % (len(genes), options.serve))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(options.serve)
 
-got_snp_pos = 0
-wrong_base = 0
-got_edit_pos = 0 
-wrong_edit_base = 0
 
 def main(argv=None):
     """script main.
@@ -61,6 +1828,14 @@ def main(argv=None):
     parser = E.OptionParser(version="%prog version: $Id$",
                             usage=globals()["__doc__"])
 
+    parser.add_option("--gene-index", dest="gene_index", type="string",
+                      help="gene models compiled by compile_geneset.py, "
+                      "used instead of reading a GTF file from stdin")
+    parser.add_option("--exons-only", dest="exons_only", action="store_true",
+                      default=False,
+                      help="only count bases in the exons of each gene, "
+                      "dropping reads with no aligned bases in them. Needs "
+                      "--gene-index")
     parser.add_option("-b", "--bamfile", dest="bam", type="string",
                       help="BAM formated alignment file to test. Should have MD and NH tags set")
     parser.add_option("-t", "--quality-threshold", dest="threshold", type="int",
@@ -68,396 +1843,114 @@ def main(argv=None):
                        help="minimum quality threshold for a mismatched base to count")
     parser.add_option("-f", "--fasta-path", dest="fastapath", type="string",
                        help="path to indexed fasta file for genome of choice")
+    parser.add_option("--genome-index", dest="genome_index", type="string",
+                      help="prefix of a genome index made by "
+                      "index_genome.py, used instead of --fasta-path")
     parser.add_option("-p", "--vcf-path", dest="vcfpath", type="string",
                        help="path to indexed vcf file for dataset  of choice")
     parser.add_option("-d", "--sample", dest="samppattern", type="string",
-                       help="pattern to match and extract the donor name from the bam file, for use in parsing the vcf file") 
+                       help="pattern to match and extract the donor name from the bam file, for use in parsing the vcf file")
+    parser.add_option("--variant-index", dest="variant_index", type="string",
+                      help="index of the donor's variants made by "
+                      "index_variants.py. If not given the variants are "
+                      "read from --vcf-path")
     parser.add_option("-n", "--REDI-path", dest="redipath", type="string",
-                       help="path to Bed format REDIportal table containing RNA editing positions")      
+                       help="path to Bed format REDIportal table containing RNA editing positions")
+    parser.add_option("--REDI-index", dest="redi_index", type="string",
+                      help="index of the REDIportal table made by "
+                      "index_redi.py. If not given the table is read from "
+                      "--REDI-path")
+    parser.add_option("--indel-window", dest="indel_window", type="int",
+                      default=5,
+                      help="ignore high quality mismatches within this many "
+                      "aligned bases of an insertion or deletion in the "
+                      "read's CIGAR. 0 to count them all")
+    parser.add_option("--npz-path", dest="npz_path", type="string",
+                      help="save the counts as a columnar numpy archive at "
+                      "this path instead of writing a table to stdout")
+    parser.add_option("--tally-path", dest="tally_path", type="string",
+                      help="also write sparse per-position tallies of the "
+                      "mismatches to this file (see MismatchTallies.py)")
+    parser.add_option("--checkpoint", dest="checkpoint", type="string",
+                      help="journal file to save the counts of each shard "
+                      "of genes to as they are finished")
+    parser.add_option("--resume", dest="resume", action="store_true",
+                      default=False,
+                      help="carry on from the --checkpoint journal of a run "
+                      "that didn't finish, only counting the missing genes")
+    parser.add_option("--stats-path", dest="stats_path", type="string",
+                      help="write timings of each stage, throughput, the "
+                      "slowest genes and dropped read counts to this JSON "
+                      "file")
+    parser.add_option("--slowest", dest="slowest", type="int", default=20,
+                      help="number of slowest genes to list in the stats")
+    parser.add_option("--progress-interval", dest="progress_interval",
+                      type="int", default=300,
+                      help="seconds between progress lines in the log")
+    parser.add_option("--genes", dest="genes", type="string",
+                      help="only count these genes: a comma separated list "
+                      "of gene ids or a file with one per line")
+    parser.add_option("--regions", dest="regions", type="string",
+                      help="only count genes overlapping these regions: a "
+                      "comma separated list of contig:start-end (without "
+                      "commas in the coordinates) or contig, or a BED file")
+    parser.add_option("--prefetch", dest="prefetch", type="int", default=0,
+                      help="number of genes (chunks of %i reads with "
+                      "--sweep) to fetch and decode ahead of counting in a "
+                      "background thread. 0 to fetch them as they are "
+                      "counted" % PREFETCH_CHUNK)
+    parser.add_option("--manifest", dest="manifest", type="string",
+                      help="table of samples to count in one run, with a "
+                      "bamfile column and an output or npz_path column for "
+                      "each sample, instead of --bamfile")
+    parser.add_option("--serve", dest="serve", type="string",
+                      help="run as a daemon, counting jobs sent by "
+                      "count_mismatches_client.py to a unix socket at this "
+                      "path")
+    parser.add_option("-w", "--workers", dest="workers", type="int",
+                      default=1,
+                      help="number of worker processes to count genes in, "
+                      "or with --manifest to count samples in")
+    parser.add_option("--shard-size", dest="shard_size", type="int",
+                      default=200,
+                      help="maximum number of genes in each shard handed to "
+                      "a worker process")
+    parser.add_option("--sweep", dest="sweep", action="store_true",
+                      default=False,
+                      help="read each contig in a single pass, decoding "
+                      "each read once for all the genes it overlaps, "
+                      "instead of fetching the reads for each gene")
 
     (options, args) = E.Start(parser, argv=argv)
 
-    
-    bamfile = pysam.AlignmentFile(options.bam)
-    fastafile = IndexedFasta(options.fastapath)
-    vcffile = vcf.Reader(open(options.vcfpath,"r"))
-    BEDREDI = Bed.readAndIndex(IOTools.openFile(options.redipath), with_values=True)
-    options.stdout.write("\t".join(["gene_id",
-                                    "strand",
-                                    "mismatches",
-                                    "bases",
-                                    "low_qual",
-                                    "a","t","c","g",
-                                    "a_to_t","a_to_g","a_to_c",
-                                    "t_to_a","t_to_g","t_to_c",
-                                    "g_to_a","g_to_t","g_to_c",
-                                    "c_to_a","c_to_t","c_to_g",
-                                    "indel_count","RNA_editing_events"]) + "\n")
-    
-    samplepattern = options.samppattern
-    (not_reverse_g_to_t, reverse_g_to_t) = 0, 0
-    donorfrombam = re.search(r"%s"%(samplepattern),options.bam,flags=0).group(1)
-
-    # find the donorid:
-    vcf_record = vcffile.next()
-    samples = vcf_record.samples
-    donors = [dnr.sample for dnr in samples]
-    donorid = None
-    for samp in donors:
-        if donorfrombam in samp:
-            donorid=samp
-
-    if donorid is None:
-        raise ValueError("Donor %s not found in VCF" % donorfrombam)
-    
-    reversecomplement = {"a":"t","t":"a","c":"g","g":"c"}
-
-    for gene in GTF.flat_gene_iterator(GTF.iterator(options.stdin)):
-
-        start = min(e.start for e in gene)
-        end = max(e.end for e in gene)  
-        strand = gene[0].strand
-
-        seq = fastafile.getSequence(gene[0].contig, "+", start, end)
-        thischr = gene[0].contig.replace("chr","")
-        reads = bamfile.fetch(gene[0].contig, start, end)
-
-        if all("chr" in c for c in vcffile.contigs.keys()) == False:            
-            contig = (gene[0].contig).replace("chr","")
-            if contig == "M":
-                contig = contig + "T"
-        else:
-            contig = gene[0].contig
-       
-        try:
-            vcfregion = vcffile.fetch(contig,start,end)
-        except ValueError:
-            vcfregion = []
-                    
-
-        regionchecker=list(vcfregion)
-                
-        BEDREDIregion = BEDREDI[gene[0].contig].find(start,end+1)
- 
-        editpositions = {edit_pos:edit_pos_field for
-                         edit_pos,edit_pos_plus,edit_pos_field
-                         in BEDREDIregion if edit_pos_field.fields[2] == strand}
-              
-        gene_id = gene[0].gene_id
-        mm_count = 0
-        base_count = 0
-        skipped = 0
-        indel_count = 0
-        RNA_edits = 0
-        matched_bases = defaultdict(int)
-        transition = {"a_to_t":0,"a_to_g":0,"a_to_c":0,"t_to_a":0,"t_to_g":0,
-        "t_to_c":0,"g_to_a":0,"g_to_t":0,"g_to_c":0,"c_to_a":0,"c_to_t":0,
-        "c_to_g":0}
-        
-        snp_dict={}
-        for snp in regionchecker:
-            if snp.genotype(donorid)["GT"] != "0/0":
-                snp_dict[snp.POS -1] = snp.ALT
-            
-        for read in reads:
-            if read.is_unmapped:
-                continue
-            if read.is_duplicate:
-                continue
-            if read.mate_is_unmapped:
-                continue
-            if read.get_tag("NH") > 1:
-                continue
-            qualities = read.query_qualities
-
-            alignmentcigar = read.cigarstring
-
-            indel_count += (alignmentcigar.count("I") + alignmentcigar.count("D"))
-
-            alignment = read.get_aligned_pairs(with_seq=True)
-
-            # list[:] is weird syntax for copying the list
-            
-            alignment = [base for base in alignment 
-                         if not base[0] is None 
-                         and not base[1] is None]
-
-            testalignment = alignment[:]           
-#            base_count += sum(1 for base in alignment
-#                          if start <= base[1] < end and
-#                          base[2].lower() != "n")
-#                          
-            
-            total_alignment = [base for base in alignment
-                               if start <= base[1] < end and
-                               base[2].lower() != "n"]
-
-            base_count += len(total_alignment)
-            for base in total_alignment:
-                if seq[(base[1])-start].lower() != base[2].lower():
-                    if (testalignment[0][1] is None) or (testalignment[-1][1] is None):
-                        E.debug("first or last base of read is None")
-                        E.debug("read sequence is %s" %(testalignment))
-                        E.debug("position of first base in genome: %s" %testalignment[0][1])
-                        E.debug("position of last base in genome: %s" %testalignment[-1][1])
-                        E.debug("identity of first base in genome: %s" %testalignment[0][2])
-                        E.debug("identity of last base in genome: %s" %testalignment[-1][2])
-                        raise ValueError
-                    else:    
-                        E.debug("identity of error causing base from read sequence: %s" %(read.query_alignment_sequence)[base[0]].lower())
-                        E.debug("read sequence: %s" %(read.query_alignment_sequence))
-                        E.debug("identity start and end of read as calculated from start and end as described in gtffile and extracted from fasta: %s" %(seq[(testalignment[0][1]-start):(testalignment[-1][1]-start)]))
-                        E.debug("section of the read 10 bp downstream and upstream of the sequence containing the error extracted from the fasta: %s" %(seq[((base[1]-10)-start):((base[1]+10)-start)].lower()))
-                        E.debug("filename?: %s" %(read.tostring(bamfile)))
-                        E.debug("positions of start and end of the gene based on the gtf: %s,%s" %(start, end))
-                        E.debug("identity of start of gene extratced from gtf: %s" %(seq[(base[1])-start]))
-                        E.debug("identity of error causing base from reference genome: %s" %base[2])
-                        E.debug("position of base in read: %s" %base[0])
-                        E.debug("position of base in genome: %s" %base[1])
-                        E.debug("position of base in read as calculated from position of base in genome and and start from gtf: %s" %(base[1]-start))                      
-                        E.debug("identity of error causing base (reference), calculated from fasta and testalignment info: %s" %(seq[(testalignment[0][1]-start):(testalignment[-1][1]-start)].upper()[base[0]]))
-                        #E.debug("position of base in read from first alignment genome base minus start plus position of base in in read, should equal position of base in read: %s" %((testalignment[0][1]-start) + base[0]))
-                        E.debug("identity of error causing base (reference), calculated from fasta and position of base in genome from aligned pairs: %s" %(seq[(base[1])-start]))
-                        #E.debug("position of start base in genome from the alignment minus position of start base in genome from the gtf, should be zero: %s" %(alignment[0][1]-start))
-                        E.debug("complete aligned pairs, unfiltered: %s" %(testalignment))
-                        E.debug("full fasta sequence of read: %s" %(textwrap.fill(seq,50)))
-                        raise ValueError
-                           
-                else:
-                    matched_bases[base[2].lower()] += 1
-            try:
-                if read.get_tag("NM") == 0:
-                    continue
-            except KeyError:
-                if read.get_tag("nM") == 0:
-                    continue
-            # mismatches
-            
+    if options.exons_only and not options.gene_index:
+        raise ValueError("--exons-only needs the exons from --gene-index")
 
-            readseq = read.query_sequence
+    if options.gene_index:
+        genes = MismatchIndex.GeneIndex.load(options.gene_index).genes()
+    else:
+        genes = iterate_genes(options.stdin)
+    regions = None
+    if options.genes or options.regions:
+        genes = list(select_genes(
+            genes,
+            read_gene_ids(options.genes) if options.genes else None,
+            parse_regions(options.regions) if options.regions else None))
+        regions = merge_regions(genes)
+        options.sweep = True
+        E.info("counting %i selected genes in %i regions" %
+               (len(genes), len(regions)))
 
-	    def _is_snp(base):
-                global got_snp_pos
-                global wrong_base
-                if snp_dict.has_key(base[1]):
-                    read_base = readseq[base[0]].lower()
-                    alt_base = snp_dict[base[1]][0].sequence.lower()
-                    got_snp_pos += 1
-                    if read_base != alt_base:
-                        wrong_base += 1
-                        return True
-                    else:
-                        return False                            
-                else:
-                    return True
-
-            def _is_indel(base):
-                if (len(readseq) >= (base[0] + 5)):
-                    if (len(seq) < ((base[1] - start) + 5)):
-                        upperrange = len(seq)-(base[1]-start)
-                        lowerrange = 5 - upperrange
-                        readindelwindow = readseq[(base[0] - lowerrange):(base[0] + upperrange)]
-                        seqindelwindow = seq[(base[1] - start - lowerrange):(base[1] - start + upperrange)]
-                        matchwindows = list()
-                        for i in range(len(readindelwindow)):
-                            try:
-                                matchwindows.append((readindelwindow[i].lower()==seqindelwindow[i].lower()))
-                            except IndexError:
-                                print i
-                                print readindelwindow
-                                print seqindelwindow
-                                print start
-                                print lowerrange
-                                print upperrange
-                                print base[0]
-                                print (base[0] - lowerrange)
-                                print (base[0] + upperrange)
-                                print base[1]
-                                print (base[1] - start)
-                                print ((((base[1])-start) - lowerrange)-1)
-                                print ((((base[1])-start) + upperrange)-1)
-                                print readseq
-                                print seq
-                                print gene_id
-                                print gene[0].contig                            
-                                raise
-                    elif len(seq) >= (base[1] - start + 5):
-                        readindelwindow = readseq[base[0]:(base[0]+5)]
-                        seqindelwindow = seq[(base[1] - start):(base[1] - start + 5)]
-                        matchwindows = []
-                        for i in range(len(readindelwindow)):
-                            try: 
-                                matchwindows.append(readindelwindow[i].lower()==seqindelwindow[i].lower())
-                            except IndexError:
-                                print i
-                                print readindelwindow
-                                print seqindelwindow
-                                print start
-                                print base[0]
-                                print base[1]
-                                print (base[1] - start) - 1
-                                print ((base[1] - start) + 5) - 1
-                                print readseq
-                                print seq
-                                print gene_id
-                                print gene[0].contig
-                                raise
-                    if matchwindows.count(False) >= 4:
-                        return False
-                    else:
-                        return True
-                elif (len(readseq) < (base[0] + 5)):
-                    if len(seq) < (((base[1])-start) + 5):
-                        readsequpperrange = len(readseq)-base[0]
-                        readseqlowerrange = 5 - readsequpperrange
-                        sequpperrange = len(seq) - (base[1] - start)
-                        seqlowerrange = 5 - sequpperrange
-                        if readsequpperrange < sequpperrange:
-                            upperrange = readsequpperrange
-                            lowerrange = readseqlowerrange
-                        elif sequpperrange < readsequpperrange:
-                            upperrange = sequpperrange
-                            lowerrange = seqlowerrange
-                        elif sequpperrange == readsequpperrange:
-                            upperrange = sequpperrange
-                            lowerrange = seqlowerrange                        
-                    elif ((base[1] - start) - 4) < 0:
-                        return True
-                    else:
-                        upperrange = len(readseq)-base[0]
-                        lowerrange = 5 - upperrange
-                    readindelwindow=readseq[(base[0] - lowerrange):(base[0] + upperrange)]
-                    seqindelwindow=seq[(((base[1])-start) - lowerrange):(((base[1])-start)+ upperrange)]                
-                    matchwindows=[]
-                    for i in range(len(readindelwindow)):
-                        try:
-                            matchwindows.append((readindelwindow[i].lower()==seqindelwindow[i].lower()))
-                        except IndexError:
-                            print i
-                            print readindelwindow
-                            print seqindelwindow
-                            print start
-                            print lowerrange
-                            print upperrange
-                            print base[0]
-                            print (base[0] - lowerrange)
-                            print (base[0] + upperrange)
-                            print base[1]
-                            print (base[1] - start)
-                            print ((((base[1])-start) - lowerrange))
-                            print ((((base[1])-start) + upperrange))
-                            print readseq
-                            print seq
-                            print gene_id
-                            print gene[0].contig
-                            
-                            raise
-                    if matchwindows.count(False) >= 4:
-                        return False
-                    else:
-                        return True
-
-
-            def _is_RNA_edit(base,editpositions):
-                global got_edit_pos
-                global wrong_edit_base
-                genomebase = base[2]
-                readbase = readseq[base[0]].lower()
-                
-                if not base[1] in editpositions.keys() or \
-                   genomebase == "n" or \
-                   readbase == "n" or \
-                   not genomebase.islower():
-                    return True
-                else:
-                    got_edit_pos += 1
-                    if genomebase == editpositions[base[1]].fields[0].lower() and \
-                       readbase == editpositions[base[1]].fields[1].lower():
-                        return False
-                    else:
-                        wrong_edit_base += 1
-                        return True
-
-
-            for base in total_alignment:
-                if _is_RNA_edit(base,editpositions) == False:
-                    RNA_edits += 1
-
-            mismatches = [base for base in total_alignment
-                          if base[2].islower() and
-		          qualities[base[0]] >= options.threshold and
-                          _is_snp(base) and
-                          _is_indel(base) and
-                          _is_RNA_edit(base,editpositions) and
-                          readseq[base[0]].lower() != "n"]
-
-            
-            total_mm = sum(1 for base in total_alignment
-                        if base[2].islower() and
-                        _is_snp(base) and
-                        readseq[base[0]].lower() != "n")
-            
-            hq_mm = len(mismatches)
-
-
-            for base in mismatches:
-                genomebase = base[2].lower()
-                readbase = readseq[base[0]].lower()
-                try:
-                    if strand == "-":
-                        revgenomebase = reversecomplement[genomebase]
-                        revreadbase = reversecomplement[readbase]
-                        if revgenomebase == "g" and revreadbase == "a":
-                            if read.is_reverse:
-                                reverse_g_to_t += 1
-                            else:
-                                not_reverse_g_to_t +=1
-                        transition["%s_to_%s"%(revgenomebase, revreadbase)] += 1
-                    else:
-                        transition["%s_to_%s"%(genomebase, readbase)] += 1
-                except KeyError:
-                    print transition
-                    print read.query_alignment_sequence.upper() 
-                    print seq[(alignment[0][1]-start):(alignment[-1][1]-start)].upper()
-	            print read.tostring(bamfile)
-                    raise
-
-	    
-		    
-            mm_count += hq_mm
-            skipped += total_mm - hq_mm
-
-        outline = "\t".join(map(str,[gene_id,
-                                     strand,
-                                     mm_count,
-                                     base_count,
-                                     skipped,
-                                     matched_bases['a'],
-                                     matched_bases['t'],
-                                     matched_bases['c'],
-                                     matched_bases['g'],
-                                     transition['a_to_t'],
-                                     transition['a_to_g'],
-                                     transition['a_to_c'],
-                                     transition['t_to_a'],
-                                     transition['t_to_g'],
-                                     transition['t_to_c'],
-                                     transition['g_to_a'],
-                                     transition['g_to_t'],
-                                     transition['g_to_c'],
-                                     transition['c_to_a'],
-                                     transition['c_to_t'],
-                                     transition['c_to_g'],
-                                     indel_count,
-                                     RNA_edits]))
-        options.stdout.write(outline + "\n")
+    redi = load_redi(options, regions)
+
+    if options.serve:
+        serve(options, genes, redi, regions)
+    elif options.manifest:
+        count_manifest(options, genes, redi, regions)
+    else:
+        count_sample(options, genes, open_handles(options), redi,
+                     load_variants(options, regions), options.workers)
 
-    # write footer and output benchmark information.
-    E.info("Out of %i mismatches at snp positions %i were the wrong base" %(got_snp_pos, wrong_base))
-    E.info("Out of %i mismatches at RNA edit positions %i were the wrong base" %(got_edit_pos, wrong_edit_base))
-    E.info("Out of %i g_to_c transitions on - strand genes, the read was on the + strand %i times" %
-           (not_reverse_g_to_t, reverse_g_to_t))
-    
     E.Stop()
 
 if __name__ == "__main__":
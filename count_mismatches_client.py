@@ -0,0 +1,135 @@
+'''
+count_mismatches_client.py - send a counting job to a count_mismatches.py daemon
+================================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Send a job to a daemon started with ``count_mismatches.py --serve`` and
+write the table of mismatches per gene it streams back to stdout. The
+daemon already has the genes and RNA editing sites loaded, so small jobs,
+such as a handful of genes or a new quality threshold, come back in
+seconds.
+
+Options that are not given take the values the daemon was started with.
+Paths are made absolute before they are sent, as the daemon may have been
+started from another directory.
+
+Usage
+-----
+
+Example::
+
+   python count_mismatches.py -I geneset.gtf.gz --REDI-index=redi.dir/redi
+      --genome-index=genome --serve=mismatches.sock &
+
+   python count_mismatches_client.py --socket=mismatches.sock
+      --bamfile=GTEX-AAA1-0001.bam --variant-index=variants.dir/GTEX-AAA1
+      --genes=ENSG00000002549 --quality-threshold=20
+
+Type::
+
+   python count_mismatches_client.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import sys
+import json
+import socket
+from CGAT import Experiment as E
+
+# options that are paths, made absolute before sending
+PATH_FIELDS = ["bamfile", "variant_index", "tally_path", "stats_path"]
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--socket", dest="socket", type="string",
+                      help="path of the daemon's unix socket")
+    parser.add_option("-b", "--bamfile", dest="bamfile", type="string",
+                      help="BAM file to count")
+    parser.add_option("--genes", dest="genes", type="string",
+                      help="comma separated gene ids to count, rather than "
+                      "every gene")
+    parser.add_option("-t", "--quality-threshold", dest="quality_threshold",
+                      type="int",
+                      help="minimum quality threshold for a mismatched base "
+                      "to count")
+    parser.add_option("--indel-window", dest="indel_window", type="int",
+                      help="ignore high quality mismatches within this many "
+                      "aligned bases of an indel")
+    parser.add_option("--variant-index", dest="variant_index", type="string",
+                      help="index of the donor's variants made by "
+                      "index_variants.py")
+    parser.add_option("-d", "--sample", dest="sample", type="string",
+                      help="pattern to extract the donor name from the bam "
+                      "file, if the daemon reads variants from a VCF")
+    parser.add_option("--sweep", dest="sweep", action="store_true",
+                      help="count in a single pass over each contig")
+    parser.add_option("--tally-path", dest="tally_path", type="string",
+                      help="also write per-position tallies to this file")
+    parser.add_option("--stats-path", dest="stats_path", type="string",
+                      help="write the stats of the job to this file")
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    job = {}
+    for field in ["bamfile", "quality_threshold", "indel_window",
+                  "variant_index", "sample", "sweep", "tally_path",
+                  "stats_path"]:
+        value = getattr(options, field)
+        if value is not None:
+            if field in PATH_FIELDS:
+                value = os.path.abspath(value)
+            job[field] = value
+    if options.genes:
+        job["genes"] = options.genes.split(",")
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(options.socket)
+    # the job and the status line are JSON, encoded as UTF-8, one line each
+    connection.sendall(json.dumps(job).encode("utf-8") + b"\n")
+
+    status = None
+    for line in connection.makefile("rb"):
+        if line.startswith(b"#"):
+            status = line.decode("utf-8").rstrip("\n").split("\t", 1)
+            break
+        options.stdout.write(line)
+    connection.close()
+
+    if status is None:
+        raise ValueError("daemon closed the connection before the job "
+                         "finished")
+    if status[0] == "#error":
+        raise ValueError("job failed: %s" % json.loads(status[1]))
+
+    summary = json.loads(status[1])
+    E.info("counted %i genes, %i reads" % (summary["genes"],
+                                           summary["reads"]))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,227 @@
+'''
+gather_mismatch_counts.py - join the counts of the parts of a sample
+=====================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Join the per gene counts that count_mismatches.py made for parts of the
+genome of a sample (with ``--regions``, one job per set of whole
+contigs) into the counts for the whole sample, the same as if it had
+been counted in one job.
+
+The parts are given as arguments, either tables or ``.npz`` archives.
+With ``--gene-index`` the genes are put back in the order of the
+geneset, otherwise the parts are joined in the order they are given. The
+table is written to stdout, or with ``--npz-path`` to an archive with the
+metadata of the first part.
+
+The stats and tallies of each part are read from the ``.stats.json``
+and ``.tally`` files next to it. With ``--stats-path`` the stats of the
+parts are added up: reads, aligned bases, the time spent in each stage,
+dropped reads and the summary counters, with the slowest genes of all of
+the parts. The elapsed time is the total over the parts. With
+``--tally-path`` the tallies of the parts are merged.
+
+Usage
+-----
+
+Example::
+
+   python gather_mismatch_counts.py --gene-index=geneset_all.genes
+      --stats-path=mismatches.dir/GTEX-AAA1-0001.stats.json
+      -S mismatches.dir/GTEX-AAA1-0001.tsv.gz
+      mismatches.dir/GTEX-AAA1-0001.chunk*.tsv.gz
+
+Type::
+
+   python gather_mismatch_counts.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+import json
+import heapq
+from collections import defaultdict
+from CGAT import Experiment as E
+from CGAT import IOTools
+import MismatchCounts
+import MismatchIndex
+import MismatchTallies
+
+# suffixes of the counts of a part, removed to find its stats and tallies
+COUNTS_SUFFIXES = [".tsv.gz", ".tsv", ".npz"]
+
+
+def part_prefix(path):
+    '''return the path of a part without its counts suffix'''
+
+    for suffix in COUNTS_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def read_part(path):
+    '''read the counts of a part. Returns the header, a list of rows and
+    the metadata of an archive (empty for a table).'''
+
+    if path.endswith(".npz"):
+        columns, metadata = MismatchCounts.load_counts(path)
+        header = [name for name, values in columns]
+        rows = zip(*[values.tolist() for name, values in columns])
+        return header, rows, metadata
+
+    infile = IOTools.openFile(path)
+    header = infile.readline().rstrip("\n").split("\t")
+    rows = [line.rstrip("\n").split("\t") for line in infile]
+    infile.close()
+    return header, rows, {}
+
+
+def gene_order(gene_index, rows, column):
+    '''sort `rows` by the order in the geneset of their gene id, in
+    `column`'''
+
+    ranks = gene_index.arrays["ranks"]
+
+    def _rank(row):
+        index = gene_index.find(row[column])
+        if index is None:
+            raise ValueError("gene %s is not in the gene index" %
+                             row[column])
+        return ranks[index]
+
+    rows.sort(key=_rank)
+
+
+def merge_stats(parts):
+    '''add up the stats of the parts, a list of dictionaries as written
+    by count_mismatches.py --stats-path'''
+
+    stats = {"parts": len(parts)}
+    for key in ["genes", "elapsed_seconds", "reads", "aligned_bases"]:
+        stats[key] = sum(part[key] for part in parts)
+    for key in ["stage_seconds", "dropped_reads", "counters"]:
+        totals = defaultdict(int)
+        for part in parts:
+            for name, value in part[key].iteritems():
+                totals[name] += value
+        stats[key] = dict(totals)
+
+    elapsed = stats["elapsed_seconds"]
+    stage_time = sum(stats["stage_seconds"].values())
+    stats["reads_per_second"] = stats["reads"] / elapsed if elapsed else 0
+    stats["bases_per_second"] = \
+        stats["aligned_bases"] / elapsed if elapsed else 0
+    stats["reads_per_stage_second"] = \
+        stats["reads"] / stage_time if stage_time else 0
+    stats["slowest_genes"] = heapq.nlargest(
+        max(len(part["slowest_genes"]) for part in parts),
+        [gene for part in parts for gene in part["slowest_genes"]],
+        key=lambda x: x["seconds"])
+
+    return stats
+
+
+def merge_part_tallies(paths, output_path):
+    '''merge the tallies of the parts into `output_path`. Returns the
+    number of records written.'''
+
+    readers = [MismatchTallies.TallyReader(path) for path in paths]
+    contigs = readers[0].contigs
+    for reader in readers:
+        if reader.contigs != contigs:
+            raise ValueError("contigs of %s do not match those of %s" %
+                             (reader.path, readers[0].path))
+    metadata = dict((key, value)
+                    for key, value in readers[0].header.iteritems()
+                    if key != "contigs")
+
+    with open(output_path, "wb") as outf:
+        MismatchTallies.write_header(outf, contigs, **metadata)
+        nwritten = MismatchTallies.merge_tallies(readers, outf)
+
+    for reader in readers:
+        reader.close()
+
+    return nwritten
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--gene-index", dest="gene_index", type="string",
+                      help="gene models compiled by compile_geneset.py, to "
+                      "put the genes back in the order of the geneset")
+    parser.add_option("--npz-path", dest="npz_path", type="string",
+                      help="save the counts as a columnar numpy archive at "
+                      "this path instead of writing a table to stdout")
+    parser.add_option("--stats-path", dest="stats_path", type="string",
+                      help="write the stats of the parts, added up, to this "
+                      "JSON file")
+    parser.add_option("--tally-path", dest="tally_path", type="string",
+                      help="merge the tallies of the parts into this file")
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    header, rows, metadata = None, [], {}
+    for path in args:
+        part_header, part_rows, part_metadata = read_part(path)
+        if header is None:
+            header, metadata = part_header, part_metadata
+        elif part_header != header:
+            raise ValueError("columns of %s do not match those of %s" %
+                             (path, args[0]))
+        rows.extend(part_rows)
+        E.info("read %i genes from %s" % (len(part_rows), path))
+
+    if options.gene_index:
+        gene_order(MismatchIndex.GeneIndex.load(options.gene_index), rows,
+                   header.index("gene_id"))
+
+    if options.npz_path:
+        MismatchCounts.save_counts(options.npz_path, header, rows,
+                                   **metadata)
+    else:
+        options.stdout.write("\t".join(header) + "\n")
+        for row in rows:
+            options.stdout.write("\t".join(map(str, row)) + "\n")
+
+    if options.stats_path:
+        parts = [json.load(open(part_prefix(path) + ".stats.json"))
+                 for path in args]
+        with open(options.stats_path, "w") as outf:
+            json.dump(merge_stats(parts), outf, indent=2, sort_keys=True)
+
+    if options.tally_path:
+        nwritten = merge_part_tallies(
+            [part_prefix(path) + ".tally" for path in args],
+            options.tally_path)
+        E.info("wrote %i tallies" % nwritten)
+
+    E.info("gathered %i genes from %i parts" % (len(rows), len(args)))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,74 @@
+'''
+index_genome.py - convert the reference genome into a compact index
+===================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Write the sequences of an indexed fasta file as a single array with one
+byte per base (lower case ascii), with a table of where each contig
+starts. The index is memory-mapped by count_mismatches.py
+(``--genome-index``), which then slices gene sequences straight out of it
+rather than reading them from the fasta file gene by gene. It only needs
+building once per genome, and concurrent jobs share it through the page
+cache.
+
+Usage
+-----
+
+Example::
+
+   python index_genome.py --fasta-path=hg38_noalt --index-prefix=hg38_noalt.genome
+
+Type::
+
+   python index_genome.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+from CGAT import Experiment as E
+from CGAT.IndexedFasta import IndexedFasta
+import MismatchIndex
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-f", "--fasta-path", dest="fastapath", type="string",
+                      help="path to indexed fasta file for genome of choice")
+    parser.add_option("-x", "--index-prefix", dest="prefix", type="string",
+                      help="prefix for the index files")
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    contigs = MismatchIndex.build_genome_index(
+        IndexedFasta(options.fastapath), options.prefix)
+
+    options.stdout.write("contig\tbases\n")
+    for contig, first, last in contigs:
+        options.stdout.write("%s\t%i\n" % (contig, last - first))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,69 @@
+'''
+index_redi.py - convert the REDIportal table into a compact index
+==================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Convert a BED format REDIportal table (contig, start, end, ref base, alt
+base, strand) into per-contig, per-strand sorted position arrays with the
+ref and alt bases packed into a byte. The index is memory-mapped by
+count_mismatches.py (``--REDI-index``), so it doesn't have to be loaded
+for every sample and concurrent jobs share it through the page cache.
+
+Usage
+-----
+
+Example::
+
+   python index_redi.py -I BEDREDI.txt.gz --index-prefix=redi.dir/redi
+
+Type::
+
+   python index_redi.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+from CGAT import Experiment as E
+import MismatchIndex
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-x", "--index-prefix", dest="prefix", type="string",
+                      help="prefix for the index files")
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    redi = MismatchIndex.build_redi_index(options.stdin)
+    redi.save(options.prefix)
+
+    options.stdout.write("contig\tsites\n")
+    for contig, first, last in redi.contig_rows:
+        options.stdout.write("%s\t%i\n" % (contig, last - first))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
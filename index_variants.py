@@ -0,0 +1,85 @@
+'''
+index_variants.py - extract one donor's variants from a cohort VCF
+===================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Find the donor matching a BAM file in a (multi-sample) VCF file and save
+the positions and alt bases of their non-reference sites as a compact,
+memory-mapped index for count_mismatches.py (``--variant-index``).
+
+Only the donor's genotypes are decoded, and the VCF is only read once
+per donor rather than once per gene.
+
+Usage
+-----
+
+Example::
+
+   python index_variants.py --vcf-path=cohort.vcf.gz
+                            --bamfile=deduped.dir/GTEX-1234-0001.bam
+                            --sample="deduped.dir/(.+-.+)-0001.bam"
+                            --index-prefix=variants.dir/GTEX-1234-0001.variants
+
+Type::
+
+   python index_variants.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+from CGAT import Experiment as E
+import pysam
+import MismatchIndex
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-p", "--vcf-path", dest="vcfpath", type="string",
+                      help="path to indexed vcf file for dataset  of choice")
+    parser.add_option("-b", "--bamfile", dest="bam", type="string",
+                      help="BAM file the donor name is taken from")
+    parser.add_option("-d", "--sample", dest="samppattern", type="string",
+                      help="pattern to match and extract the donor name from the bam file, for use in parsing the vcf file")
+    parser.add_option("-x", "--index-prefix", dest="prefix", type="string",
+                      help="prefix for the index files")
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    samples = list(pysam.VariantFile(options.vcfpath).header.samples)
+    donorid = MismatchIndex.find_donor(samples, options.bam,
+                                       options.samppattern)
+    E.info("indexing variants for donor %s" % donorid)
+
+    variants = MismatchIndex.build_variant_index(options.vcfpath, donorid)
+    variants.save(options.prefix)
+
+    options.stdout.write("contig\tsites\n")
+    for contig, first, last in variants.contig_rows:
+        options.stdout.write("%s\t%i\n" % (contig, last - first))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
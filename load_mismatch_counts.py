@@ -0,0 +1,257 @@
+'''
+load_mismatch_counts.py - load mismatch counts into the database
+=================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Load the per gene counts of many samples, either ``.npz`` archives
+written by ``count_mismatches.py --npz-path`` or the tables it writes,
+into a single sqlite table. The typed columns of archives are inserted
+directly, so nothing is formatted as text or parsed again on the way in.
+Tables are streamed into the database a line at a time, so only one
+sample is ever held in memory, whatever the number of samples.
+
+The sample name, stored in each archive or taken from the name of each
+table without its directory and suffix, is split with ``--regex-sample``
+into the columns named by ``--cat``, which are added in front of the
+count columns (by default tissue, replicate and sample, as the
+pipeline's BAM files are named ``tissue-replicate-sample.bam``).
+
+Each sample is loaded in one transaction, with sqlite's syncing to disk
+turned off and the rollback journal kept in memory, and the indexes
+given with ``--add-index`` are created once all the rows are in.
+
+With ``--append`` the table is kept, and the samples already in it (as
+listed in ``<table>_samples``, which records the file each sample was
+loaded from and when it was changed) are skipped. Samples whose file
+has changed since are deleted and loaded again. The indexes of an
+existing table are kept up to date as the new samples go in.
+
+A summary with the number of genes loaded from each file is written to
+stdout.
+
+Usage
+-----
+
+Example::
+
+   python load_mismatch_counts.py --database=csvdb --table=mismatch_counts
+      -i gene_id mismatches.dir/*.npz
+
+Type::
+
+   python load_mismatch_counts.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import sys
+import re
+import sqlite3
+import contextlib
+import numpy as np
+from CGAT import Experiment as E
+from CGAT import IOTools
+import MismatchCounts
+
+# suffixes of counts tables, removed to give the sample name
+TABLE_SUFFIXES = [".tsv.gz", ".tsv"]
+
+
+def counts_sample(path):
+    '''return the sample name of the counts in `path`, read from the
+    ``sample`` member of an archive alone or taken from the name of a
+    table'''
+
+    if path.endswith(".npz"):
+        archive = np.load(path)
+        sample = archive["sample"].item()
+        archive.close()
+        return sample
+
+    sample = os.path.basename(path)
+    for suffix in TABLE_SUFFIXES:
+        if sample.endswith(suffix):
+            return sample[:-len(suffix)]
+    return sample
+
+
+@contextlib.contextmanager
+def read_counts(path):
+    '''open the counts in `path`, giving the column names and an iterator
+    over the rows as tuples. A table is closed again on leaving the
+    context.'''
+
+    if path.endswith(".npz"):
+        columns, metadata = MismatchCounts.load_counts(path)
+        names = [name for name, values in columns]
+        yield names, iter(zip(*[values.tolist() for name, values in columns]))
+        return
+
+    infile = IOTools.openFile(path)
+    try:
+        names = infile.readline().rstrip("\n").split("\t")
+        yield names, (tuple(line.rstrip("\n").split("\t"))
+                      for line in infile)
+    finally:
+        infile.close()
+
+
+def table_columns(cc, table):
+    '''return the column names of `table`, or None if there is no such
+    table'''
+
+    columns = [row[1] for row in
+               cc.execute("PRAGMA table_info(%s)" % table).fetchall()]
+    return columns or None
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--database", dest="database", type="string",
+                      help="sqlite database to load the counts into")
+    parser.add_option("--table", dest="table", type="string",
+                      default="mismatch_counts",
+                      help="name of the table to create")
+    parser.add_option("--regex-sample", dest="regex_sample", type="string",
+                      default="(.+)-(.+)-(.+)",
+                      help="regular expression splitting sample names into "
+                      "the columns given by --cat")
+    parser.add_option("--cat", dest="cat", type="string",
+                      default="tissue,replicate,sample",
+                      help="comma separated names of the columns taken from "
+                      "the sample name")
+    parser.add_option("-i", "--add-index", dest="indices", action="append",
+                      default=[],
+                      help="create an index on this column. Can be given "
+                      "more than once")
+    parser.add_option("--append", dest="append", action="store_true",
+                      default=False,
+                      help="keep the table and only load the samples that "
+                      "are not in it yet, or whose file has changed")
+    parser.add_option("--cache-size", dest="cache_size", type="int",
+                      default=256,
+                      help="megabytes of sqlite page cache to use")
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    sample_columns = options.cat.split(",")
+    regex_sample = re.compile(options.regex_sample)
+    samples_table = options.table + "_samples"
+
+    dbh = sqlite3.connect(options.database)
+    cc = dbh.cursor()
+    cc.execute("PRAGMA synchronous = OFF")
+    cc.execute("PRAGMA journal_mode = MEMORY")
+    cc.execute("PRAGMA cache_size = -%i" % (options.cache_size * 1024))
+
+    header = table_columns(cc, options.table)
+    loaded = {}
+    if options.append and header is not None:
+        if table_columns(cc, samples_table) is None:
+            E.warn("%s has no record of its samples, loading it again" %
+                   options.table)
+            header = None
+        else:
+            loaded = dict(cc.execute(
+                "SELECT sample, mtime FROM %s" % samples_table).fetchall())
+    if not options.append or header is None:
+        cc.execute("DROP TABLE IF EXISTS %s" % options.table)
+        cc.execute("DROP TABLE IF EXISTS %s" % samples_table)
+        cc.execute("CREATE TABLE %s (sample TEXT PRIMARY KEY, file TEXT, "
+                   "mtime REAL, genes INT)" % samples_table)
+        header = None
+    dbh.commit()
+
+    options.stdout.write("file\tsample\tgenes\n")
+    nskipped = 0
+    for infile in args:
+        mtime = os.path.getmtime(infile)
+        sample = counts_sample(infile)
+        if loaded.get(sample) == mtime:
+            nskipped += 1
+            continue
+
+        match = regex_sample.search(sample)
+        if match is None:
+            raise ValueError("sample name %s of %s does not match %s" %
+                             (sample, infile, options.regex_sample))
+        sample_values = match.groups()
+
+        # counted in the generator as executemany doesn't set rowcount
+        ngenes = [0]
+
+        with read_counts(infile) as (names, rows):
+            if header is None:
+                header = sample_columns + names
+                types = ["TEXT"] * len(sample_columns) + \
+                    ["TEXT" if name in MismatchCounts.STRING_COLUMNS
+                     else "INT" for name in names]
+                cc.execute("CREATE TABLE %s (%s)" % (
+                    options.table,
+                    ", ".join("%s %s" % column for column in
+                              zip(header, types))))
+            elif sample_columns + names != header:
+                raise ValueError("columns of %s do not match those of %s" %
+                                 (infile, options.table))
+            insert = "INSERT INTO %s VALUES (%s)" % (
+                options.table, ", ".join(["?"] * len(header)))
+
+            if sample in loaded:
+                E.info("%s has changed, loading it again" % infile)
+                cc.execute("DELETE FROM %s WHERE %s" % (
+                    options.table,
+                    " AND ".join("%s = ?" % column
+                                 for column in sample_columns)),
+                    sample_values)
+
+            def _rows():
+                for row in rows:
+                    ngenes[0] += 1
+                    yield sample_values + row
+
+            cc.executemany(insert, _rows())
+
+        cc.execute("INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?)" %
+                   samples_table, (sample, infile, mtime, ngenes[0]))
+        dbh.commit()
+        loaded[sample] = mtime
+
+        options.stdout.write("%s\t%s\t%i\n" % (infile, sample, ngenes[0]))
+
+    if nskipped:
+        E.info("skipped %i samples that were already loaded" % nskipped)
+
+    for column in options.indices:
+        cc.execute("CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)" % (
+            options.table, column, options.table, column))
+
+    dbh.commit()
+    cc.close()
+    dbh.close()
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
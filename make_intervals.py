@@ -0,0 +1,150 @@
+'''
+make_intervals.py - split a BAM file into chunks with similar numbers of reads
+===============================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Split the genome into ``--chunks`` sets of intervals, each with about the
+same number of mapped reads in the BAM file, so that a per-sample job
+(such as GATK SplitNCigarReads or HaplotypeCaller) can be scattered over
+them. Read counts come from the BAM index, so no reads are read.
+
+Chunks are runs of consecutive contigs in the order of the BAM header,
+and contigs with more reads than a chunk should hold are split into
+equal length pieces, so the results of the chunks can be joined back
+together in chunk order. Contigs without any mapped reads are left out.
+
+With ``--whole-contigs`` contigs are never split, and those without any
+mapped reads are kept, so that every contig in the BAM header is in one
+of the chunks. This is how the pipeline scatters count_mismatches.py,
+whose genes must not be split between chunks.
+
+Each chunk is written to ``<prefix>.chunk<n>.intervals`` as a GATK
+interval list, with one contig:start-end interval per line, or with
+``--output-format=bed`` to ``<prefix>.chunk<n>.bed`` as a BED file. A
+summary of the number of intervals and estimated reads in each chunk
+goes to stdout.
+
+Usage
+-----
+
+Example::
+
+   python make_intervals.py --bamfile=deduped.dir/GTEX-AAA1-0001.bam
+      --chunks=8 --output-prefix=split.dir/GTEX-AAA1-0001
+
+Type::
+
+   python make_intervals.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+import math
+import pysam
+from CGAT import Experiment as E
+
+
+def split_contigs(stats, chunks, whole_contigs=False):
+    '''split contigs into `chunks` runs of intervals with about the same
+    number of reads. `stats` is a list of (contig, length, reads) tuples in
+    the order of the genome. If `whole_contigs` is set, contigs are not
+    split and contigs without reads are kept. Returns a list of chunks,
+    each a list of (contig, start, end, reads) tuples with 0-based half
+    open coordinates.'''
+
+    total = sum(reads for contig, length, reads in stats)
+    target = float(total) / chunks or 1.0
+
+    pieces = []
+    for contig, length, reads in stats:
+        if whole_contigs:
+            pieces.append((contig, 0, length, float(reads)))
+            continue
+        if reads == 0:
+            continue
+        npieces = min(length, int(math.ceil(reads / target)))
+        for i in range(npieces):
+            pieces.append((contig,
+                           length * i // npieces,
+                           length * (i + 1) // npieces,
+                           float(reads) / npieces))
+
+    # pieces go to the chunk their middle falls in, so chunks are runs of
+    # consecutive pieces
+    assigned = [[] for i in range(chunks)]
+    done = 0.0
+    for piece in pieces:
+        index = min(chunks - 1, int((done + piece[3] / 2) / target))
+        assigned[index].append(piece)
+        done += piece[3]
+
+    return [chunk for chunk in assigned if chunk]
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-b", "--bamfile", dest="bam", type="string",
+                      help="indexed BAM file to balance the chunks for")
+    parser.add_option("-n", "--chunks", dest="chunks", type="int",
+                      default=8,
+                      help="number of chunks to split the genome into")
+    parser.add_option("-x", "--output-prefix", dest="prefix", type="string",
+                      help="prefix for the interval list of each chunk")
+    parser.add_option("--whole-contigs", dest="whole_contigs",
+                      action="store_true", default=False,
+                      help="don't split contigs between chunks, and keep "
+                      "contigs without reads")
+    parser.add_option("--output-format", dest="output_format",
+                      type="choice", choices=("intervals", "bed"),
+                      default="intervals",
+                      help="write GATK interval lists or BED files")
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    bamfile = pysam.AlignmentFile(options.bam)
+    lengths = dict(zip(bamfile.references, bamfile.lengths))
+    stats = [(stat.contig, lengths[stat.contig], stat.mapped)
+             for stat in bamfile.get_index_statistics()]
+
+    chunks = split_contigs(stats, options.chunks, options.whole_contigs)
+
+    options.stdout.write("chunk\tintervals\treads\n")
+    for index, chunk in enumerate(chunks):
+        name = "%s.chunk%03i.%s" % (options.prefix, index,
+                                    options.output_format)
+        with open(name, "w") as outf:
+            for contig, start, end, reads in chunk:
+                if options.output_format == "bed":
+                    outf.write("%s\t%i\t%i\n" % (contig, start, end))
+                else:
+                    outf.write("%s:%i-%i\n" % (contig, start + 1, end))
+        options.stdout.write("%s\t%i\t%i\n" % (
+            name, len(chunk), sum(reads for contig, start, end, reads
+                                  in chunk)))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
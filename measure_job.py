@@ -0,0 +1,222 @@
+'''
+measure_job.py - measure the resource use of a running pipeline job
+===================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Watch a pipeline job while it runs and write the peak memory, CPU time,
+run time and exit status of the job to ``--measure-path`` as JSON, for
+the pipeline to size later jobs of the same task from (see
+JobResources.py).
+
+The job is the shell with process id ``--pid`` and everything it starts.
+Every ``--interval`` seconds the memory of all of the processes below
+the shell is added up, so jobs of several processes running side by
+side (pipes, or count_mismatches.py with several workers) are measured
+as a whole. The proportional set size is used where the kernel reports
+it, so memory shared between processes, such as the pages of an index
+mapped by several workers, is only counted once; otherwise the resident
+set size. Peaks shorter than the interval can be missed.
+
+The job's shell writes its exit status to ``--status-path`` once it has
+finished, which tells this script to stop watching. The job's stderr,
+saved to ``--stderr-path``, is then searched for messages saying it ran
+out of memory. The CPU time is that of the shell and all of the
+processes it waited for.
+
+If the job's shell goes away before it writes its status, as when the
+cluster kills the job, nothing is written.
+
+Usage
+-----
+
+The pipeline starts it in the background of a job, as in::
+
+   python measure_job.py --pid=$$ --measure-path=resources.dir/job.json
+      --status-path=resources.dir/job.json.status
+      --stderr-path=resources.dir/job.json.err
+      -L resources.dir/job.json.log &
+
+Type::
+
+   python measure_job.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import sys
+import json
+import time
+from CGAT import Experiment as E
+import JobResources
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+CLOCK_TICKS = float(os.sysconf("SC_CLK_TCK"))
+
+
+def read_stat(pid):
+    '''return the fields of /proc/`pid`/stat after the command name,
+    or None if there is no such process'''
+
+    try:
+        with open("/proc/%i/stat" % pid) as inf:
+            stat = inf.read()
+    except IOError:
+        return None
+
+    # the command name is in brackets and may contain spaces
+    return stat[stat.rindex(")") + 2:].split()
+
+
+def descendants(pid):
+    '''return the process ids of every process below `pid`'''
+
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        stat = read_stat(int(name))
+        if stat is not None:
+            children.setdefault(int(stat[1]), []).append(int(name))
+
+    found = []
+    waiting = [pid]
+    while waiting:
+        for child in children.get(waiting.pop(), []):
+            found.append(child)
+            waiting.append(child)
+
+    return found
+
+
+def process_memory(pid):
+    '''return the proportional set size of `pid` in bytes, or the
+    resident set size if the kernel doesn't report it, or 0 if the
+    process has gone'''
+
+    try:
+        with open("/proc/%i/smaps_rollup" % pid) as inf:
+            for line in inf:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    try:
+        with open("/proc/%i/statm" % pid) as inf:
+            return int(inf.read().split()[1]) * PAGE_SIZE
+    except IOError:
+        return 0
+
+
+def tree_memory(pid, exclude):
+    '''return the memory in bytes of `pid` and every process below it,
+    leaving out the processes in `exclude`'''
+
+    return sum(process_memory(process)
+               for process in [pid] + descendants(pid)
+               if process not in exclude)
+
+
+def cpu_seconds(pid):
+    '''return the CPU time of `pid` and every child it has waited for'''
+
+    stat = read_stat(pid)
+    return sum(int(ticks) for ticks in stat[11:15]) / CLOCK_TICKS
+
+
+def read_status(path):
+    '''return the exit status written to `path`, or None if it hasn't
+    been written yet'''
+
+    if not os.path.exists(path):
+        return None
+    with open(path) as inf:
+        status = inf.read().strip()
+    return int(status) if status else None
+
+
+def memory_error(path):
+    '''return True if the stderr of the job, saved to `path`, says it ran
+    out of memory'''
+
+    if not os.path.exists(path):
+        return False
+    with open(path) as inf:
+        for line in inf:
+            if any(message in line
+                   for message in JobResources.OOM_MESSAGES):
+                return True
+    return False
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--pid", dest="pid", type="int",
+                      help="process id of the shell running the job")
+    parser.add_option("--measure-path", dest="measure_path", type="string",
+                      help="write the measurements of the job to this file")
+    parser.add_option("--status-path", dest="status_path", type="string",
+                      help="the job writes its exit status to this file "
+                      "when it finishes")
+    parser.add_option("--stderr-path", dest="stderr_path", type="string",
+                      help="the stderr of the job, searched for messages "
+                      "saying it ran out of memory")
+    parser.add_option("--interval", dest="interval", type="float",
+                      default=1.0,
+                      help="seconds between measurements of the job's "
+                      "memory")
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    started = time.time()
+    exclude = set([os.getpid()])
+    peak = 0
+    status = read_status(options.status_path)
+    while status is None:
+        if read_stat(options.pid) is None:
+            E.warn("job %i went away without an exit status" % options.pid)
+            E.Stop()
+            return 1
+        peak = max(peak, tree_memory(options.pid, exclude))
+        time.sleep(options.interval)
+        status = read_status(options.status_path)
+
+    seconds = time.time() - started
+    with open(options.measure_path, "w") as outf:
+        json.dump({"max_rss_bytes": peak,
+                   "cpu_seconds": cpu_seconds(options.pid),
+                   "seconds": seconds,
+                   "status": status,
+                   "memory_error": memory_error(options.stderr_path)}, outf)
+
+    E.info("job finished with status %i in %.1f seconds, peak memory %s" %
+           (status, seconds, JobResources.memory_string(peak)))
+
+    E.Stop()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,98 @@
+'''
+merge_mismatch_tallies.py - merge per-position mismatch tallies
+================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+Merge tally files written by ``count_mismatches.py --tally-path`` (or by
+this script) into a single tally file. Records for the same position,
+strand and read base are combined by adding up their high and low quality
+counts, depths and number of samples, so recurrent sites stand out.
+
+The merge streams through the inputs a chunk at a time, so any number of
+samples can be merged in a fixed amount of memory. All the inputs must
+have been counted against the same reference (the same contigs in the
+same order).
+
+Note that the depth of a merged record only includes samples with a
+mismatch at the site.
+
+A summary of the number of records read from each input and written to
+the output goes to stdout.
+
+Usage
+-----
+
+Example::
+
+   python merge_mismatch_tallies.py --output-path=all.tally tallies.dir/*.tally
+
+Type::
+
+   python merge_mismatch_tallies.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+from CGAT import Experiment as E
+import MismatchTallies
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-o", "--output-path", dest="output_path",
+                      type="string",
+                      help="path of the merged tally file")
+    parser.add_option("--chunk-size", dest="chunk_size", type="int",
+                      default=1000000,
+                      help="number of records to read from each input at a "
+                      "time")
+
+    (options, args) = E.Start(parser, argv=argv)
+
+    readers = [MismatchTallies.TallyReader(infile) for infile in args]
+    contigs = readers[0].contigs
+    samples = []
+    for reader in readers:
+        if reader.contigs != contigs:
+            raise ValueError("contigs of %s do not match those of %s" %
+                             (reader.path, readers[0].path))
+        samples.extend(reader.header.get("samples",
+                                         [reader.header.get("sample")]))
+
+    with open(options.output_path, "wb") as outf:
+        MismatchTallies.write_header(outf, contigs, samples=samples)
+        nwritten = MismatchTallies.merge_tallies(readers, outf,
+                                                 options.chunk_size)
+
+    options.stdout.write("file\trecords\n")
+    for reader in readers:
+        reader.close()
+        options.stdout.write("%s\t%i\n" % (reader.path, reader.records_read))
+    options.stdout.write("%s\t%i\n" % (options.output_path, nwritten))
+
+    E.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,36 @@
+import glob
+import os
+import re
+import numpy as np
+from CGATReport.Tracker import Tracker
+from CGATReport.Utils import PARAMS as P
+
+DATADIR = P.get("datadir", ".")
+
+
+class MismatchRates(Tracker):
+    '''per gene mismatch rates, read directly from the columnar count
+    files in mismatches.dir. Each sample is a track, and the counts of
+    the chunks a sample was counted in are left out. Genes with fewer
+    than `min_bases` high quality bases are skipped.'''
+
+    pattern = os.path.join(DATADIR, "mismatches.dir", "*.npz")
+    chunk_pattern = re.compile(r"\.chunk\d+$")
+    min_bases = 1000
+
+    @property
+    def tracks(self):
+        tracks = [os.path.basename(x)[:-len(".npz")]
+                  for x in glob.glob(self.pattern)]
+        return sorted(track for track in tracks
+                      if not self.chunk_pattern.search(track))
+
+    def __call__(self, track):
+        counts = np.load(os.path.join(DATADIR, "mismatches.dir",
+                                      track + ".npz"))
+        mismatches = counts["mismatches"]
+        bases = counts["bases"]
+        keep = bases >= self.min_bases
+
+        return {"mismatch_rate":
+                (mismatches[keep] / bases[keep].astype(float)).tolist()}
@@ -75,7 +75,7 @@ software to be in the path:
 
 Requirements:
 
-* samtools >= 1.1
+* samtools >= 1.14 (slim_bams uses ``view -e`` and ``--keep-tag``)
 
 Pipeline output
 ===============
@@ -97,9 +97,11 @@ from ruffus import *
 import sys
 import os
 import sqlite3
+import tempfile
 import CGAT.Experiment as E
 import CGATPipelines.Pipeline as P
 import re
+import JobResources
 
 # load options from the config file
 PARAMS = P.getParameters(
@@ -134,6 +136,24 @@ PARAMS.update(P.peekParameters(
 # Note that this is a hack and deprecated, better pass all
 # parameters that are needed by a function explicitely.
 
+# per gene counts are either gzipped tables or columnar numpy archives
+if PARAMS["mismatch_columnar"]:
+    COUNTS_SUFFIX = ".npz"
+else:
+    COUNTS_SUFFIX = ".tsv.gz"
+
+# the gene models compiled from the geneset are kept in the working
+# directory, as the geneset may be shared and not writable
+GENE_INDEX = os.path.join(
+    "geneset.dir",
+    re.sub(r"\.gtf(\.gz)?$", "", os.path.basename(PARAMS["gtf"])) + ".genes")
+
+# the peak memory and run time of the jobs sized by run_sized are
+# recorded here, and later jobs are sized from them
+RESOURCE_DIR = "resources.dir"
+RESOURCE_HISTORY = os.path.join(RESOURCE_DIR, "history.tsv")
+
+
 # -----------------------------------------------
 # Utility functions
 def connect():
@@ -155,15 +175,147 @@ def connect():
     return dbh
 
 
+def mismatch_options(regions):
+    '''options for count_mismatches.py from the [mismatch] section of
+    the config file that are shared by all the counting tasks. The chunk
+    of contigs in the bed file `regions` is only passed on if the
+    samples are scattered over several chunks, as count_mismatches.py
+    always sweeps when it counts a selection of the genes.'''
+
+    options = ["--indel-window=%s" % PARAMS["mismatch_indel_window"],
+               "--prefetch=%s" % PARAMS["mismatch_prefetch"]]
+    if PARAMS["mismatch_scatter"] > 1:
+        options.append("--regions=%s" % regions)
+    if PARAMS["mismatch_sweep"]:
+        options.append("--sweep")
+    if PARAMS["mismatch_exons_only"]:
+        options.append("--exons-only")
+
+    return " ".join(options)
+
+
+def mismatch_output(outfile, checkpoint=True):
+    '''the count_mismatches.py (or gather_mismatch_counts.py) options that
+    send its counts to `outfile`, and its per-position tallies to a .tally
+    file next to it if they are wanted. Timings and throughput go to a
+    .stats.json file next to it. With checkpointing on, a job that is run
+    again picks up from the journal its last attempt left behind.'''
+
+    if outfile.endswith(".npz"):
+        options = ["--npz-path=%s" % outfile]
+    else:
+        options = ["-S %s" % outfile]
+
+    options.append("--stats-path=%s.stats.json" %
+                   P.snip(outfile, COUNTS_SUFFIX))
+
+    if PARAMS["mismatch_tallies"]:
+        options.append("--tally-path=%s" % tally_file(outfile))
+
+    if checkpoint and PARAMS["mismatch_checkpoint"]:
+        options.append("--checkpoint=%s.checkpoint --resume" % outfile)
+
+    return " ".join(options)
+
+
+def tally_file(outfile):
+    '''the per-position tally file written alongside the counts in
+    `outfile`'''
+    return P.snip(outfile, COUNTS_SUFFIX) + ".tally"
+
+
+def run_sized(task, statement, infiles, values, job_memory, job_threads=1,
+              max_threads=None):
+    '''run `statement` of `task` with P.run, with `job_memory` and
+    `job_threads`. P.run fills in the statement from `values`, the
+    task's locals, as it would have from the task itself. The statement
+    can also use %(job_threads)s, and %(java_heap)s for the -Xmx setting
+    of a JVM.
+
+    With [resources] auto on, the task's earlier jobs in RESOURCE_HISTORY
+    are used to size the job by the size of `infiles` (see
+    JobResources.py): its memory, and its threads up to `max_threads` if
+    it is given. The job is measured by measure_job.py, its peak memory
+    and run time are added to the history, and if it runs out of memory
+    it is run again on the next memory tier up. The measurements of jobs
+    that fail are left in RESOURCE_DIR.'''
+
+    values = dict(values)
+
+    if not PARAMS["resources_auto"]:
+        values.update(statement=statement, job_memory=job_memory,
+                      job_threads=job_threads,
+                      java_heap=JobResources.java_heap(
+                          JobResources.memory_bytes(job_memory)))
+        P.run(**values)
+        return
+
+    size = JobResources.input_bytes(infiles)
+    jobs = JobResources.read_history(RESOURCE_HISTORY, task)
+    tiers = [JobResources.memory_bytes(tier + "G")
+             for tier in str(PARAMS["resources_tiers"]).split(",")]
+    min_history = PARAMS["resources_min_history"]
+    if max_threads:
+        job_threads = JobResources.job_threads(
+            jobs, size, job_threads, max_threads,
+            PARAMS["resources_target_minutes"] * 60, min_history)
+    memory = JobResources.job_memory(
+        jobs, size, job_memory, PARAMS["resources_margin"], tiers,
+        job_threads, min_history)
+
+    JobResources.make_directory(RESOURCE_DIR)
+    while True:
+        handle, measure_path = tempfile.mkstemp(
+            dir=RESOURCE_DIR, prefix=task + ".", suffix=".json")
+        os.close(handle)
+        job_memory = JobResources.memory_string(memory)
+        values.update(statement=JobResources.measured_statement(statement),
+                      measure_path=measure_path, job_memory=job_memory,
+                      job_threads=job_threads,
+                      java_heap=JobResources.java_heap(memory))
+        E.info("running %s with %s of memory and %i threads" %
+               (task, job_memory, job_threads))
+
+        try:
+            P.run(**values)
+        except Exception:
+            measured = JobResources.read_measurements(measure_path)
+            if measured is None or \
+               not JobResources.out_of_memory(measured):
+                raise
+            JobResources.record(
+                RESOURCE_HISTORY, task=task, input_bytes=size,
+                threads=job_threads, memory_bytes=memory, **measured)
+
+            larger = JobResources.next_tier(memory, tiers)
+            if larger is None:
+                raise
+            E.warn("%s ran out of memory with %s, running it again with %s" %
+                   (task, job_memory, JobResources.memory_string(larger)))
+            memory = larger
+            continue
+
+        measured = JobResources.read_measurements(measure_path)
+        if measured is not None:
+            JobResources.record(
+                RESOURCE_HISTORY, task=task, input_bytes=size,
+                threads=job_threads, memory_bytes=memory, **measured)
+        for suffix in ["", ".status", ".err", ".log"]:
+            if os.path.exists(measure_path + suffix):
+                os.unlink(measure_path + suffix)
+        return
+
+
 # ---------------------------------------------------
 # Specific pipeline tasks
 
+@active_if(not(PARAMS["dedup_fused"]))
 @follows(mkdir("readgroups.dir"))
 @transform("*.bam",regex(r"(.+).bam"),r"readgroups.dir/\1.readgroups.bam")
 def add_read_groups(infile, outfile):
     platform = PARAMS["platform"]
     groupsample = PARAMS["groupsample"]
-    statement = '''java -jar /shared/sudlab1/General/apps/bio/picard-tools-1.135/picard.jar
+    statement = '''java -Xmx%(java_heap)s -jar /shared/sudlab1/General/apps/bio/picard-tools-1.135/picard.jar
                    AddOrReplaceReadGroups
                    I=%(infile)s
                    O=%(outfile)s
@@ -172,11 +324,11 @@ def add_read_groups(infile, outfile):
                    RGPU=unit1
                    RGSM=%(groupsample)s'''
 
-    job_memory = "4G"
-    P.run()
+    run_sized("add_read_groups", statement, infile, locals(), "4G")
 
 
 
+@active_if(not(PARAMS["dedup_fused"]))
 @follows(mkdir("deduped.dir"))
 @transform(add_read_groups,
            regex(r"readgroups.dir/(.+).readgroups.bam"),
@@ -205,29 +357,129 @@ def dedup_bams(infile, outfile):
 
                                 samtools index %(outfile)s'''
 
-    job_memory = "15G"
-    P.run()
+    run_sized("dedup_bams", statement, infile, locals(), "15G")
+
+
+@active_if(PARAMS["dedup_fused"])
+@follows(mkdir("deduped.dir"))
+@transform("*.bam", regex(r"(.+).bam"), r"deduped.dir/\1.bam")
+def fused_dedup_bams(infile, outfile):
+    '''Add read groups and remove duplicates in a single stream of samtools
+    commands, instead of add_read_groups and dedup_bams, so that only the
+    final indexed BAM file is written. Reads are grouped by name for
+    fixmate to add the mate tags markdup needs, then sorted by position
+    and duplicates removed'''
+    platform = PARAMS["platform"]
+    groupsample = PARAMS["groupsample"]
+    threads = PARAMS["dedup_threads"]
+    sort_memory = PARAMS["dedup_sort_memory"]
+    tmpprefix = os.path.join(PARAMS["tmpdir"],
+                             os.path.basename(P.snip(outfile, ".bam")))
+    metrics = P.snip(outfile, ".bam") + ".metrics.tsv"
+    statement = '''samtools addreplacerg
+                                -r 'ID:1' -r 'LB:lib1' -r 'PL:%(platform)s'
+                                -r 'PU:unit1' -r 'SM:%(groupsample)s'
+                                -O bam,level=0
+                                -o -
+                                %(infile)s
+                  | samtools collate
+                                -@ %(threads)s
+                                -O -u
+                                - %(tmpprefix)s.collate
+                  | samtools fixmate
+                                -@ %(threads)s
+                                -m
+                                -O bam,level=0
+                                - -
+                  | samtools sort
+                                -@ %(threads)s
+                                -m %(sort_memory)s
+                                -l 0
+                                -T %(tmpprefix)s.sort
+                                -
+                  | samtools markdup
+                                -@ %(threads)s
+                                -r
+                                -f %(metrics)s
+                                -T %(tmpprefix)s.markdup
+                                - %(outfile)s
+                                2> %(outfile)s.log;
+
+                    checkpoint;
+
+                                samtools index -@ %(threads)s %(outfile)s'''
+    run_sized("fused_dedup_bams", statement, infile, locals(),
+              PARAMS["dedup_memory"], threads)
+
+
+@follows(mkdir("slim.dir"))
+@transform([dedup_bams, fused_dedup_bams],
+           regex(r"deduped.dir/(.+).bam"),
+           r"slim.dir/\1.bam")
+def slim_bams(infile, outfile):
+    '''Keep only the reads and tags that count_mismatches.py uses: mapped,
+    non-duplicate reads with a mapped mate and a single alignment (NH of
+    1), carrying just their MD, NM, nM and NH tags'''
+    threads = PARAMS["mismatch_slim_threads"]
+    statement = '''samtools view
+                                -@ %(threads)s
+                                -b
+                                -F 1036
+                                -e '[NH] == 1'
+                                --keep-tag MD,NM,nM,NH
+                                -o %(outfile)s
+                                %(infile)s;
+
+                    checkpoint;
+
+                                samtools index -@ %(threads)s %(outfile)s'''
+    run_sized("slim_bams", statement, infile, locals(), "2G", threads)
+
 
 @active_if(not(PARAMS['vcfavail']))
 @follows(mkdir("split.dir"))
-@transform(dedup_bams,regex(r"deduped.dir/(.+).bam"),r"split.dir/\1.split.bam")
-def splitbams(infile,outfile):
-    '''use GATK splitNcigar to split reads into exon segements'''
+@subdivide([dedup_bams, fused_dedup_bams],
+           regex(r"deduped.dir/(.+).bam"),
+           r"split.dir/\1.chunk*.intervals",
+           r"split.dir/\1")
+def make_intervals(infile, outfiles, prefix):
+    '''Split the genome into chunks with about the same number of reads in
+    the sample, going by the BAM index, for splitbams and variantcalling to
+    be scattered over'''
+    chunks = PARAMS["variantcalling_chunks"]
+    statement = '''python %(projectsrc)s/make_intervals.py
+                                         --bamfile=%(infile)s
+                                         --chunks=%(chunks)s
+                                         --output-prefix=%(prefix)s
+                                         -S %(prefix)s.intervals.tsv
+                                         -L %(prefix)s.intervals.log'''
+    job_memory = "2G"
+    P.run()
+
+
+@transform(make_intervals,
+           regex(r"split.dir/(.+)\.(chunk\d+).intervals"),
+           add_inputs(r"deduped.dir/\1.bam"),
+           r"split.dir/\1.\2.split.bam")
+def splitbams(infiles,outfile):
+    '''use GATK splitNcigar to split reads into exon segements, one chunk
+    of the genome at a time'''
+    intervals, infile = infiles
     fasta = os.path.join(PARAMS["fasta"],PARAMS["genome"]) + ".fasta"
     fastamap = PARAMS["mapfasta"]
     drctry= PARAMS["tmpdir"]
-    statement = '''java -Xmx10G -Djava.io.tmpdir=%(drctry)s -jar ~/Downloads/GenomeAnalysisTK-3.8-0-ge9d806836/GenomeAnalysisTK.jar
+    statement = '''java -Xmx%(java_heap)s -Djava.io.tmpdir=%(drctry)s -jar ~/Downloads/GenomeAnalysisTK-3.8-0-ge9d806836/GenomeAnalysisTK.jar
                    -T SplitNCigarReads 
                    -R %(fastamap)s
                    -I %(infile)s 
+                   -L %(intervals)s
                    -o %(outfile)s 
                    -rf ReassignOneMappingQuality 
                    -RMQF 255 
                    -RMQT 60
                    -U ALLOW_N_CIGAR_READS'''
 
-    job_memory = "12G"
-    P.run()
+    run_sized("splitbams", statement, infile, locals(), "12G")
 
 #@follows(mkdir("BaseRecalibration.dir"))
 #@transform(splitbams,regex(r"split.dir/(.+).split.bam"),r"BaseRecalibration.dir/\1.recal.bam")
@@ -246,16 +498,22 @@ def splitbams(infile,outfile):
 #    P.run()               
 
 @follows(mkdir("Variantcalls.dir"))
-@transform(splitbams,regex(r"split.dir/(.+).split.bam"),r"Variantcalls.dir/\1.vcf.gz")
-def variantcalling(infile,outfile):
+@transform(splitbams,
+           regex(r"split.dir/(.+).split.bam"),
+           add_inputs(r"split.dir/\1.intervals"),
+           r"Variantcalls.dir/\1.vcf.gz")
+def variantcalling(infiles,outfile):
+    '''call variants with HaplotypeCaller in one chunk of the genome'''
+    infile, intervals = infiles
     fasta = os.path.join(PARAMS["fasta"],PARAMS["genome"]) + ".fasta"
     fastamap = PARAMS["mapfasta"]
     drctry= PARAMS["tmpdir"]
     tempfile=P.snip(outfile,".gz")
-    statement = '''java -Xmx10G -Djava.io.tmpdir=%(drctry)s -jar ~/Downloads/GenomeAnalysisTK-3.8-0-ge9d806836/GenomeAnalysisTK.jar 
+    statement = '''java -Xmx%(java_heap)s -Djava.io.tmpdir=%(drctry)s -jar ~/Downloads/GenomeAnalysisTK-3.8-0-ge9d806836/GenomeAnalysisTK.jar 
                    -T HaplotypeCaller
                    -R %(fastamap)s 
                    -I %(infile)s 
+                   -L %(intervals)s
                    -dontUseSoftClippedBases 
                    -stand_call_conf 20.0 
                    -o %(tempfile)s;
@@ -263,11 +521,29 @@ def variantcalling(infile,outfile):
                    bgzip %(tempfile)s;
                    '''  
 
-    job_memory = "12G"
-    P.run()                 
+    run_sized("variantcalling", statement, infile, locals(), "12G")
 
 
-@transform(variantcalling,regex(r"(.+).vcf.gz"),r"\1.reheader.vcf.gz.tbi")
+@collate(variantcalling,
+         regex(r"Variantcalls.dir/(.+)\.chunk\d+.vcf.gz"),
+         r"Variantcalls.dir/\1.vcf.gz")
+def gather_variants(infiles, outfile):
+    '''join the variant calls of the chunks of a sample, in the order of the
+    genome, into a single bgzipped and tabix indexed VCF file'''
+    chunks = " ".join(sorted(infiles))
+    statement = '''bcftools concat
+                                -O z
+                                -o %(outfile)s
+                                %(chunks)s;
+
+                    checkpoint;
+
+                                tabix -p vcf %(outfile)s'''
+    job_memory = "2G"
+    P.run()
+
+
+@transform(gather_variants,regex(r"(.+).vcf.gz"),r"\1.reheader.vcf.gz.tbi")
 def renamesample(infile,outfile):
     renamefile=P.snip(infile,".vcf.gz")+".txt"
     tempfile=P.snip(outfile,".tbi")
@@ -294,34 +570,131 @@ def renamesample(infile,outfile):
     
 #add_inputs("geneset_all.gtf.gz")
 # ---------------------------------------------------
+@follows(mkdir("redi.dir"))
+@files(os.path.expanduser(PARAMS["redipath"]), "redi.dir/redi.contigs.tsv")
+def index_redi(infile, outfile):
+    '''Convert the REDIportal table into a memory-mapped index that all the
+    counting jobs share'''
+    prefix = P.snip(outfile, ".contigs.tsv")
+    statement = '''python %(projectsrc)s/index_redi.py
+                                         -I %(infile)s
+                                         --index-prefix=%(prefix)s
+                                         -S %(prefix)s.tsv
+                                         -L %(prefix)s.log'''
+    job_memory="8G"
+    P.run()
+
+
+@files(os.path.join(PARAMS["fasta"], PARAMS["genome"]) + ".fasta",
+       os.path.join(PARAMS["fasta"], PARAMS["genome"]) + ".genome.contigs.tsv")
+def index_genome(infile, outfile):
+    '''Write the genome as a memory-mapped array of bases next to the
+    fasta file. It is built once per genome and shared by every counting
+    job'''
+    fastapath = P.snip(infile, ".fasta")
+    prefix = P.snip(outfile, ".contigs.tsv")
+    statement = '''python %(projectsrc)s/index_genome.py
+                                         --fasta-path=%(fastapath)s
+                                         --index-prefix=%(prefix)s
+                                         -L %(prefix)s.log'''
+    job_memory="4G"
+    P.run()
+
+
+@follows(mkdir("geneset.dir"))
+@files(PARAMS["gtf"], GENE_INDEX + ".contigs.tsv")
+def compile_geneset(infile, outfile):
+    '''Compile the gene models of the geneset into a memory-mapped index
+    in geneset.dir, so the GTF is parsed once rather than by every
+    counting job'''
+    prefix = P.snip(outfile, ".contigs.tsv")
+    statement = '''python %(projectsrc)s/compile_geneset.py
+                                         -I %(infile)s
+                                         --index-prefix=%(prefix)s
+                                         -S %(prefix)s.tsv
+                                         -L %(prefix)s.log'''
+    job_memory="4G"
+    P.run()
+
+
 @active_if(PARAMS['vcfavail'])
-@follows(mkdir("mismatches.dir"))
-@transform(dedup_bams,
+@follows(mkdir("variants.dir"))
+@transform([dedup_bams, fused_dedup_bams],
            regex(r"deduped.dir/(.+).bam"),
-           r"mismatches.dir/\1.tsv.gz")
-def count_mismatches(infile, outfile):
-    ''' Count mismatches per sequenced base, per read, discarding duplicated reads
-    and low quality bases'''
-    fastapath = os.path.join(PARAMS["fasta"],PARAMS["genome"])
+           r"variants.dir/\1.variants.contigs.tsv")
+def index_variants(infile, outfile):
+    '''Extract the donor's non-reference sites from the cohort VCF into a
+    compact index, so the genotypes are only parsed once per donor'''
     vcfpath = PARAMS["vcf"]
-    gtfpath = PARAMS["gtf"]
-    redipath = PARAMS["redipath"]
     sampat = "deduped.dir/" + PARAMS["samplepattern"]
     samplepattern = '"%s"'%(sampat)
+    prefix = P.snip(outfile, ".contigs.tsv")
+    statement = '''python %(projectsrc)s/index_variants.py
+                                         --vcf-path=%(vcfpath)s
+                                         --bamfile=%(infile)s
+                                         -d %(samplepattern)s
+                                         --index-prefix=%(prefix)s
+                                         -S %(prefix)s.tsv
+                                         -L %(prefix)s.log'''
+    job_memory="4G"
+    P.run()
+
+
+@follows(mkdir("mismatches.dir"))
+@subdivide(slim_bams,
+           regex(r"slim.dir/(.+).bam"),
+           r"mismatches.dir/\1.chunk*.bed",
+           r"mismatches.dir/\1")
+def scatter_mismatch_regions(infile, outfiles, prefix):
+    '''Split the contigs into chunks with about the same number of reads in
+    the sample, going by the BAM index, so that each sample is counted in
+    several smaller jobs. Contigs are not split, so each gene is counted by
+    one job'''
+    chunks = PARAMS["mismatch_scatter"]
+    statement = '''python %(projectsrc)s/make_intervals.py
+                                         --bamfile=%(infile)s
+                                         --chunks=%(chunks)s
+                                         --whole-contigs
+                                         --output-format=bed
+                                         --output-prefix=%(prefix)s
+                                         -S %(prefix)s.chunks.tsv
+                                         -L %(prefix)s.chunks.log'''
+    job_memory = "2G"
+    P.run()
+
+
+@active_if(PARAMS['vcfavail'])
+@follows(index_redi, index_genome, compile_geneset, index_variants)
+@transform(scatter_mismatch_regions,
+           regex(r"mismatches.dir/(.+)\.(chunk\d+).bed"),
+           add_inputs(r"variants.dir/\1.variants.contigs.tsv",
+                      r"slim.dir/\1.bam"),
+           r"mismatches.dir/\1.\2" + COUNTS_SUFFIX)
+def count_mismatches(infiles, outfile):
+    ''' Count mismatches per sequenced base, per read, discarding duplicated reads
+    and low quality bases, in one chunk of the contigs'''
+    regions, variant_index, infile = infiles
+    genome_index = os.path.join(PARAMS["fasta"], PARAMS["genome"]) + ".genome"
+    gene_index = GENE_INDEX
+    redi_index = "redi.dir/redi"
     quality_threshold = PARAMS["quality_threshold"]
+    counter_options = mismatch_options(regions)
+    output_options = mismatch_output(outfile)
     statement = '''python %(projectsrc)s/count_mismatches.py
-                                         -I %(gtfpath)s
+                                         --gene-index=%(gene_index)s
                                          --bamfile=%(infile)s
                                          --quality-threshold=%(quality_threshold)s
-                                         --fasta-path=%(fastapath)s
-                                         -d %(samplepattern)s
-                                         --vcf-path=%(vcfpath)s
-                                         --REDI-path=%(redipath)s
-                                         -S %(outfile)s
+                                         --workers=%(job_threads)s
+                                         --genome-index=%(genome_index)s
+                                         --variant-index=%(variant_index)s
+                                         --REDI-index=%(redi_index)s
+                                         %(counter_options)s
+                                         %(output_options)s
                                          -L %(outfile)s.log
                                          -v5 '''
-    job_memory="6G"
-    P.run()
+    workers = PARAMS["mismatch_workers"]
+    run_sized("count_mismatches", statement, infile, locals(), "3G",
+              workers, max_threads=workers)
 
 #@transform(dedup_bams,
 #           formatter(),
@@ -329,51 +702,101 @@ def count_mismatches(infile, outfile):
 
 @active_if(not(PARAMS['vcfavail']))
 @follows("renamesample")
-@follows(mkdir("mismatches.dir"))
-@transform(dedup_bams,
-           regex(r"deduped.dir/(.+).bam"),
-           r"mismatches.dir/\1.tsv.gz")
-def count_mismatches_with_VCF(infile, outfile):
+@follows(index_redi, index_genome, compile_geneset)
+@transform(scatter_mismatch_regions,
+           regex(r"mismatches.dir/(.+)\.(chunk\d+).bed"),
+           add_inputs(r"slim.dir/\1.bam"),
+           r"mismatches.dir/\1.\2" + COUNTS_SUFFIX)
+def count_mismatches_with_VCF(infiles, outfile):
     ''' Count mismatches per sequenced base, per read, discarding duplicated reads
-    and low quality bases'''
-    fastapath = os.path.join(PARAMS["fasta"],PARAMS["genome"])
-    vcfname = re.search(r"deduped.dir/(.+).bam", infile, flags = 0).group(1) + ".reheader.vcf.gz"
+    and low quality bases, in one chunk of the contigs'''
+    regions, infile = infiles
+    genome_index = os.path.join(PARAMS["fasta"], PARAMS["genome"]) + ".genome"
+    vcfname = re.search(r"slim.dir/(.+).bam", infile, flags = 0).group(1) + ".reheader.vcf.gz"
     vcfpath = "Variantcalls.dir/" + vcfname
-    gtfpath = PARAMS["gtf"]
-    redipath = PARAMS["redipath"]
-    sampat = "deduped.dir/" + PARAMS["samplepattern"]
+    gene_index = GENE_INDEX
+    redi_index = "redi.dir/redi"
+    sampat = "slim.dir/" + PARAMS["samplepattern"]
     samplepattern = '"%s"'%(sampat)
     quality_threshold = PARAMS["quality_threshold"]
+    counter_options = mismatch_options(regions)
+    output_options = mismatch_output(outfile)
     statement = '''python %(projectsrc)s/count_mismatches.py
-                                         -I %(gtfpath)s
+                                         --gene-index=%(gene_index)s
                                          --bamfile=%(infile)s
                                          --quality-threshold=%(quality_threshold)s
-                                         --fasta-path=%(fastapath)s
+                                         --workers=%(job_threads)s
+                                         --genome-index=%(genome_index)s
                                          --vcf-path=%(vcfpath)s
-                                         --REDI-path=%(redipath)s
+                                         --REDI-index=%(redi_index)s
                                          -d %(samplepattern)s
-                                         -S %(outfile)s
+                                         %(counter_options)s
+                                         %(output_options)s
                                          -L %(outfile)s.log
                                          -v5'''
-    job_memory="8G"
+    workers = PARAMS["mismatch_workers"]
+    run_sized("count_mismatches_with_VCF", statement, infile, locals(),
+              "4G", workers, max_threads=workers)
+
+
+@collate([count_mismatches, count_mismatches_with_VCF],
+         regex(r"mismatches.dir/(.+)\.chunk\d+" + re.escape(COUNTS_SUFFIX)),
+         r"mismatches.dir/\1" + COUNTS_SUFFIX)
+def gather_mismatch_counts(infiles, outfile):
+    '''Join the counts of the chunks of a sample into the counts for the
+    whole sample, in the order of the geneset, adding up their summary
+    counters and merging their tallies'''
+    parts = " ".join(sorted(infiles))
+    gene_index = GENE_INDEX
+    output_options = mismatch_output(outfile, checkpoint=False)
+    statement = '''python %(projectsrc)s/gather_mismatch_counts.py
+                                         --gene-index=%(gene_index)s
+                                         %(output_options)s
+                                         -L %(outfile)s.log
+                                         %(parts)s'''
+    job_memory = "2G"
     P.run()
 
 # ---------------------------------------------------
-@merge([count_mismatches,count_mismatches_with_VCF],
-       "mismatch_counts.load")
+@merge(gather_mismatch_counts, "mismatch_counts.load")
 def merge_mismatch_counts(infiles, outfile):
-    '''Load the results of mismatch counting into the database'''
-    
-    P.concatenateAndLoad(infiles, outfile,
-                         regex_filename="mismatches.dir/(.+)-(.+)-(.+).tsv.gz",
-                         cat="tissue,replicate,sample",
-                         options="-i tissue -i replicate -i sample -i gene_id",
-			 job_memory="30G")
+    '''Load the results of mismatch counting into the database, streaming
+    each sample in and only loading samples that are new or have been
+    counted again since the last load'''
+
+    infiles = " ".join(infiles)
+    database = PARAMS["database"]
+    statement = '''python %(projectsrc)s/load_mismatch_counts.py
+                                         --database=%(database)s
+                                         --table=mismatch_counts
+                                         --append
+                                         -i tissue -i replicate
+                                         -i sample -i gene_id
+                                         -L %(outfile)s.log
+                                         %(infiles)s
+                                         > %(outfile)s'''
+    job_memory = "2G"
+    P.run()
+
+
+@active_if(PARAMS["mismatch_tallies"])
+@merge(gather_mismatch_counts, "mismatch_tallies.tally")
+def merge_mismatch_tallies(infiles, outfile):
+    '''Merge the per-position mismatch tallies of all the samples'''
+
+    tallies = " ".join(tally_file(infile) for infile in infiles)
+    statement = '''python %(projectsrc)s/merge_mismatch_tallies.py
+                                         --output-path=%(outfile)s
+                                         -L %(outfile)s.log
+                                         %(tallies)s
+                                         > %(outfile)s.tsv'''
+    job_memory = "4G"
+    P.run()
 
 
 # ---------------------------------------------------
 # Generic pipeline tasks
-@follows(merge_mismatch_counts)
+@follows(merge_mismatch_counts, merge_mismatch_tallies)
 def full():
     pass
 
@@ -0,0 +1,155 @@
+'''
+test_count_mismatches_serve.py - test the count_mismatches.py daemon
+====================================================================
+
+:Author: Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+
+Start ``count_mismatches.py --serve`` on a unix socket in a temporary
+directory, with a small data set from benchmarks/make_synthetic_data.py,
+and send it jobs with count_mismatches_client.py. Nothing outside the
+temporary directory is needed.
+
+Run with::
+
+   python -m unittest discover -s tests -v
+
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+SRCDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SRCDIR, "benchmarks"))
+
+import make_synthetic_data
+
+GENES = ["ENSG00001", "ENSG00002", "ENSG00010"]
+
+
+def script(name):
+    return [sys.executable, os.path.join(SRCDIR, name)]
+
+
+class TestServe(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp(prefix="test_serve.")
+        cls.datadir = os.path.join(cls.tmpdir, "data")
+        make_synthetic_data.make_data(cls.datadir, 2000)
+        cls.bam = os.path.join(cls.datadir,
+                               "%s.bam" % make_synthetic_data.DONORS[0])
+        cls.socket = os.path.join(cls.tmpdir, "mismatches.sock")
+
+        cls.log = open(os.path.join(cls.tmpdir, "serve.log"), "w")
+        cls.daemon = subprocess.Popen(
+            cls.count_options() + ["--serve=%s" % cls.socket],
+            stderr=cls.log)
+        for i in range(600):
+            if os.path.exists(cls.socket) or cls.daemon.poll() is not None:
+                break
+            time.sleep(0.1)
+        if not os.path.exists(cls.socket):
+            cls.tearDownClass()
+            raise OSError("daemon did not start, see %s" % cls.log.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.daemon.poll() is None:
+            cls.daemon.terminate()
+            cls.daemon.wait()
+        cls.log.close()
+        shutil.rmtree(cls.tmpdir)
+
+    @classmethod
+    def count_options(cls):
+        '''the count_mismatches.py options shared by the daemon and the
+        direct runs'''
+
+        return script("count_mismatches.py") + [
+            "-I", os.path.join(cls.datadir, "genes.gtf"),
+            "--fasta-path=%s" % os.path.join(cls.datadir, "genome"),
+            "--vcf-path=%s" % os.path.join(cls.datadir, "variants.vcf.gz"),
+            "--REDI-path=%s" % os.path.join(cls.datadir, "redi.bed.gz"),
+            "--sample=([^/]+)-0001.bam"]
+
+    def run_client(self, outfile, bam, genes):
+        '''send a job to the daemon. Returns the exit status of the
+        client.'''
+
+        with open(outfile + ".log", "w") as log:
+            return subprocess.call(
+                script("count_mismatches_client.py") + [
+                    "--socket=%s" % self.socket,
+                    "--bamfile=%s" % bam,
+                    "--genes=%s" % ",".join(genes),
+                    "-S", outfile], stderr=log)
+
+    def run_direct(self, outfile, genes):
+        '''count `genes` with count_mismatches.py itself'''
+
+        with open(outfile + ".log", "w") as log:
+            subprocess.check_call(
+                self.count_options() + [
+                    "--bamfile=%s" % self.bam,
+                    "--genes=%s" % ",".join(genes),
+                    "-S", outfile], stderr=log)
+
+    def read(self, path):
+        with open(path) as inf:
+            return inf.readlines()
+
+    def test_rows_match_direct_run(self):
+        served = os.path.join(self.tmpdir, "served.tsv")
+        direct = os.path.join(self.tmpdir, "direct.tsv")
+        self.assertEqual(self.run_client(served, self.bam, GENES), 0)
+        self.run_direct(direct, GENES)
+
+        rows = self.read(served)
+        self.assertEqual(len(rows), len(GENES) + 1)
+        self.assertEqual(rows, self.read(direct))
+
+    def send_job(self, job):
+        '''send `job` to the daemon over the socket. Returns the lines
+        it sends back.'''
+
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(self.socket)
+        connection.sendall(json.dumps(job).encode("utf-8") + b"\n")
+        lines = connection.makefile("rb").readlines()
+        connection.close()
+        return lines
+
+    def test_bad_jobs_leave_daemon_serving(self):
+        lines = self.send_job(
+            {"bamfile": os.path.join(self.tmpdir, "none.bam"),
+             "genes": GENES[:1]})
+        self.assertEqual(len(lines), 1)
+        status, message = lines[0].rstrip("\n").split("\t", 1)
+        self.assertEqual(status, "#error")
+        self.assertIn("none.bam", json.loads(message))
+
+        failed = os.path.join(self.tmpdir, "failed.tsv")
+        self.assertNotEqual(
+            self.run_client(failed, self.bam, ["ENSG_UNKNOWN"]), 0)
+        self.assertIn("job failed: unknown genes: ENSG_UNKNOWN",
+                      open(failed + ".log").read())
+
+        served = os.path.join(self.tmpdir, "after.tsv")
+        self.assertEqual(self.run_client(served, self.bam, GENES[:1]), 0)
+        self.assertEqual(len(self.read(served)), 2)
+        self.assertIsNone(self.daemon.poll())
+
+
+if __name__ == "__main__":
+    unittest.main()